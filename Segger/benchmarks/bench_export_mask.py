@@ -0,0 +1,102 @@
+# -----------------------------------------------------------------------------
+# Time and peak memory of exporting a large synthetic segmentation mask as a
+# map of top level region ids with segcmd.MaskIdGrid, which computes ids a
+# plane at a time as the file is written, compared with the earlier export
+# that made the relabelled and unbinned id array for the whole mask.
+# Needs ChimeraX (chimerax.map_data) for the map file writers.
+#
+import argparse, os, sys, tempfile
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from benchutil import segger_module
+
+def synthetic_mask(shape, region_size, nregions, seed = 0):
+    '''uint16 mask of box shaped leaf regions with random ids, a plane at a time.'''
+    rs = numpy.random.RandomState(seed)
+    coarse = [-(-s // region_size) for s in shape]
+    ids = rs.randint(1, nregions + 1, coarse).astype(numpy.uint16)
+    mask = numpy.empty(shape, numpy.uint16)
+    for k in range(shape[0]):
+        plane = ids[k // region_size].repeat(region_size, 0).repeat(region_size, 1)
+        mask[k] = plane[:shape[1], :shape[2]]
+    return mask
+
+def full_array_export(mask, lut, bin_size, path, save_grid_data):
+    '''Export as before streaming, relabel and unbin the whole mask.'''
+    array = lut[mask]
+    b2, b1, b0 = bin_size
+    if tuple(bin_size) != (1,1,1):
+        ks, js, i_s = array.shape
+        aub = numpy.zeros((ks*b0, js*b1, i_s*b2), array.dtype)
+        for o0 in range(b0):
+            for o1 in range(b1):
+                for o2 in range(b2):
+                    aub[o0::b0, o1::b1, o2::b2] = array
+        array = aub
+    from chimerax.map_data import ArrayGridData
+    g = ArrayGridData(array, (0,0,0), (1,1,1), name = 'region ids')
+    save_grid_data(g, path, None, format = 'mrc')
+    return array
+
+def streaming_export(mask, lut, bin_size, path, save_grid_data):
+    MaskIdGrid = segger_module('segcmd').MaskIdGrid
+    value_type = numpy.uint16 if lut.max() <= 65535 else numpy.uint32
+    g = MaskIdGrid(mask, lut.astype(value_type), bin_size, (0,0,0), (1,1,1),
+                   name = 'region ids')
+    save_grid_data(g, path, None, format = 'mrc')
+    return g
+
+def measure(func, *args):
+    '''Seconds, peak MB of numpy and Python allocations, and the result.'''
+    import tracemalloc
+    from time import perf_counter
+    tracemalloc.start()
+    t0 = perf_counter()
+    result = func(*args)
+    t = perf_counter() - t0
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return t, peak / 2**20, result
+
+def main(args):
+    from chimerax.map_data import save_grid_data
+    shape = (args.size,) * 3
+    bin_size = (args.bin,) * 3
+    mask = synthetic_mask(shape, args.region_size, args.regions, args.seed)
+    rs = numpy.random.RandomState(args.seed)
+    lut = numpy.zeros((args.regions + 1,), numpy.uint32)
+    lut[1:] = rs.randint(1, args.groups + 1, args.regions)   # Top level group of each leaf.
+    mb = mask.nbytes / 2**20
+    print('Mask %s uint16 (%.0f MB), bin size %d, export grid %d^3'
+          % ('x'.join(str(s) for s in shape), mb, args.bin, args.size * args.bin))
+
+    d = tempfile.mkdtemp()
+    spath, fpath = os.path.join(d, 'streaming.mrc'), os.path.join(d, 'full.mrc')
+    ts, ms, g = measure(streaming_export, mask, lut, bin_size, spath, save_grid_data)
+    print('%-22s %8.2f sec %10.1f MB peak  %8.0f MB file'
+          % ('streaming planes', ts, ms, os.path.getsize(spath) / 2**20))
+    if not args.skip_full:
+        tf, mf, array = measure(full_array_export, mask, lut, bin_size, fpath, save_grid_data)
+        print('%-22s %8.2f sec %10.1f MB peak  %8.0f MB file'
+              % ('full array', tf, mf, os.path.getsize(fpath) / 2**20))
+        # Both exports give the same region ids.
+        for k in numpy.linspace(0, array.shape[0]-1, 5).astype(int):
+            plane = g.matrix((0,0,int(k)), (array.shape[2], array.shape[1], 1))
+            assert (plane[0] == array[k]).all(), 'plane %d differs' % k
+        print('Region ids agree')
+    for p in (spath, fpath):
+        if os.path.exists(p):
+            os.remove(p)
+    os.rmdir(d)
+
+if __name__ == '__main__' or __name__.startswith('ChimeraX_sandbox'):
+    p = argparse.ArgumentParser(description = 'Benchmark streaming segmentation mask export.')
+    p.add_argument('--size', type = int, default = 384, help = 'mask grid size along each axis')
+    p.add_argument('--bin', type = int, default = 2, help = 'map grid points per mask voxel')
+    p.add_argument('--region-size', type = int, default = 6, help = 'leaf region edge length')
+    p.add_argument('--regions', type = int, default = 60000, help = 'number of leaf region ids')
+    p.add_argument('--groups', type = int, default = 5000, help = 'number of top level groups')
+    p.add_argument('--seed', type = int, default = 0)
+    p.add_argument('--skip-full', action = 'store_true', help = 'only run the streaming export')
+    main(p.parse_args())
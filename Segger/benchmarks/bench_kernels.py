@@ -0,0 +1,66 @@
+# -----------------------------------------------------------------------------
+# Time each segmentation kernel with each available backend on a synthetic
+# map and report whether the results agree with the first backend.
+#
+import argparse, os, sys
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from benchutil import segger_module, synthetic_map, timed
+
+def kernel_calls(k, m, threshold, mask, points):
+    return (('watershed_regions', lambda: (k.watershed_regions(m, threshold, mask), mask.copy())[1]),
+            ('region_maxima', lambda: k.region_maxima(mask, m)),
+            ('region_contacts', lambda: sorted_pairs(k.region_contacts(mask))),
+            ('interface_values', lambda: sorted_pairs(*k.interface_values(mask, m))),
+            ('region_bounds', lambda: k.region_bounds(mask)),
+            ('region_points', lambda: k.region_points(mask, 1)),
+            ('find_local_maxima', lambda: moved(k, m, points)))
+
+def sorted_pairs(ci, cf = None):
+    order = numpy.lexsort((ci[:,1], ci[:,0]))
+    return ci[order] if cf is None else (ci[order], cf[order])
+
+def moved(k, m, points):
+    p = points.copy()
+    k.find_local_maxima(m, p)
+    return p
+
+def same(a, b):
+    if isinstance(a, tuple):
+        return len(a) == len(b) and all(same(x, y) for x, y in zip(a, b))
+    a, b = numpy.asarray(a), numpy.asarray(b)
+    if a.shape != b.shape:
+        return False
+    if a.dtype.kind == 'f' or b.dtype.kind == 'f':
+        return bool(numpy.allclose(a, b, rtol = 1e-5, atol = 1e-5))
+    return bool((a == b).all())
+
+def main(args):
+    kernels = segger_module('kernels')
+    shape = (args.size,) * 3
+    nblobs = max(1, int(args.density * args.size**3))
+    m = synthetic_map(shape, nblobs, args.seed)
+    rs = numpy.random.RandomState(args.seed)
+    points = rs.randint(0, args.size, (1000,3)).astype(numpy.intc)
+    names = args.backends or kernels.available_backends()
+    print('Map %s, %d blobs, backends %s' % ('x'.join(str(s) for s in shape), nblobs, ', '.join(names)))
+    print('%-18s %-10s %10s  %s' % ('kernel', 'backend', 'seconds', 'same'))
+    reference = {}
+    for name in names:
+        k = kernels.backend(name)
+        mask = numpy.zeros(shape, numpy.uint32)
+        for kname, call in kernel_calls(k, m, args.threshold, mask, points):
+            t, result = timed(call, args.repeat)
+            ok = same(reference.setdefault(kname, result), result)
+            print('%-18s %-10s %10.4f  %s' % (kname, name, t, ok))
+
+if __name__ == '__main__' or __name__.startswith('ChimeraX_sandbox'):
+    p = argparse.ArgumentParser(description = 'Time segmentation kernels of each backend.')
+    p.add_argument('--size', type = int, default = 128, help = 'map grid size along each axis')
+    p.add_argument('--density', type = float, default = 1e-3, help = 'blobs per grid point')
+    p.add_argument('--threshold', type = float, default = 0.1)
+    p.add_argument('--repeat', type = int, default = 3)
+    p.add_argument('--seed', type = int, default = 0)
+    p.add_argument('--backends', nargs = '*', help = 'backend names, default all available')
+    main(p.parse_args())
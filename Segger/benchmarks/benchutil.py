@@ -0,0 +1,53 @@
+# -----------------------------------------------------------------------------
+# Helpers for the Segger benchmark scripts.  Scripts use the installed bundle
+# when run by ChimeraX,
+#
+#   chimerax --nogui --exit --script "Segger/benchmarks/bench_kernels.py --size 160"
+#
+# (ChimeraX runs scripts with a module name starting with ChimeraX_sandbox)
+#
+# or the modules in Segger/src that do not need ChimeraX when run by a plain
+# Python with numpy.
+#
+import importlib, os, sys, types
+import numpy
+
+def segger_module(name):
+    try:
+        return importlib.import_module('chimerax.segger.' + name)
+    except ImportError:
+        pass
+    if 'segger' not in sys.modules:
+        src = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+        pkg = types.ModuleType('segger')     # Skip src/__init__.py, it needs ChimeraX.
+        pkg.__path__ = [src]
+        pkg.timing = False
+        pkg.debug = False
+        sys.modules['segger'] = pkg
+    return importlib.import_module('segger.' + name)
+
+def synthetic_map(shape, nblobs, seed = 0, blob_size = (1.5, 3.5)):
+    '''Sum of Gaussian blobs, float32, computed a z plane at a time.'''
+    rs = numpy.random.RandomState(seed)
+    centers = rs.uniform(0, 1, (nblobs,3)) * numpy.array(shape)
+    heights = rs.uniform(.5, 1.5, nblobs)
+    widths = rs.uniform(*blob_size, nblobs)
+    m = numpy.zeros(shape, numpy.float32)
+    j, i = numpy.indices(shape[1:])
+    r = int(3 * blob_size[1]) + 1
+    for c, h, w in zip(centers, heights, widths):
+        k0, k1 = max(0, int(c[0]) - r), min(shape[0], int(c[0]) + r + 1)
+        j0, j1 = max(0, int(c[1]) - r), min(shape[1], int(c[1]) + r + 1)
+        i0, i1 = max(0, int(c[2]) - r), min(shape[2], int(c[2]) + r + 1)
+        for k in range(k0, k1):
+            d2 = (k-c[0])**2 + (j[j0:j1,i0:i1]-c[1])**2 + (i[j0:j1,i0:i1]-c[2])**2
+            m[k,j0:j1,i0:i1] += h * numpy.exp(-d2 / (2*w*w))
+    return m
+
+def timed(func, repeat = 1):
+    '''Mean seconds per call and the result of the last call.'''
+    from time import perf_counter
+    t0 = perf_counter()
+    for r in range(repeat):
+        result = func()
+    return (perf_counter() - t0) / repeat, result
@@ -40,9 +40,14 @@ class _SeggerAPI(BundleAPI):
         if mgr == session.open_command:
             from chimerax.open_command import OpenerInfo
             class OpenSegmentationInfo(OpenerInfo):
-                def open(self, session, path, file_name, **kw):
+                def open(self, session, path, file_name, memory_map = False, **kw):
                     from .segfile import open_segmentation
-                    return open_segmentation(session, path, file_name)
+                    return open_segmentation(session, path, file_name,
+                                             memory_map = memory_map)
+                @property
+                def open_args(self):
+                    from chimerax.core.commands import BoolArg
+                    return { 'memory_map': BoolArg }
             return OpenSegmentationInfo()
         elif mgr == session.save_command:
             from chimerax.save_command import SaverInfo
@@ -56,6 +61,7 @@ class _SeggerAPI(BundleAPI):
                     return { 'models': ModelsArg }
                 def save_args_widget(self, session):
                     from chimerax.save_command.widgets import SaveModelOptionWidget
+                    from .regions import Segmentation
                     return SaveModelOptionWidget(session, 'Segmentation', Segmentation)
                 def save_args_string_from_widget(self, widget):
                     return widget.options_string()
@@ -73,4 +79,11 @@ timing = False          # Report execution times for optimizing code.
 seggerVersion = '2.3'
 debug = False		# Whether to output debugging messages
 
-from .regions import Segmentation, Region, SelectedRegions
+# Segmentation classes are imported on first use so that worker processes
+# started by the parallel module do not import the graphics and user
+# interface modules.
+def __getattr__(name):
+    if name in ('Segmentation', 'Region', 'SelectedRegions'):
+        from . import regions
+        return getattr(regions, name)
+    raise AttributeError('module %s has no attribute %s' % (__name__, name))
@@ -618,43 +618,21 @@ def SphereMesh (r, div, color, pos, mol) :
 def prAxes ( points ) :
 
     com = numpy.mean(points, axis=0)
+    p = numpy.asarray(points - com, numpy.float64)
 
-    comv = numpy.ones_like ( points ) * com
-    points = points - comv
-
-    i = numpy.matrix ( [[1,0,0], [0,1,0], [0,0,1]] )
-    ii = i * numpy.sum ( numpy.multiply ( points, points ) )
-    p_t = numpy.transpose(points)
-    td = numpy.tensordot ( points, p_t, axes=[0,1] )
-
-    I0 = ii - td
+    # Inertia tensor of unit masses at the points.
+    s = numpy.dot(p.T, p)
+    I0 = numpy.trace(s) * numpy.eye(3) - s
 
+    from .moments import inertia_axes
     try :
-        U, S, V = numpy.linalg.svd( I0 )
-    except :
+        U, S, V = inertia_axes ( I0.reshape((1,3,3)) )
+    except numpy.linalg.LinAlgError :
         print("- error computing SVD - prob. singular matrix")
         return []
 
-    #U[0,0] = U[0,0] * -1.0
-    #U[1,0] = U[1,0] * -1.0
-    #U[2,0] = U[2,0] * -1.0
-
-    #U[0,2] = U[0,2] * -1.0
-    #U[1,2] = U[1,2] * -1.0
-    #U[2,2] = U[2,2] * -1.0
-
-    # The sign of each row of V and column of U is indeterminate and they can
-    # define a left-handed coordinate system.  Make sure they produce a right
-    # handed coordinate system.
-    for r in (0,1,2):
-        if V[r,r] < 0:
-            V[r,:] *= -1
-            U[:,r] *= -1
-    if numpy.linalg.det(V) < 0:
-        V[2,:] *= -1
-        U[:,2] *= -1
-
-    return [com, U, S, V]
+    # Callers multiply point arrays by U and V as matrices.
+    return [com, numpy.matrix(U[0]), S[0], numpy.matrix(V[0])]
 
 
 
@@ -0,0 +1,398 @@
+# -----------------------------------------------------------------------------
+# Contacts between segmentation regions as a sparse graph of parallel arrays,
+# computed from the mask and summed over region groups.  Uses only numpy so
+# it can be used and tested without ChimeraX.
+#
+import numpy
+from . import timing
+from time import time as clock
+from .log import debug
+
+# -----------------------------------------------------------------------------
+#
+class Contact:
+
+    def __init__ (self, ncontact):
+
+        self.N = ncontact               # number of voxel pairs
+        self.D = 0.0                    # divide by 2*N to get average
+        self.maximum_density = None
+
+# -----------------------------------------------------------------------------
+#
+class RegionContacts:
+
+    '''
+    Symmetric sparse graph of contacts between regions.  Contacts are held
+    as parallel arrays with one entry per contacting pair of region ids,
+    r1 < r2.  N is the number of contacting voxel pairs, D the sum of
+    interface densities and maximum_density the maximum interface density.
+    D and maximum_density are None if no map was used.  A compressed row
+    index over both orderings of each pair is built on first use for
+    neighbor and degree queries.
+    '''
+
+    def __init__ (self, segmentation, r1, r2, N, D = None, maximum_density = None):
+
+        self.segmentation = segmentation
+        r1 = numpy.asarray(r1, numpy.int32)
+        r2 = numpy.asarray(r2, numpy.int32)
+        self.r1 = numpy.minimum(r1, r2)
+        self.r2 = numpy.maximum(r1, r2)
+        self.N = numpy.asarray(N, numpy.int64)
+        self.D = D
+        self.maximum_density = maximum_density
+        self._row_start = None      # Index into neighbor arrays by region id.
+        self._neighbors = None      # Contacting region ids grouped by region.
+        self._edges = None          # Contact array index for each neighbor.
+
+    @property
+    def count(self):
+        return len(self.r1)
+
+    def pair_keys(self, r1, r2):
+        r1 = numpy.asarray(r1, numpy.int64)
+        r2 = numpy.asarray(r2, numpy.int64)
+        a, b = numpy.minimum(r1, r2), numpy.maximum(r1, r2)
+        return (a << 32) | b
+
+    def pair_indices(self, r1, r2):
+        '''Index of each region id pair in the contact arrays.'''
+        keys = self.pair_keys(self.r1, self.r2)
+        order = numpy.argsort(keys)
+        k = self.pair_keys(r1, r2)
+        i = numpy.searchsorted(keys, k, sorter = order)
+        i = numpy.minimum(i, len(keys)-1)
+        if len(keys) == 0 or (keys[order[i]] != k).any():
+            raise KeyError('Region pair has no contact')
+        return order[i]
+
+    def _adjacency(self):
+
+        if self._row_start is None:
+            n = self.count
+            size = int(max(self.r1.max(), self.r2.max())) + 2 if n else 1
+            rows = numpy.concatenate((self.r1, self.r2))
+            order = numpy.argsort(rows, kind = 'stable')
+            self._neighbors = numpy.concatenate((self.r2, self.r1))[order]
+            self._edges = (order % n).astype(numpy.int32) if n else order.astype(numpy.int32)
+            start = numpy.zeros((size+1,), numpy.int64)
+            numpy.cumsum(numpy.bincount(rows, minlength = size), out = start[1:])
+            self._row_start = start
+        return self._row_start, self._neighbors, self._edges
+
+    def _row(self, rid):
+
+        start, nbrs, edges = self._adjacency()
+        if rid <= 0 or rid >= len(start)-1:
+            return 0, 0
+        return start[rid], start[rid+1]
+
+    def degree(self, rid):
+        '''Number of regions contacting a region.'''
+        s, e = self._row(rid)
+        return int(e - s)
+
+    def degrees(self, rids):
+        start = self._adjacency()[0]
+        rids = numpy.asarray(rids, numpy.int64)
+        ok = (rids > 0) & (rids < len(start)-1)
+        d = numpy.zeros((len(rids),), numpy.int64)
+        d[ok] = start[rids[ok]+1] - start[rids[ok]]
+        return d
+
+    def neighbors(self, rid):
+        '''Ids of regions contacting a region.'''
+        s, e = self._row(rid)
+        return self._neighbors[s:e]
+
+    def neighbor_contacts(self, rid):
+        '''Ids of regions contacting a region and their contact array indices.'''
+        s, e = self._row(rid)
+        return self._neighbors[s:e], self._edges[s:e]
+
+    def neighbors_of(self, rids):
+        '''Ids of all regions contacting any of the given regions.'''
+        start, nbrs, edges = self._adjacency()
+        rids = numpy.asarray(rids, numpy.int64)
+        rids = rids[(rids > 0) & (rids < len(start)-1)]
+        if len(rids) == 0:
+            return numpy.zeros((0,), numpy.int32)
+        lo, hi = start[rids], start[rids+1]
+        n = hi - lo
+        # Concatenated ranges lo[i]:hi[i].
+        off = numpy.repeat(lo - numpy.cumsum(n) + n, n)
+        i = numpy.arange(n.sum()) + off
+        return numpy.unique(nbrs[i])
+
+    def boundary_ids(self, rids):
+        '''Ids of regions not in the given set that contact the set.'''
+        b = self.neighbors_of(rids)
+        return b[~numpy.isin(b, rids)]
+
+    def contact_index(self, r1, r2):
+        '''Index in the contact arrays of a pair of regions, or -1.'''
+        nbrs, edges = self.neighbor_contacts(r1)
+        i = numpy.nonzero(nbrs == r2)[0]
+        return int(edges[i[0]]) if len(i) else -1
+
+    def contact(self, r1, r2):
+        '''Contact between two region ids, or None if they do not touch.'''
+        i = self.contact_index(r1, r2)
+        return None if i < 0 else self.contact_at(i)
+
+    def contact_at(self, i):
+
+        c = Contact(int(self.N[i]))
+        if self.D is not None:
+            c.D = float(self.D[i])
+        if self.maximum_density is not None:
+            c.maximum_density = float(self.maximum_density[i])
+        return c
+
+    def pairs(self):
+        '''Iterate over (r1 id, r2 id, Contact) for every contacting pair.'''
+        for i, (r1, r2) in enumerate(zip(self.r1.tolist(), self.r2.tolist())):
+            yield r1, r2, self.contact_at(i)
+
+    def remove_regions(self, rids):
+        '''Drop all contacts of the given region ids.'''
+        rids = numpy.asarray(rids, numpy.int32)
+        keep = ~(numpy.isin(self.r1, rids) | numpy.isin(self.r2, rids))
+        if keep.all():
+            return
+        self.r1, self.r2, self.N = self.r1[keep], self.r2[keep], self.N[keep]
+        if self.D is not None:
+            self.D = self.D[keep]
+        if self.maximum_density is not None:
+            self.maximum_density = self.maximum_density[keep]
+        self._row_start = self._neighbors = self._edges = None
+
+    def contact_sizes(self, rids):
+        '''Total number of contacting voxel pairs for each region id.'''
+        size = int(max(self.r1.max(), self.r2.max())) + 1 if self.count else 1
+        n = numpy.bincount(self.r1, weights = self.N, minlength = size)
+        n += numpy.bincount(self.r2, weights = self.N, minlength = size)
+        rids = numpy.asarray(rids, numpy.int64)
+        ok = rids < size
+        csize = numpy.zeros((len(rids),), numpy.int64)
+        csize[ok] = numpy.rint(n[rids[ok]])
+        return csize
+
+# -----------------------------------------------------------------------------
+#
+def mask_contacts(segmentation, map = None, workers = 1):
+    '''
+    Contacts between leaf regions of a segmentation mask as a RegionContacts
+    graph.  Interface densities are included if a map is given.
+    '''
+    from .parallel import region_contacts, interface_values
+    mask = segmentation.mask
+    if timing: t0 = clock()
+    rcon = region_contacts(mask, workers)
+    if timing: t1 = clock()
+    r1, r2, n = rcon[:,0], rcon[:,1], rcon[:,2]
+    rc = RegionContacts(segmentation, r1, r2, n)
+    if timing: t2 = clock()
+    if map is not None:
+        ci, cf = interface_values(mask, map, workers)
+        i = rc.pair_indices(ci[:,0], ci[:,1])
+        D = numpy.zeros((rc.count,), numpy.float64)
+        maxd = numpy.zeros((rc.count,), numpy.float64)
+        D[i] = cf[:,1]
+        maxd[i] = cf[:,0]
+        rc.D, rc.maximum_density = D, maxd
+    if timing: t3 = clock()
+
+    debug('Computed %d contacting pairs' % rc.count)
+    if timing:
+        debug('Time %.2f: contact calc %.2f sec, contact arrays %.2f sec, maxima %.2f sec' % (t3-t0,t1-t0,t2-t1,t3-t2))
+    return rc
+
+# -----------------------------------------------------------------------------
+#
+def group_contacts ( contacts, limit_regions = None, task = None ) :
+    '''
+    Contacts between top level regions summed from leaf region contacts.
+    N and D are sums and maximum_density the maximum over all leaf contacts
+    between two groups.  Contacts within one top level region are dropped.
+    If limit_regions is given only contacts between those top level
+    regions are kept.
+    '''
+    if task:
+        task.updateStatus('Grouping %d contacts' % contacts.count)
+
+    s = contacts.segmentation
+    t = s.table
+    top = t.top_parents()
+
+    p1, p2 = top[contacts.r1], top[contacts.r2]
+    keep = (p1 != p2)
+    if limit_regions is not None:
+        lim = numpy.zeros((t.size,), numpy.bool_)
+        lim[[r.rid for r in limit_regions]] = True
+        keep &= lim[p1]
+        keep &= lim[p2]
+
+    keys = contacts.pair_keys(p1[keep], p2[keep])
+    ukeys, inv = numpy.unique(keys, return_inverse = True)
+    inv = inv.ravel()
+    n = len(ukeys)
+    N = numpy.bincount(inv, weights = contacts.N[keep], minlength = n)
+    N = numpy.rint(N).astype(numpy.int64)
+    D = maxd = None
+    if contacts.D is not None:
+        D = numpy.bincount(inv, weights = contacts.D[keep], minlength = n)
+    if contacts.maximum_density is not None:
+        maxd = numpy.full((n,), -numpy.inf)
+        numpy.maximum.at(maxd, inv, contacts.maximum_density[keep])
+
+    return RegionContacts(s, ukeys >> 32, ukeys & 0xffffffff, N, D, maxd)
+
+# -----------------------------------------------------------------------------
+#
+def merge_by_contact_size ( contacts, join, nsteps, stopAt = 1, task = None ) :
+    '''
+    Agglomerate contacting regions in levels with one pass over a priority
+    queue.  Queue entries are (level, -contact size, id1, id2) so contacts
+    come off a level at a time, largest first, and each region is joined
+    with at most one other region per level.  Contacts of a joined pair are
+    summed into the new region and queued for the next level, stale queue
+    entries for joined regions are skipped when popped.  join(id1, id2)
+    creates the joined region and returns its id.  Stops after nsteps
+    levels or when a level makes no more than stopAt joins.  Returns a
+    list of (id1, id2, new id) joins for each level.
+    '''
+    from heapq import heapify, heappop, heappush
+
+    # Contact sizes keyed by region id then contacting region id.
+    adj = {}
+    heap = []
+    for r1, r2, n in zip(contacts.r1.tolist(), contacts.r2.tolist(),
+                         contacts.N.tolist()):
+        adj.setdefault(r1, {})[r2] = n
+        adj.setdefault(r2, {})[r1] = n
+        heap.append((0, -n, r1, r2))
+    heapify(heap)
+
+    levels = []
+    while heap and len(levels) < nsteps:
+        level = heap[0][0]
+        if task:
+            task.updateStatus('Joining regions, level %d, %d contacts' % (level+1, len(heap)))
+        joins = []
+        while heap and heap[0][0] == level:
+            l, n, r1, r2 = heappop(heap)
+            if r1 not in adj or r2 not in adj:
+                continue            # Stale entry for an already joined region.
+            rj = join(r1, r2)
+            joins.append((r1, r2, rj))
+            # Sum contacts of the joined pair, merging the smaller into the larger.
+            a1, a2 = adj.pop(r1), adj.pop(r2)
+            if len(a1) < len(a2):
+                a1, a2 = a2, a1
+            for r, c in a2.items():
+                a1[r] = a1.get(r, 0) + c
+            a1.pop(r1, None)
+            a1.pop(r2, None)
+            adj[rj] = a1
+            for r, c in a1.items():
+                ar = adj[r]
+                ar.pop(r1, None)
+                ar.pop(r2, None)
+                ar[rj] = c
+                heappush(heap, (level+1, -c, min(r, rj), max(r, rj)))
+        # Every contact left involves a region joined at this level and
+        # was queued for the next level when the join was made.
+        levels.append(joins)
+        debug(" - level %d joined %d pairs, %d queued" % (level+1, len(joins), len(heap)))
+        if len(joins) <= stopAt:
+            break
+
+    return levels
+
+# -----------------------------------------------------------------------------
+#
+def contact_drop_merges(smod, map, join, task = None):
+    '''
+    Join top level regions of a segmentation in order of increasing drop
+    from the lower of the two region maxima to the maximum map value on
+    their interface.  Region maxima are map maxima over the mask voxels
+    of their leaf regions.  Contacts of mask ids that are not leaf regions
+    in the region table are skipped.  join(id1, id2, drop) makes the join
+    and returns the new region id.
+    '''
+    if task:
+        task.updateStatus('Computing interface maxima')
+
+    from .parallel import interface_values, region_maxima
+    ci, cf = interface_values(smod.mask, map, smod.workers)
+    points, values = region_maxima(smod.mask, map)
+
+    if task:
+        task.updateStatus('Computing drops')
+
+    if timing: t0 = clock()
+
+    # Leaf regions of the table found in the mask.
+    t = smod.table
+    lids = t.leaf_ids()
+    lids = lids[t.in_mask[lids] & (lids <= len(values))]
+    leaf = numpy.zeros((max(t.size, len(values)+1),), numpy.bool_)
+    leaf[lids] = True
+    ok = leaf[ci[:,0]] & leaf[ci[:,1]]
+    if not ok.all():
+        debug('skipped %d contacts of mask ids without leaf regions' % (len(ok) - ok.sum()))
+        ci, cf = ci[ok], cf[ok]
+
+    # Union-find parent of each region id, leaves start in their top group.
+    tids = t.top_parents()[lids]
+    up = dict(zip(lids.tolist(), tids.tolist()))
+
+    def find(rid):
+        p = up.get(rid, rid)
+        if p == rid:
+            return rid
+        root = p
+        while up.get(root, root) != root:
+            root = up[root]
+        while rid != root:
+            up[rid], rid = root, up[rid]
+        return root
+
+    # Maximum map value of each top level group.
+    lmax = values[lids-1].astype(numpy.float64)
+    gmax = numpy.full((t.size,), -numpy.inf)
+    numpy.maximum.at(gmax, tids, lmax)
+    rmax = dict((rid, gmax[rid]) for rid in numpy.unique(tids).tolist())
+
+    # Min-heap of (drop, contact index).  Drops only grow as groups merge
+    # so stale entries are pushed back with their new drop when popped.
+    r1s, r2s = ci[:,0].tolist(), ci[:,1].tolist()
+    cds = cf[:,0].astype(numpy.float64).tolist()
+    heap = [(min(rmax[find(r1)],rmax[find(r2)])-cd, i)
+            for i, (r1, r2, cd) in enumerate(zip(r1s, r2s, cds))]
+    from heapq import heapify, heappop, heappush
+    heapify(heap)
+
+    cc = 0
+    requeued = 0
+    while heap:
+        d, i = heappop(heap)
+        p1, p2 = find(r1s[i]), find(r2s[i])
+        dl = min(rmax[p1],rmax[p2])-cds[i]
+        if dl != d:
+            # Drop changed due to region merging.
+            heappush(heap, (dl, i))
+            requeued += 1
+            continue
+        cc += 1
+        if task and cc % 100 == 0:
+            task.updateStatus('Contact %d of %d' % (cc, len(ci)))
+        if p1 != p2:
+            rj = join(p1, p2, d)
+            up[p1] = up[p2] = rj
+            rmax[rj] = max((rmax[p1], rmax[p2]))
+    if timing:
+        debug('Grouped %d contacts by drop in %.2f sec, %d drops requeued'
+              % (len(ci), clock()-t0, requeued))
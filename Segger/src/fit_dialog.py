@@ -1832,7 +1832,7 @@ class FitSegmentsDialog ( ToolInstance, Fit_Devel ):
             to_map = dmap
             reg_map = None
             if 1 :
-                reg_map = mask_volume( [reg], dmap )
+                reg_map = mask_volume( [reg], dmap, full_size = False )
 
             bCloseMap = False
 
@@ -2262,7 +2262,7 @@ class FitSegmentsDialog ( ToolInstance, Fit_Devel ):
         to_map = dmap
         reg_map = None
         if 1 :
-            reg_map = mask_volume( regs, dmap )
+            reg_map = mask_volume( regs, dmap, full_size = False )
 
 
         bCloseMap = False
@@ -40,30 +40,26 @@ def create_graph ( smod, links ) :
 
     # first run through contacts to list contacts and properties
     if links == "avgd" or links == "maxd" or links == "N" :
-        for r1 in list(cons.keys()) :
-            for r2 in list(cons[r1].keys()) :
-                if r2 > r1 :
+        for r1id, r2id, con in cons.pairs() :
 
-                    con = cons[r1][r2]
+            #print "link %d -> %d -- N:%.1f, " % (r1id, r2id, con.N),
 
-                    #print "link %d -> %d -- N:%.1f, " % (r1.rid, r2.rid, con.N),
+            if con.N < 0.1 :
+                #print "*hmm*"
+                continue
+            else :
+                Ns.append ( con.N )
 
-                    if con.N < 0.1 :
-                        #print "*hmm*"
-                        continue
-                    else :
-                        Ns.append ( con.N )
+            if con.D :
+                #print "D:%.3f, " % con.D,
+                avgd = float(con.D) / (2.0 * float(con.N))
+                avgds.append ( avgd )
+            #else : print "D:*",
 
-                    if con.D :
-                        #print "D:%.3f, " % con.D,
-                        avgd = float(con.D) / (2.0 * float(con.N))
-                        avgds.append ( avgd )
-                    #else : print "D:*",
-
-                    if con.maximum_density :
-                        #print "MaxD:%.3f, " % con.maximum_density
-                        maxds.append ( con.maximum_density )
-                    #else : print "MaxD:*"
+            if con.maximum_density :
+                #print "MaxD:%.3f, " % con.maximum_density
+                maxds.append ( con.maximum_density )
+            #else : print "MaxD:*"
 
 
         min_N, max_N = min(Ns), max(Ns)
@@ -78,36 +74,32 @@ def create_graph ( smod, links ) :
     min_rad = marker_radius * 0.1
     max_rad = marker_radius * 0.75 - min_rad
 
-    for r1 in list(cons.keys()) :
-        for r2 in list(cons[r1].keys()) :
-            if r2 > r1 :
-
-                con = cons[r1][r2]
-
-                if links == "maxd" and con.maximum_density :
-                    # radius proportional to max density at boundary
-                    if con.N > 0.1 :
-                        maxd = con.maximum_density
-                        link_radius_var = min_rad + max_rad * (maxd - min_maxd)/(max_maxd-min_maxd)
-                        Link ( aMap[r1], aMap[r2], link_color, link_radius_var )
-
-                elif links == "N" and con.N:
-                    # radius of link proportional to area of contact
-                    #  - where area of contact ~ #voxels between regions
-                    con = cons[r1][r2]
-                    link_radius_var = min_rad + max_rad * (con.N - min_N)/(max_N-min_N)
-                    Link ( aMap[r1], aMap[r2], link_color, link_radius_var )
-
-                elif links == "avgd" and con.D:
-                    # radius of link proportional to average density
-                    #  - at boundary
-                    if con.N > 0.1 :
-                        avgd = float(con.D) / (2.0 * float(con.N))
-                        link_radius_var = min_rad + max_rad * (avgd - min_avgd)/(max_avgd-min_avgd)
-                        Link ( aMap[r1], aMap[r2], link_color, link_radius_var )
-                else :
-                    # same link radius for all links
-                    Link ( aMap[r1], aMap[r2], link_color, link_radius )
+    for r1id, r2id, con in cons.pairs() :
+        r1, r2 = smod.region(r1id), smod.region(r2id)
+
+        if links == "maxd" and con.maximum_density :
+            # radius proportional to max density at boundary
+            if con.N > 0.1 :
+                maxd = con.maximum_density
+                link_radius_var = min_rad + max_rad * (maxd - min_maxd)/(max_maxd-min_maxd)
+                Link ( aMap[r1], aMap[r2], link_color, link_radius_var )
+
+        elif links == "N" and con.N:
+            # radius of link proportional to area of contact
+            #  - where area of contact ~ #voxels between regions
+            link_radius_var = min_rad + max_rad * (con.N - min_N)/(max_N-min_N)
+            Link ( aMap[r1], aMap[r2], link_color, link_radius_var )
+
+        elif links == "avgd" and con.D:
+            # radius of link proportional to average density
+            #  - at boundary
+            if con.N > 0.1 :
+                avgd = float(con.D) / (2.0 * float(con.N))
+                link_radius_var = min_rad + max_rad * (avgd - min_avgd)/(max_avgd-min_avgd)
+                Link ( aMap[r1], aMap[r2], link_color, link_radius_var )
+        else :
+            # same link radius for all links
+            Link ( aMap[r1], aMap[r2], link_color, link_radius )
 
 
     g.show_model ( True )
@@ -0,0 +1,139 @@
+# -----------------------------------------------------------------------------
+# Segmentation kernels with interchangeable implementations.  The default
+# backend is the ChimeraX C++ chimerax.segment module, the "numpy" backend
+# runs the same calculations with NumPy, compiled with Numba if installed,
+# so segmentation can run and be profiled outside ChimeraX.
+#
+# The backend is chosen with set_backend() or the SEGGER_KERNELS environment
+# variable.  set_backend() also sets the environment variable so worker
+# processes use the same backend.
+#
+import os
+
+kernel_names = ('watershed_regions', 'region_maxima', 'region_contacts',
+                'interface_values', 'region_bounds', 'region_points',
+                'find_local_maxima')
+
+_backends = {}          # Name to function returning kernel module.
+_loaded = {}            # Name to kernel module.
+_current = None
+
+# -----------------------------------------------------------------------------
+#
+def register_backend(name, load):
+    '''
+    Add a kernel backend.  Function load() returns a module or object with
+    the functions named in kernel_names, or raises ImportError if the
+    backend cannot be used.
+    '''
+    _backends[name] = load
+    _loaded.pop(name, None)
+
+# -----------------------------------------------------------------------------
+#
+def backend_names():
+    return tuple(_backends.keys())
+
+# -----------------------------------------------------------------------------
+#
+def available_backends():
+    '''Names of backends that load in this Python.'''
+    names = []
+    for name in _backends:
+        try:
+            _load(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+# -----------------------------------------------------------------------------
+#
+def set_backend(name):
+    global _current
+    if name not in _backends:
+        raise ValueError('Unknown segmentation kernel backend "%s", choose from %s'
+                         % (name, ', '.join(_backends)))
+    _load(name)
+    _current = name
+    os.environ['SEGGER_KERNELS'] = name
+
+# -----------------------------------------------------------------------------
+#
+def backend_name():
+    '''Name of the backend in use, the first one that loads by default.'''
+    global _current
+    if _current is None:
+        name = os.environ.get('SEGGER_KERNELS')
+        if name in _backends:
+            _current = name
+        else:
+            _current = available_backends()[0]
+    return _current
+
+# -----------------------------------------------------------------------------
+#
+def backend(name = None):
+    '''Kernel module for the named or current backend.'''
+    return _load(backend_name() if name is None else name)
+
+# -----------------------------------------------------------------------------
+#
+def _load(name):
+    k = _loaded.get(name)
+    if k is None:
+        k = _loaded[name] = _backends[name]()
+    return k
+
+# -----------------------------------------------------------------------------
+#
+def _load_chimerax():
+    from chimerax import segment
+    return segment
+
+def _load_numpy():
+    from . import numpy_kernels
+    return numpy_kernels
+
+register_backend('chimerax', _load_chimerax)
+register_backend('numpy', _load_numpy)
+
+# -----------------------------------------------------------------------------
+# Kernels of the current backend.  Masks (region_index) are 3-d uint32
+# arrays, grid points are (i,j,k) and arrays are indexed [k,j,i].
+#
+def watershed_regions(map, threshold, region_index):
+    '''
+    Fill region_index with the region of each grid point at or above
+    threshold, found by steepest ascent to a local maximum.
+    '''
+    return backend().watershed_regions(map, threshold, region_index)
+
+def region_maxima(region_index, map):
+    '''Maximum point (i,j,k) and value for region ids 1 to n.'''
+    return backend().region_maxima(region_index, map)
+
+def region_contacts(region_index):
+    '''Array of (r1, r2, count) for each pair of regions that touch.'''
+    return backend().region_contacts(region_index)
+
+def interface_values(region_index, map):
+    '''Region contacts and (maximum, sum) of map values on each interface.'''
+    return backend().interface_values(region_index, map)
+
+def region_bounds(region_index):
+    '''Array of (imin,jmin,kmin,imax,jmax,kmax,count) indexed by region id.'''
+    return backend().region_bounds(region_index)
+
+def region_points(region_index, region_id):
+    '''Grid points (i,j,k) of one region.'''
+    return backend().region_points(region_index, region_id)
+
+def find_local_maxima(map, points):
+    '''Move integer grid points (i,j,k) uphill to local maxima in place.'''
+    return backend().find_local_maxima(map, points)
+
+def kernel_mask(mask):
+    '''Mask as uint32 array as needed by the segmentation kernels.'''
+    import numpy
+    return mask if mask.dtype == numpy.uint32 else mask.astype(numpy.uint32)
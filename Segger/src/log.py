@@ -0,0 +1,8 @@
+# -----------------------------------------------------------------------------
+# Debugging messages.  Kept in a module without ChimeraX user interface
+# imports so worker processes of the parallel module can import it.
+#
+def debug(*args, **kw):
+    from . import debug
+    if debug:
+        print(*args, **kw)
@@ -0,0 +1,205 @@
+# -----------------------------------------------------------------------------
+# Surfaces of many labeled mask regions from one pass over the mask.  The
+# mask is binned on a grid aligned to the whole mask, each block taking its
+# most common value, so every region is surfaced on the same grid.  Cubes
+# of the label grid are split into tetrahedra and each label is contoured
+# halfway between its voxels and other voxels.  A vertex is identified by
+# its grid edge, so touching regions have the same vertices on their shared
+# boundary.  Uses only numpy.
+#
+import numpy
+from . import timing
+from time import time as clock
+from .log import debug
+
+# -----------------------------------------------------------------------------
+#
+def binned_mask(mask, bin_size):
+    '''
+    Mask reduced by bin_size along each axis, each block of bin_size^3
+    voxels taking its most common value, ties going to the smaller value.
+    Blocks start at index 0 of the mask.  Voxels past the end of the mask
+    count as 0.
+    '''
+    b = int(bin_size)
+    if b <= 1:
+        return mask
+    ks, js, i_s = mask.shape
+    nk, nj, ni = (ks + b - 1)//b, (js + b - 1)//b, (i_s + b - 1)//b
+    binned = numpy.zeros((nk, nj, ni), mask.dtype)
+    plane = numpy.zeros((b, nj*b, ni*b), mask.dtype)
+    for k in range(nk):
+        # One plane of blocks at a time limits memory use.
+        p = mask[k*b:(k+1)*b]
+        plane[:] = 0
+        plane[:len(p),:js,:i_s] = p
+        blocks = plane.reshape((b, nj, b, ni, b)).transpose((1,3,0,2,4)).reshape((nj*ni, b**3))
+        binned[k] = _most_common(blocks).reshape((nj, ni))
+    return binned
+
+def _most_common(rows):
+    '''Most common value in each row of a 2d array, the smallest of ties.'''
+    s = numpy.sort(rows, axis = 1)
+    n, m = s.shape
+    col = numpy.arange(m)
+    start = numpy.ones(s.shape, bool)
+    start[:,1:] = (s[:,1:] != s[:,:-1])
+    run_start = numpy.maximum.accumulate(numpy.where(start, col, 0), axis = 1)
+    longest = numpy.argmax(col - run_start, axis = 1)
+    return s[numpy.arange(n), longest]
+
+# -----------------------------------------------------------------------------
+#
+def label_surfaces(labels, nlabels, max_cells = 2**21):
+    '''
+    Closed triangulated surfaces of each label 1 to nlabels in a 3d label
+    array, with 0 for no label.  Returns a list of (vertices, triangles)
+    with vertices (i,j,k) in grid index units.  Vertices are halfway
+    between label grid points and other grid points, and triangles face
+    away from the label.  Cubes are contoured max_cells at a time.
+    '''
+    if timing: t0 = clock()
+    ks, js, i_s = labels.shape
+    # Zero border so surfaces are closed.
+    g = numpy.zeros((ks+2, js+2, i_s+2), numpy.int32)
+    g[1:-1,1:-1,1:-1] = labels
+    size = numpy.array(g.shape, numpy.int64)
+    stride = numpy.array((size[1]*size[2], size[2], 1), numpy.int64)
+    corner_offsets = numpy.dot(_cube_corners, stride)
+    gflat = g.ravel()
+
+    tlabels, tedges = [], []
+    planes = max(1, max_cells // (size[1]*size[2]))
+    for k0 in range(0, ks+1, planes):
+        k1 = min(k0 + planes, ks+1)
+        cells = g[k0:k1+1]
+        # Cubes with more than one value at their corners.
+        c0 = cells[:-1,:-1,:-1]
+        mixed = numpy.zeros(c0.shape, bool)
+        for dk, dj, di in _cube_corners[1:]:
+            mixed |= (cells[dk:dk+k1-k0, dj:dj+js+1, di:di+i_s+1] != c0)
+        k, j, i = numpy.nonzero(mixed)
+        base = ((k + k0)*stride[0] + j*stride[1] + i).astype(numpy.int64)
+        tl, te = _tetrahedra_triangles(gflat, base, corner_offsets, stride)
+        tlabels.append(tl)
+        tedges.append(te)
+    tlabels = numpy.concatenate(tlabels)
+    tedges = numpy.concatenate(tedges)
+
+    surfs = _label_meshes(tlabels, tedges, nlabels, size, stride)
+    if timing:
+        debug('Time %.2f: %d label surfaces, %d triangles' % (clock()-t0, nlabels, len(tlabels)))
+    return surfs
+
+# Cube corners (k,j,i) and the 6 tetrahedra sharing the cube diagonal from
+# corner 0 to corner 7, one for each path along the 3 axes.  All cubes are
+# split the same way so tetrahedra faces of neighbor cubes match.
+_cube_corners = numpy.array([(k,j,i) for k in (0,1) for j in (0,1) for i in (0,1)], numpy.int64)
+_tetrahedra = numpy.array([(0, a, a|b, 7) for a, b in ((4,2), (4,1), (2,4), (2,1), (1,4), (1,2))],
+                          numpy.int64)
+
+def _tetrahedron_cases():
+    '''
+    For each of the 16 inside/outside patterns of tetrahedron corners, up
+    to 2 triangles, each 3 edges given as (inside corner, outside corner).
+    '''
+    tri = numpy.zeros((16, 2, 3, 2), numpy.int64)
+    ntri = numpy.zeros((16,), numpy.int64)
+    for case in range(1, 15):
+        inside = [c for c in range(4) if case & (1 << c)]
+        outside = [c for c in range(4) if not case & (1 << c)]
+        if len(inside) == 1:
+            tri[case,0] = [(inside[0], o) for o in outside]
+            ntri[case] = 1
+        elif len(inside) == 3:
+            tri[case,0] = [(c, outside[0]) for c in inside]
+            ntri[case] = 1
+        else:
+            (a, b), (c, d) = inside, outside
+            tri[case,0] = [(a,c), (a,d), (b,d)]
+            tri[case,1] = [(a,c), (b,d), (b,c)]
+            ntri[case] = 2
+    return tri, ntri
+
+_case_triangles, _case_triangle_count = _tetrahedron_cases()
+
+def _tetrahedra_triangles(gflat, base, corner_offsets, stride):
+    '''
+    Triangles of every label in the tetrahedra of cubes with lowest grid
+    point indices base.  Returns the triangle labels and the grid edges of
+    the triangle vertices, each edge as 8 times its lower grid point index
+    plus the axes it steps along as bits.
+    '''
+    tc = corner_offsets[_tetrahedra]                       # (6,4)
+    corners = (base[:,None,None] + tc[None,:,:]).reshape((-1,4))
+    cl = gflat[corners]
+    mixed = (cl != cl[:,:1]).any(axis = 1)
+    corners, cl = corners[mixed], cl[mixed]
+
+    # Each nonzero label at a corner, counted once per tetrahedron.
+    tlabels, tedges = [], []
+    for c in range(4):
+        lab = cl[:,c]
+        use = (lab != 0)
+        for e in range(c):
+            use &= (cl[:,e] != lab)
+        lab, lcorners = lab[use], corners[use]
+        inside = (cl[use] == lab[:,None])
+        case = numpy.dot(inside, 1 << numpy.arange(4))
+        for t in (0, 1):
+            has = (_case_triangle_count[case] > t)
+            ends = _case_triangles[case[has], t]           # (n,3,2) corner numbers
+            p = numpy.take_along_axis(lcorners[has], ends[:,:,0], axis = 1)
+            q = numpy.take_along_axis(lcorners[has], ends[:,:,1], axis = 1)
+            tedges.append(_oriented(_edge_ids(p, q, stride), p, q, stride))
+            tlabels.append(lab[has])
+    return numpy.concatenate(tlabels), numpy.concatenate(tedges)
+
+def _edge_ids(p, q, stride):
+    '''Grid edge ids for edges between grid point indices p and q.'''
+    lo = numpy.minimum(p, q)
+    d = numpy.abs(q - p)
+    axes = numpy.zeros(d.shape, numpy.int64)
+    for a in range(3):
+        axes |= ((d // stride[a]) % 2) << (2-a)
+        d = d % stride[a]
+    return 8*lo + axes
+
+def _grid_points(index, stride):
+    '''Grid indices (k,j,i) from grid point indices.'''
+    k, r = numpy.divmod(index, stride[0])
+    j, i = numpy.divmod(r, stride[1])
+    return numpy.stack((k, j, i), axis = -1)
+
+def _oriented(edges, p, q, stride):
+    '''Reverse triangles whose normal points toward the label side.'''
+    # Normals in (i,j,k) order, the order of the vertex coordinates.
+    mid = (_grid_points(p, stride) + _grid_points(q, stride))[:,:,::-1]
+    n = numpy.cross(mid[:,1] - mid[:,0], mid[:,2] - mid[:,0])
+    out = (_grid_points(q[:,0], stride) - _grid_points(p[:,0], stride))[:,::-1]
+    flip = ((n * out).sum(axis = 1) < 0)
+    edges[flip] = edges[flip][:,::-1]
+    return edges
+
+def _label_meshes(tlabels, tedges, nlabels, size, stride):
+    '''Vertices at edge midpoints and triangles for each label.'''
+    # Vertex keys sorted by label then edge, so each label's vertices are contiguous.
+    nedge = 8 * int(size.prod())
+    keys = tlabels.astype(numpy.int64)[:,None] * nedge + tedges
+    ukeys, tvi = numpy.unique(keys, return_inverse = True)
+    tvi = tvi.reshape(keys.shape)
+    vlabels, vedges = numpy.divmod(ukeys, nedge)
+    lo, axes = numpy.divmod(vedges, 8)
+    bits = (axes[:,None] >> numpy.array((2,1,0))) & 1
+    kji = _grid_points(lo, stride) + 0.5*bits - 1          # Remove zero border.
+    xyz = kji[:,::-1].astype(numpy.float32)
+
+    vstart = numpy.searchsorted(vlabels, numpy.arange(1, nlabels+2))
+    order = numpy.argsort(tlabels, kind = 'stable')
+    tstart = numpy.searchsorted(tlabels[order], numpy.arange(1, nlabels+2))
+    surfs = []
+    for l in range(nlabels):
+        v0, v1 = vstart[l], vstart[l+1]
+        t = tvi[order[tstart[l]:tstart[l+1]]] - v0
+        surfs.append((xyz[v0:v1].copy(), t.astype(numpy.int32)))
+    return surfs
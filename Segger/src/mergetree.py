@@ -0,0 +1,147 @@
+# -----------------------------------------------------------------------------
+# Precomputed agglomeration tree (dendrogram) for a segmentation so grouping
+# to a chosen number of regions or density level is a cut of the tree rather
+# than a new grouping calculation.
+#
+import numpy
+from . import timing
+from time import time as clock
+from .log import debug
+
+# -----------------------------------------------------------------------------
+#
+class MergeTree:
+
+    '''
+    Merge tree over a set of base regions.  Nodes 0 to n-1 are the base
+    regions in base_ids order, merge k joins nodes node1[k] and node2[k]
+    into node n+k at height[k].  Heights do not decrease with k, so any
+    cut is a prefix of the merges.  Regions that never contact others are
+    not merged so there may be fewer than n-1 merges.
+    '''
+
+    def __init__(self, base_ids, node1, node2, height, method):
+
+        self.base_ids = numpy.asarray(base_ids, numpy.int32)
+        self.node1 = numpy.asarray(node1, numpy.int32)
+        self.node2 = numpy.asarray(node2, numpy.int32)
+        self.height = numpy.asarray(height, numpy.float64)
+        self.method = method            # 'contact size' or 'contact drop'
+
+    @property
+    def base_count(self):
+        return len(self.base_ids)
+
+    @property
+    def merge_count(self):
+        return len(self.node1)
+
+    @property
+    def minimum_region_count(self):
+        return self.base_count - self.merge_count
+
+    def merges_for_region_count(self, nregions):
+        '''Number of merges that leaves nregions groups.'''
+        return min(max(self.base_count - nregions, 0), self.merge_count)
+
+    def merges_for_height(self, height):
+        '''Number of merges at or below a height.'''
+        return int(numpy.searchsorted(self.height, height, side = 'right'))
+
+    def labels(self, nmerges):
+        '''Group node index for each base region using the first nmerges merges.'''
+        n = self.base_count
+        up = numpy.arange(n + nmerges, dtype = numpy.int32)
+        new = numpy.arange(n, n + nmerges, dtype = numpy.int32)
+        up[self.node1[:nmerges]] = new
+        up[self.node2[:nmerges]] = new
+        # Pointer jumping to the top node.
+        while True:
+            top = up[up]
+            if (top == up).all():
+                break
+            up = top
+        return up[:n]
+
+    def groups(self, nmerges):
+        '''Arrays of base region ids for each group with more than one region.'''
+        labels = self.labels(nmerges)
+        order = numpy.argsort(labels, kind = 'stable')
+        lsort = labels[order]
+        breaks = numpy.nonzero(lsort[1:] != lsort[:-1])[0] + 1
+        groups = numpy.split(self.base_ids[order], breaks)
+        return [g for g in groups if len(g) > 1]
+
+    def take_state(self):
+
+        return {'base_ids': self.base_ids, 'node1': self.node1,
+                'node2': self.node2, 'height': self.height,
+                'method': self.method}
+
+    @staticmethod
+    def from_state(state):
+
+        return MergeTree(state['base_ids'], state['node1'], state['node2'],
+                         state['height'], state['method'])
+
+# -----------------------------------------------------------------------------
+#
+class _MergeRecorder:
+
+    '''Join callback that records merges instead of creating regions.'''
+
+    def __init__(self, base_ids, next_id):
+
+        self.node = dict((rid, i) for i, rid in enumerate(base_ids.tolist()))
+        self.next_id = next_id          # Ids not used by any region.
+        self.node1, self.node2, self.height = [], [], []
+
+    def join(self, id1, id2, height):
+
+        self.node1.append(self.node[id1])
+        self.node2.append(self.node[id2])
+        self.height.append(height)
+        rid = self.next_id
+        self.next_id += 1
+        self.node[rid] = len(self.node)
+        return rid
+
+# -----------------------------------------------------------------------------
+#
+def contact_size_merge_tree(smod, task = None):
+    '''
+    Merge tree joining pairs of top level regions largest contact first,
+    the same levels of pairwise joins as grouping by connectivity.  The
+    height of a merge is its level.
+    '''
+    from .contacts import group_contacts, merge_by_contact_size
+
+    if timing: t0 = clock()
+    base_ids = smod.table.top_ids()
+    rec = _MergeRecorder(base_ids, smod.max_region_id + 1)
+    gc = group_contacts(smod.region_contacts(), task = task)
+    levels = merge_by_contact_size(gc, lambda id1, id2: rec.join(id1, id2, 0),
+                                   len(base_ids), 0, task)
+    height = [l+1 for l, joins in enumerate(levels) for j in joins]
+    tree = MergeTree(base_ids, rec.node1, rec.node2, height, 'contact size')
+    if timing: debug('Merge tree of %d merges in %.2f sec' % (tree.merge_count, clock()-t0))
+    return tree
+
+# -----------------------------------------------------------------------------
+#
+def contact_drop_merge_tree(smod, task = None):
+    '''
+    Merge tree joining top level regions in order of increasing density
+    drop to their interface, as grouping by contacts does.  The height of
+    a merge is the drop.
+    '''
+    from .contacts import contact_drop_merges
+
+    if timing: t0 = clock()
+    base_ids = smod.table.top_ids()
+    rec = _MergeRecorder(base_ids, smod.max_region_id + 1)
+    map = smod.volume_data().full_matrix()
+    contact_drop_merges(smod, map, rec.join, task)
+    tree = MergeTree(base_ids, rec.node1, rec.node2, rec.height, 'contact drop')
+    if timing: debug('Merge tree of %d merges in %.2f sec' % (tree.merge_count, clock()-t0))
+    return tree
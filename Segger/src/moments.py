@@ -0,0 +1,199 @@
+# -----------------------------------------------------------------------------
+# Geometric moments of all segmentation regions from one pass over the mask.
+# Point counts, coordinate sums and sums of coordinate products of each leaf
+# region are accumulated with bincount.  Group moments are sums over their
+# leaf regions, and centers, inertia tensors, principal axes and extents in
+# physical coordinates are derived from the moments for many regions at once
+# instead of from the region grid points.  Largest distances of region points
+# from centers and along axes are found in one pass over the voxel index.
+#
+import numpy
+from . import timing
+from time import time as clock
+from .log import debug
+
+# -----------------------------------------------------------------------------
+#
+class RegionMoments:
+
+    '''
+    Arrays indexed by region id of the grid point count m0, sums of grid
+    indices (i,j,k) m1 and sums of their products m2 (3 by 3).
+    '''
+
+    def __init__(self, size):
+
+        self.m0 = numpy.zeros((size,), numpy.float64)
+        self.m1 = numpy.zeros((size,3), numpy.float64)
+        self.m2 = numpy.zeros((size,3,3), numpy.float64)
+
+    def copy(self, size = None):
+        n = len(self.m0)
+        if size is None:
+            size = n
+        m = RegionMoments(size)
+        c = min(n, size)
+        m.m0[:c], m.m1[:c], m.m2[:c] = self.m0[:c], self.m1[:c], self.m2[:c]
+        return m
+
+    def add_points(self, labels, ijk):
+        '''Accumulate moments of grid points (n,3) with region ids labels.'''
+        n = len(self.m0)
+        self.m0 += numpy.bincount(labels, minlength = n)
+        p = ijk.astype(numpy.float64)
+        for a in range(3):
+            self.m1[:,a] += numpy.bincount(labels, weights = p[:,a], minlength = n)
+            for b in range(a, 3):
+                s = numpy.bincount(labels, weights = p[:,a]*p[:,b], minlength = n)
+                self.m2[:,a,b] += s
+                if b != a:
+                    self.m2[:,b,a] += s
+
+    def combine_groups(self, hierarchy, group_ids):
+        '''Set group region moments to the sums over their leaf regions.'''
+        h = hierarchy
+        start, end = h.leaf_first[group_ids], h.leaf_end[group_ids]
+        leaves = h.leaves
+        for a in (self.m0, self.m1, self.m2):
+            v = a[leaves]
+            cs = numpy.concatenate((numpy.zeros((1,) + v.shape[1:]), numpy.cumsum(v, axis = 0)))
+            a[group_ids] = cs[end] - cs[start]
+
+    def centers(self, ids, transform = None):
+        '''Center of grid points of regions, in physical coordinates if transform given.'''
+        c = self.m1[ids] / numpy.maximum(self.m0[ids], 1)[:,None]
+        if transform is not None:
+            A, t = _linear_part(transform)
+            c = c @ A.T + t
+        return c
+
+    def scatter(self, ids, transform = None):
+        '''Sum of outer products of grid point offsets from the center, (n,3,3).'''
+        n = numpy.maximum(self.m0[ids], 1)
+        m1 = self.m1[ids]
+        s = self.m2[ids] - m1[:,:,None] * m1[:,None,:] / n[:,None,None]
+        if transform is not None:
+            A, t = _linear_part(transform)
+            s = A @ s @ A.T
+        return s
+
+    def inertia_tensors(self, ids, transform = None):
+        '''Inertia tensors of regions with unit mass per grid point.'''
+        s = self.scatter(ids, transform)
+        tr = numpy.trace(s, axis1 = 1, axis2 = 2)
+        return tr[:,None,None] * numpy.eye(3) - s
+
+    def principal_axes(self, ids, transform = None):
+        '''
+        Centers, and U, S, V of the inertia tensor singular value
+        decomposition for regions, as computed by axes.prAxes() from
+        points.  Columns of U are the axes, longest axis last.
+        '''
+        U, S, V = inertia_axes(self.inertia_tensors(ids, transform))
+        return self.centers(ids, transform), U, S, V
+
+    def extents(self, ids, transform = None):
+        '''
+        Half lengths along the principal axes (columns of U) of the solid
+        ellipsoid with the same second moments as each region.
+        '''
+        com, U, S, V = self.principal_axes(ids, transform)
+        n = numpy.maximum(self.m0[ids], 1)
+        var = numpy.einsum('nji,njk,nki->ni', U, self.scatter(ids, transform), U) / n[:,None]
+        return numpy.sqrt(5 * numpy.maximum(var, 0))
+
+    def long_axes(self, ids, transform = None):
+        '''Unit vector along the direction of greatest spread of each region.'''
+        s = self.scatter(ids, transform)
+        w, v = numpy.linalg.eigh(s)
+        return v[:,:,-1]
+
+# -----------------------------------------------------------------------------
+#
+def inertia_axes(inertia):
+    '''
+    Singular value decomposition U, S, V of (n,3,3) inertia tensors with
+    signs chosen so each V is a right handed rotation with positive diagonal
+    where possible, as for axes.prAxes().
+    '''
+    U, S, V = numpy.linalg.svd(inertia)
+    for r in (0,1,2):
+        flip = (V[:,r,r] < 0)
+        V[flip,r,:] *= -1
+        U[flip,:,r] *= -1
+    flip = (numpy.linalg.det(V) < 0)
+    V[flip,2,:] *= -1
+    U[flip,:,2] *= -1
+    return U, S, V
+
+# -----------------------------------------------------------------------------
+#
+def point_extents(voxel_index, leaf_ids, centers, axes = None, transform = None,
+                  chunk_size = 2**20):
+    '''
+    Largest distance of the grid points of regions from their centers, and
+    if axes are given (n,3,3) with the axes as columns, the largest distance
+    along each axis.  Each region is an array of leaf region ids and the
+    voxels of all regions are read from the voxel index in one vectorized
+    pass, chunk_size voxels at a time.  Points are in physical coordinates
+    if a transform is given.  Returns radii (n,) and extents (n,3) or None.
+    '''
+    n = len(leaf_ids)
+    radii2 = numpy.zeros((n,), numpy.float64)
+    extents = None if axes is None else numpy.zeros((n,3), numpy.float64)
+    if n == 0:
+        return radii2, extents
+    vi = voxel_index
+    lids = numpy.concatenate([numpy.asarray(l, numpy.int64).ravel() for l in leaf_ids])
+    region = numpy.repeat(numpy.arange(n), [numpy.size(l) for l in leaf_ids])
+    keep = (lids >= 0) & (lids < len(vi.start))
+    lids, region = lids[keep], region[keep]
+    start, counts = vi.start[lids], vi.end[lids] - vi.start[lids]
+    nv = int(counts.sum())
+    # Position in voxel_index.voxels of each voxel of the leaf list.
+    vstart = numpy.repeat(start - (numpy.cumsum(counts) - counts), counts)
+    vregion = numpy.repeat(region, counts)
+    centers = numpy.asarray(centers, numpy.float64)
+    if transform is not None:
+        A, t = _linear_part(transform)
+    for v0 in range(0, nv, chunk_size):
+        v1 = min(v0 + chunk_size, nv)
+        p = vi.grid_points(vi.voxels[vstart[v0:v1] + numpy.arange(v0, v1)]).astype(numpy.float64)
+        if transform is not None:
+            p = p @ A.T + t
+        r = vregion[v0:v1]
+        d = p - centers[r]
+        # Voxels are grouped by region, reduce each group then combine chunks.
+        gstart = numpy.flatnonzero(numpy.diff(r, prepend = -1))
+        rg = r[gstart]
+        numpy.maximum.at(radii2, rg, numpy.maximum.reduceat((d*d).sum(axis = 1), gstart))
+        if axes is not None:
+            proj = numpy.abs(numpy.einsum('na,nab->nb', d, axes[r]))
+            numpy.maximum.at(extents, rg, numpy.maximum.reduceat(proj, gstart, axis = 0))
+    return numpy.sqrt(radii2), extents
+
+# -----------------------------------------------------------------------------
+#
+def _linear_part(transform):
+    m = numpy.array(transform.matrix, numpy.float64)
+    return m[:,:3], m[:,3]
+
+# -----------------------------------------------------------------------------
+#
+def leaf_moments(mask, size, slab_bytes = 2**26, task = None):
+    '''Moments of the mask grid points of each region id, read in z slabs.'''
+    if timing: t0 = clock()
+    m = RegionMoments(size)
+    ks, js, i_s = mask.shape
+    step = max(1, slab_bytes // max(1, 40 * js * i_s))
+    for z0 in range(0, ks, step):
+        if task:
+            task.updateStatus('Region moments, planes %d of %d' % (z0, ks))
+        slab = mask[z0:z0+step]
+        f = numpy.flatnonzero(slab)
+        k, j, i = numpy.unravel_index(f, slab.shape)
+        ijk = numpy.stack((i, j, k + z0), axis = 1)
+        m.add_points(slab.ravel()[f].astype(numpy.intp), ijk)
+    if timing:
+        debug('Time %.2f: moments of %d leaf regions' % (clock()-t0, numpy.count_nonzero(m.m0)))
+    return m
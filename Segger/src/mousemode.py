@@ -77,9 +77,9 @@ class Group_Connected_Mouse_Mode:
 
         t = r.top_parent()
         from .regions import random_color
-        self.color = random_color(self.ungrouped_color) if t is r else t.color
+        self.color = random_color(self.ungrouped_color) if t == r else t.color
         self.level = self.density_level(r)
-        lev = self.level if t is r else None
+        lev = self.level if t == r else None
         self.region = r
         self.last_y = event.y
         self.dragging = False
@@ -334,18 +334,21 @@ def show_connected_regions(region, level, color, rset, ungrouped_color):
         cset = set(rsibling)
     else:
         cset = set([region])
-        bndry = set([region])
+        bndry = set([region.rid])
+        parent = s.table.parent
         dmax = None
         while bndry:
-            r = bndry.pop()
-            if r in rcons:
-                for cr, c in list(rcons[r].items()):
-                    if cr.preg is None and not cr in cset:
-                        if c.maximum_density >= level:
+            rid = bndry.pop()
+            cids, ci = rcons.neighbor_contacts(rid)
+            for crid, d in zip(cids.tolist(), rcons.maximum_density[ci].tolist()):
+                if parent[crid] == 0:
+                    cr = s.region(crid)
+                    if not cr in cset:
+                        if d >= level:
                             cset.add(cr)
-                            bndry.add(cr)
-                        if dmax is None or c.maximum_density > dmax:
-                            dmax = c.maximum_density
+                            bndry.add(crid)
+                        if dmax is None or d > dmax:
+                            dmax = d
 
     # Show only connected regions and boundary.
     from .regions import boundary_regions
@@ -376,17 +379,24 @@ def contact_density(regions, rcons, scale = 1.000001):
 
     demax = None           # external contacts
     dimin = None           # internal contacts
-    rset = set(regions)
-    for r in rset:
-        if r in rcons:
-            for rc, c in list(rcons[r].items()):
-                if not c.maximum_density is None:
-                    if rc in rset:
-                        if dimin is None or c.maximum_density < dimin:
-                            dimin = c.maximum_density
-                    elif not rc.in_group():
-                        if demax is None or c.maximum_density > demax:
-                            demax = c.maximum_density
+    if rcons.maximum_density is None:
+        return None
+    import numpy
+    ids = numpy.array([r.rid for r in regions], numpy.int32)
+    parent = rcons.segmentation.table.parent
+    for rid in ids:
+        cids, ci = rcons.neighbor_contacts(rid)
+        d = rcons.maximum_density[ci]
+        inside = numpy.isin(cids, ids)
+        if inside.any():
+            dmin = d[inside].min()
+            if dimin is None or dmin < dimin:
+                dimin = dmin
+        outside = ~inside & (parent[cids] == 0)
+        if outside.any():
+            dout = d[outside].max()
+            if demax is None or dout > demax:
+                demax = dout
     if not demax is None:
         d = demax * scale
     elif not dimin is None:
@@ -0,0 +1,378 @@
+# -----------------------------------------------------------------------------
+# NumPy implementation of the chimerax.segment kernels used by Segger.  Each
+# kernel has a per grid point loop that is compiled with Numba if it is
+# installed, otherwise the kernels use whole array NumPy operations that
+# use more memory.  Grid points ascend to the highest of their 26 neighbors
+# if it is higher, ties going to the first neighbor in k,j,i offset order,
+# and watershed regions are numbered in k,j,i order of their maxima.
+#
+import numpy
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# -----------------------------------------------------------------------------
+#
+def watershed_regions(map, threshold, region_index):
+
+    up = _steepest_neighbor(map)
+    top = _roots(up)
+    above = (map.ravel() >= threshold)
+    maxima = numpy.flatnonzero(above & (up == numpy.arange(up.size)))
+    label = numpy.zeros((up.size,), numpy.uint32)
+    label[maxima] = numpy.arange(1, len(maxima)+1, dtype = numpy.uint32)
+    region_index[:] = numpy.where(above, label[top], 0).reshape(map.shape)
+    return len(maxima)
+
+# -----------------------------------------------------------------------------
+#
+def region_maxima(region_index, map):
+
+    flat = region_index.ravel()
+    n = int(flat.max()) if flat.size else 0
+    points = numpy.zeros((n,3), numpy.int32)
+    values = numpy.zeros((n,), numpy.float32)
+    if numba is not None:
+        _region_maxima_jit(region_index, map, points, values)
+        return points, values
+    nz = numpy.flatnonzero(flat)
+    ids = flat[nz]
+    v = map.ravel()[nz]
+    # Highest value of each region, first in mask order if tied.
+    order = numpy.lexsort((-v, ids))
+    ids = ids[order]
+    first = numpy.concatenate(((True,), ids[1:] != ids[:-1])) if len(ids) else ids.astype(bool)
+    sel = nz[order][first]
+    rid = ids[first].astype(numpy.int64)
+    k, j, i = numpy.unravel_index(sel, region_index.shape)
+    points[rid-1] = numpy.stack((i, j, k), axis = 1)
+    values[rid-1] = map.ravel()[sel]
+    return points, values
+
+# -----------------------------------------------------------------------------
+#
+def region_bounds(region_index):
+
+    flat = region_index.ravel()
+    n = int(flat.max()) + 1 if flat.size else 1
+    bounds = numpy.zeros((n,7), numpy.int32)
+    if numba is not None:
+        _region_bounds_jit(region_index, bounds)
+        return bounds
+    nz = numpy.flatnonzero(flat)
+    if len(nz) == 0:
+        return bounds
+    ids = flat[nz]
+    order = numpy.argsort(ids, kind = 'stable')
+    ids = ids[order]
+    start = numpy.flatnonzero(numpy.concatenate(((True,), ids[1:] != ids[:-1])))
+    rid = ids[start]
+    k, j, i = numpy.unravel_index(nz[order], region_index.shape)
+    for a, c in enumerate((i, j, k)):
+        bounds[rid,a] = numpy.minimum.reduceat(c, start)
+        bounds[rid,a+3] = numpy.maximum.reduceat(c, start)
+    bounds[:,6] = numpy.bincount(ids, minlength = n)[:n]
+    return bounds
+
+# -----------------------------------------------------------------------------
+#
+def region_points(region_index, region_id):
+
+    k, j, i = numpy.nonzero(region_index == region_id)
+    return numpy.stack((i, j, k), axis = 1).astype(numpy.int32)
+
+# -----------------------------------------------------------------------------
+#
+def region_contacts(region_index):
+
+    r1, r2, f1, f2 = _contact_faces(region_index)
+    pairs, inv, count = _unique_pairs(r1, r2)
+    return numpy.concatenate((pairs, count[:,None]), axis = 1).astype(numpy.int32)
+
+# -----------------------------------------------------------------------------
+#
+def interface_values(region_index, map):
+
+    '''
+    The map value on an interface face is the lower value of the two grid
+    points it joins, so the interface maximum is the highest pass between
+    the two regions.
+    '''
+    r1, r2, f1, f2 = _contact_faces(region_index)
+    m = map.ravel()
+    v = numpy.minimum(m[f1], m[f2])
+    pairs, inv, count = _unique_pairs(r1, r2)
+    npair = len(pairs)
+    vmax = numpy.full((npair,), -numpy.inf, numpy.float64)
+    numpy.maximum.at(vmax, inv, v)
+    vsum = numpy.bincount(inv, weights = v, minlength = npair)
+    ci = numpy.concatenate((pairs, count[:,None]), axis = 1).astype(numpy.int32)
+    cf = numpy.stack((vmax, vsum), axis = 1).astype(numpy.float32)
+    return ci, cf
+
+# -----------------------------------------------------------------------------
+#
+def find_local_maxima(map, points):
+
+    '''Steepest ascent from each point, moving all points a step at a time.'''
+    if numba is not None:
+        _find_local_maxima_jit(map, points)
+        return points
+    ks, js, i_s = map.shape
+    offsets = _neighbor_offsets()
+    active = numpy.arange(len(points))
+    while len(active) > 0:
+        i, j, k = points[active].T
+        best = map[k, j, i]
+        step = numpy.zeros((len(active),), numpy.int32)     # Index into offsets + 1
+        for o, (dk, dj, di) in enumerate(offsets):
+            kk, jj, ii = k + dk, j + dj, i + di
+            inside = ((kk >= 0) & (kk < ks) & (jj >= 0) & (jj < js) &
+                      (ii >= 0) & (ii < i_s))
+            v = numpy.full(best.shape, -numpy.inf)
+            v[inside] = map[kk[inside], jj[inside], ii[inside]]
+            higher = (v > best)
+            best = numpy.where(higher, v, best)
+            step[higher] = o + 1
+        moved = (step > 0)
+        delta = numpy.array(offsets)[step[moved] - 1][:,::-1]
+        points[active[moved]] += delta.astype(points.dtype)
+        active = active[moved]
+    return points
+
+# -----------------------------------------------------------------------------
+#
+def _neighbor_offsets():
+    return [(dk, dj, di) for dk in (-1,0,1) for dj in (-1,0,1) for di in (-1,0,1)
+            if (dk, dj, di) != (0,0,0)]
+
+# -----------------------------------------------------------------------------
+#
+def _steepest_neighbor(map):
+    '''Flat index of the highest neighbor of each grid point, or itself.'''
+    if numba is not None:
+        up = numpy.empty((map.size,), numpy.int64)
+        _steepest_neighbor_jit(map, up)
+        return up
+
+    shape = map.shape
+    ks, js, i_s = shape
+    fdtype = map.dtype if map.dtype.kind == 'f' else numpy.float64
+    p = numpy.pad(map.astype(fdtype, copy = False), 1, mode = 'constant',
+                  constant_values = -numpy.inf)
+    best = map.astype(fdtype)
+    step = numpy.zeros(shape, numpy.int64)
+    for dk, dj, di in _neighbor_offsets():
+        v = p[1+dk:1+dk+ks, 1+dj:1+dj+js, 1+di:1+di+i_s]
+        higher = (v > best)
+        numpy.copyto(best, v, where = higher)
+        numpy.copyto(step, (dk*js + dj)*i_s + di, where = higher)
+    return numpy.arange(map.size, dtype = numpy.int64) + step.ravel()
+
+# -----------------------------------------------------------------------------
+#
+def _roots(up):
+    '''Follow steepest neighbor links to the local maximum of each point.'''
+    if numba is not None:
+        top = up.copy()
+        _roots_jit(top)
+        return top
+    top = up
+    while True:
+        t = top[top]
+        if (t == top).all():
+            return top
+        top = t
+
+# -----------------------------------------------------------------------------
+# Numba compiled loops.
+#
+def _steepest_neighbor_loop(map, up):
+    ks, js, i_s = map.shape
+    for k in range(ks):
+        for j in range(js):
+            for i in range(i_s):
+                best = map[k,j,i]
+                b = (k*js + j)*i_s + i
+                s = b
+                for dk in range(-1, 2):
+                    kk = k + dk
+                    if kk < 0 or kk >= ks:
+                        continue
+                    for dj in range(-1, 2):
+                        jj = j + dj
+                        if jj < 0 or jj >= js:
+                            continue
+                        for di in range(-1, 2):
+                            ii = i + di
+                            if ii < 0 or ii >= i_s or (dk == 0 and dj == 0 and di == 0):
+                                continue
+                            v = map[kk,jj,ii]
+                            if v > best:
+                                best = v
+                                b = (kk*js + jj)*i_s + ii
+                up[s] = b
+
+def _roots_loop(up):
+    for p in range(len(up)):
+        r = p
+        while up[r] != r:
+            r = up[r]
+        # Path compression so later points stop early.
+        q = p
+        while up[q] != r:
+            n = up[q]
+            up[q] = r
+            q = n
+
+def _region_maxima_loop(region_index, map, points, values):
+    ks, js, i_s = region_index.shape
+    best = numpy.empty(values.shape, numpy.float64)
+    found = numpy.zeros(values.shape, numpy.bool_)
+    for k in range(ks):
+        for j in range(js):
+            for i in range(i_s):
+                r = region_index[k,j,i]
+                if r == 0:
+                    continue
+                v = map[k,j,i]
+                # First in mask order if tied.
+                if not found[r-1] or v > best[r-1]:
+                    found[r-1] = True
+                    best[r-1] = v
+                    values[r-1] = v
+                    points[r-1,0] = i
+                    points[r-1,1] = j
+                    points[r-1,2] = k
+
+def _region_bounds_loop(region_index, bounds):
+    ks, js, i_s = region_index.shape
+    for k in range(ks):
+        for j in range(js):
+            for i in range(i_s):
+                r = region_index[k,j,i]
+                if r == 0:
+                    continue
+                b = bounds[r]
+                if b[6] == 0:
+                    b[0] = b[3] = i
+                    b[1] = b[4] = j
+                    b[2] = b[5] = k
+                else:
+                    b[0] = min(b[0], i)
+                    b[1] = min(b[1], j)
+                    b[2] = min(b[2], k)
+                    b[3] = max(b[3], i)
+                    b[4] = max(b[4], j)
+                    b[5] = max(b[5], k)
+                b[6] += 1
+
+def _contact_faces_loop(region_index, r1, r2, f1, f2):
+    '''
+    Faces in the same order as the NumPy version, k axis faces first.  With
+    no face arrays only counts the faces.
+    '''
+    ks, js, i_s = region_index.shape
+    n = 0
+    for axis in range(3):
+        dk = 1 if axis == 0 else 0
+        dj = 1 if axis == 1 else 0
+        di = 1 if axis == 2 else 0
+        for k in range(ks - dk):
+            for j in range(js - dj):
+                for i in range(i_s - di):
+                    a = region_index[k,j,i]
+                    b = region_index[k+dk,j+dj,i+di]
+                    if a == b or a == 0 or b == 0:
+                        continue
+                    if r1 is not None:
+                        r1[n] = min(a, b)
+                        r2[n] = max(a, b)
+                        f1[n] = (k*js + j)*i_s + i
+                        f2[n] = ((k+dk)*js + j+dj)*i_s + i+di
+                    n += 1
+    return n
+
+def _find_local_maxima_loop(map, points):
+    ks, js, i_s = map.shape
+    for p in range(len(points)):
+        i, j, k = points[p,0], points[p,1], points[p,2]
+        while True:
+            best = map[k,j,i]
+            bi, bj, bk = i, j, k
+            for dk in range(-1, 2):
+                kk = k + dk
+                if kk < 0 or kk >= ks:
+                    continue
+                for dj in range(-1, 2):
+                    jj = j + dj
+                    if jj < 0 or jj >= js:
+                        continue
+                    for di in range(-1, 2):
+                        ii = i + di
+                        if ii < 0 or ii >= i_s or (dk == 0 and dj == 0 and di == 0):
+                            continue
+                        v = map[kk,jj,ii]
+                        if v > best:
+                            best = v
+                            bi, bj, bk = ii, jj, kk
+            if bi == i and bj == j and bk == k:
+                break
+            i, j, k = bi, bj, bk
+        points[p,0] = i
+        points[p,1] = j
+        points[p,2] = k
+
+if numba is not None:
+    _jit = numba.njit(nogil = True, cache = True)
+    _steepest_neighbor_jit = _jit(_steepest_neighbor_loop)
+    _roots_jit = _jit(_roots_loop)
+    _region_maxima_jit = _jit(_region_maxima_loop)
+    _region_bounds_jit = _jit(_region_bounds_loop)
+    _contact_faces_jit = _jit(_contact_faces_loop)
+    _find_local_maxima_jit = _jit(_find_local_maxima_loop)
+
+# -----------------------------------------------------------------------------
+#
+def _contact_faces(region_index):
+    '''
+    Region ids and flat grid indices of the two sides of each face between
+    grid points in different nonzero regions, lower region id first.
+    '''
+    if numba is not None:
+        n = _contact_faces_jit(region_index, None, None, None, None)
+        r1 = numpy.empty((n,), region_index.dtype)
+        r2 = numpy.empty((n,), region_index.dtype)
+        f1 = numpy.empty((n,), numpy.int64)
+        f2 = numpy.empty((n,), numpy.int64)
+        _contact_faces_jit(region_index, r1, r2, f1, f2)
+        return r1, r2, f1, f2
+    shape = region_index.shape
+    flat = region_index.ravel()
+    index = numpy.arange(flat.size).reshape(shape)
+    r1, r2, f1, f2 = [], [], [], []
+    for axis in range(3):
+        lo = [slice(None)]*3
+        hi = [slice(None)]*3
+        lo[axis] = slice(0, -1)
+        hi[axis] = slice(1, None)
+        a, b = region_index[tuple(lo)], region_index[tuple(hi)]
+        sel = (a != b) & (a > 0) & (b > 0)
+        ia, ib = index[tuple(lo)][sel], index[tuple(hi)][sel]
+        va, vb = a[sel], b[sel]
+        swap = (va > vb)
+        r1.append(numpy.where(swap, vb, va))
+        r2.append(numpy.where(swap, va, vb))
+        f1.append(ia)
+        f2.append(ib)
+    return tuple(numpy.concatenate(x) for x in (r1, r2, f1, f2))
+
+# -----------------------------------------------------------------------------
+#
+def _unique_pairs(r1, r2):
+    keys = (r1.astype(numpy.int64) << 32) | r2.astype(numpy.int64)
+    ukeys, inv, count = numpy.unique(keys, return_inverse = True, return_counts = True)
+    pairs = numpy.stack((ukeys >> 32, ukeys & 0xffffffff), axis = 1)
+    return pairs, inv.ravel(), count
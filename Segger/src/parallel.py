@@ -0,0 +1,307 @@
+# -----------------------------------------------------------------------------
+# Segmentation kernels run by a pool of worker processes.  The map and mask
+# are placed in shared memory and split into blocks of z planes, each block
+# is computed by a worker and the block results are merged at the seams.
+# With one worker, uint16 and memory mapped masks are computed in blocks in
+# this process, converting one block at a time to the uint32 mask needed by
+# the kernels instead of copying the whole mask.
+#
+import numpy
+from . import timing
+from time import time as clock
+from .log import debug
+
+# -----------------------------------------------------------------------------
+#
+def worker_count(workers):
+    '''
+    Number of worker processes, 0 or None means one per cpu.  Counts are
+    limited to the number of cpus, negative values and values that are not
+    integers give 1.
+    '''
+    import os
+    ncpu = os.cpu_count() or 1
+    try:
+        workers = int(workers or 0)
+    except (TypeError, ValueError):
+        return 1
+    if workers < 0:
+        return 1
+    if workers == 0:
+        workers = ncpu
+    return min(workers, ncpu)
+
+# -----------------------------------------------------------------------------
+#
+def watershed_regions(matrix, threshold, workers, halo = 2, task = None):
+    '''
+    Watershed regions of a 3-d map array computed in z slabs by worker
+    processes.  Returns the uint32 mask with region ids 1 to n and the
+    maximum grid point (i,j,k) of each region.  Slab regions are stitched
+    as for the out-of-core watershed so the result matches the single
+    process calculation.
+    '''
+    from .watershed import slab_ranges, stitch_slabs
+
+    nz = matrix.shape[0]
+    workers = min(worker_count(workers), nz)
+    if workers <= 1:
+        from .kernels import watershed_regions, region_maxima
+        mask = numpy.zeros(matrix.shape, numpy.uint32)
+        watershed_regions(matrix, threshold, mask)
+        points, values = region_maxima(mask, matrix)
+        return mask, numpy.array(points, numpy.int32).reshape((-1,3))
+
+    if timing: t0 = clock()
+    slabs = slab_ranges(nz, -(-nz // workers))
+    with _SharedArray.copy_of(matrix) as smap, \
+         _SharedArray(matrix.shape, numpy.uint32) as labels:
+        if task:
+            task.updateStatus('Watershed in %d slabs using %d processes' % (len(slabs), workers))
+        args = [(smap.spec, labels.spec, threshold, z0, z1, halo) for z0, z1 in slabs]
+        results = _run(_watershed_block, args, workers)
+        if timing: t1 = clock()
+        points = [p for p, o in results]
+        owned = [o for p, o in results]
+        mask = numpy.empty(matrix.shape, numpy.uint32)
+        max_points = stitch_slabs(slabs, points, owned, labels.array, mask)
+
+    if timing:
+        debug('Parallel watershed %d slabs, %d regions, %.2f sec, stitch %.2f'
+              % (len(slabs), len(max_points), clock()-t0, clock()-t1))
+
+    return mask, max_points
+
+# -----------------------------------------------------------------------------
+#
+def region_contacts(mask, workers = 1):
+    '''
+    Same as kernels.region_contacts(mask) computed in z blocks by
+    worker processes.  Each block includes the first plane of the next block
+    so contacts across the seam are counted and the contacts within that
+    plane are subtracted.  Memory mapped masks are not copied to shared
+    memory and are computed in this process.
+    '''
+    workers = min(worker_count(workers), mask.shape[0] // 2)
+    if workers <= 1 or isinstance(mask, numpy.memmap):
+        if mask.dtype == numpy.uint32:
+            from .kernels import region_contacts
+            return region_contacts(mask)
+        results = [r for z0, z1 in _mask_blocks(mask)
+                   for r in _contacts(mask, z0, z1)]
+    else:
+        with _SharedArray.copy_of(mask, numpy.uint32) as smask:
+            args = [(smask.spec, z0, z1) for z0, z1 in _blocks(mask.shape[0], workers)]
+            results = [r for block in _run(_contacts_block, args, workers) for r in block]
+
+    rc = numpy.concatenate([c for c, sign in results])
+    sign = numpy.concatenate([numpy.full(len(c), sign, numpy.int32) for c, sign in results])
+    r1, r2, inv, npair = _merge_pairs(rc[:,0], rc[:,1])
+    n = numpy.bincount(inv, weights = sign * rc[:,2], minlength = npair)
+    keep = (n > 0)
+    return numpy.stack((r1[keep], r2[keep], n[keep].astype(numpy.int32)), axis = 1)
+
+# -----------------------------------------------------------------------------
+#
+def interface_values(mask, map, workers = 1):
+    '''
+    Same as kernels.interface_values(mask, map) computed in z
+    blocks by worker processes.  Returns contact pairs with count and the
+    maximum and sum of interface map values, merged as for region_contacts().
+    '''
+    workers = min(worker_count(workers), mask.shape[0] // 2)
+    if workers <= 1 or isinstance(mask, numpy.memmap):
+        if mask.dtype == numpy.uint32:
+            from .kernels import interface_values
+            return interface_values(mask, map)
+        results = [r for z0, z1 in _mask_blocks(mask)
+                   for r in _interfaces(mask, map, z0, z1)]
+    else:
+        with _SharedArray.copy_of(mask, numpy.uint32) as smask, _SharedArray.copy_of(map) as smap:
+            args = [(smask.spec, smap.spec, z0, z1) for z0, z1 in _blocks(mask.shape[0], workers)]
+            results = [r for block in _run(_interface_block, args, workers) for r in block]
+
+    ci = numpy.concatenate([ci for ci, cf, sign in results])
+    cf = numpy.concatenate([cf for ci, cf, sign in results])
+    sign = numpy.concatenate([numpy.full(len(ci), sign, numpy.int32) for ci, cf, sign in results])
+    r1, r2, inv, npair = _merge_pairs(ci[:,0], ci[:,1])
+    n = numpy.bincount(inv, weights = sign * ci[:,2], minlength = npair)
+    dsum = numpy.bincount(inv, weights = sign * cf[:,1], minlength = npair)
+    dmax = numpy.full(npair, -numpy.inf, numpy.float64)
+    numpy.maximum.at(dmax, inv, cf[:,0])
+    keep = (n > 0)
+    ci = numpy.stack((r1[keep], r2[keep], n[keep].astype(numpy.int32)), axis = 1)
+    cf = numpy.stack((dmax[keep], dsum[keep]), axis = 1).astype(cf.dtype)
+    return ci, cf
+
+# -----------------------------------------------------------------------------
+#
+def region_bounds(mask):
+    '''
+    Same as kernels.region_bounds(mask) for masks of any integer type,
+    computed in z blocks so only one block is converted to uint32 at a time.
+    '''
+    from .kernels import region_bounds, kernel_mask
+    if mask.dtype == numpy.uint32:
+        return region_bounds(mask)
+    blocks = []
+    for z0, z1 in _mask_blocks(mask):
+        b = region_bounds(kernel_mask(mask[z0:z1]))
+        b[:,2] += z0
+        b[:,5] += z0
+        blocks.append(b)
+    bounds = numpy.zeros((max(len(b) for b in blocks), 7), numpy.int32)
+    found = numpy.zeros((len(bounds),), bool)
+    for b in blocks:
+        n = len(b)
+        cur, new = found[:n], (b[:,6] > 0)
+        first = new & ~cur
+        both = new & cur
+        bounds[:n][first] = b[first]
+        bb = bounds[:n]
+        bb[both,:3] = numpy.minimum(bb[both,:3], b[both,:3])
+        bb[both,3:6] = numpy.maximum(bb[both,3:6], b[both,3:6])
+        bb[both,6] += b[both,6]
+        found[:n] |= new
+    return bounds
+
+# -----------------------------------------------------------------------------
+#
+def region_maxima(mask, map):
+    '''
+    Same as kernels.region_maxima(mask, map) for masks of any integer type,
+    computed in z blocks so only one block is converted to uint32 at a time.
+    '''
+    from .kernels import region_maxima, kernel_mask
+    if mask.dtype == numpy.uint32:
+        return region_maxima(mask, map)
+    n = int(mask.max()) if mask.size else 0
+    points = numpy.zeros((n,3), numpy.int32)
+    values = numpy.zeros((n,), numpy.float32)
+    found = numpy.zeros((n,), bool)
+    for z0, z1 in _mask_blocks(mask):
+        m = mask[z0:z1]
+        p, v = region_maxima(kernel_mask(m), map[z0:z1])
+        nb = len(v)
+        # Ties keep the maximum of the earlier block, first in mask order.
+        new = (numpy.bincount(m.ravel(), minlength = nb+1)[1:nb+1] > 0)
+        new &= ~found[:nb] | (v > values[:nb])
+        points[:nb][new] = p[new]
+        points[:nb][new,2] += z0
+        values[:nb][new] = v[new]
+        found[:nb] |= new
+    return points, values
+
+# -----------------------------------------------------------------------------
+#
+def _mask_blocks(mask, block_bytes = 2**26):
+    '''Ranges (z0, z1) of z planes holding about block_bytes as uint32.'''
+    from .watershed import slab_ranges
+    plane_bytes = 4 * max(1, mask[:1].size)
+    return slab_ranges(mask.shape[0], max(1, block_bytes // plane_bytes))
+
+# -----------------------------------------------------------------------------
+#
+def _blocks(nz, workers):
+    from .watershed import slab_ranges
+    return slab_ranges(nz, -(-nz // workers))
+
+# -----------------------------------------------------------------------------
+#
+def _merge_pairs(r1, r2):
+    '''Unique (r1,r2) pairs and index of each input pair in the unique pairs.'''
+    keys = (r1.astype(numpy.int64) << 32) | r2.astype(numpy.int64)
+    ukeys, inv = numpy.unique(keys, return_inverse = True)
+    return ((ukeys >> 32).astype(numpy.int32), (ukeys & 0xffffffff).astype(numpy.int32),
+            inv.ravel(), len(ukeys))
+
+# -----------------------------------------------------------------------------
+#
+def _run(func, args, workers):
+    '''Call func for each argument tuple using a pool of worker processes.'''
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers = min(workers, len(args))) as pool:
+        return list(pool.map(func, *zip(*args)))
+
+# -----------------------------------------------------------------------------
+# Worker process functions.  Shared arrays are attached by name and slices
+# passed back are copied so the shared memory can be closed.
+#
+def _watershed_block(map_spec, labels_spec, threshold, z0, z1, halo):
+    from .watershed import slab_watershed
+    with _SharedArray(*map_spec) as smap, _SharedArray(*labels_spec) as labels:
+        m = smap.array
+        core, points, owned = slab_watershed(lambda z, n: m[z:z+n], m.shape[0],
+                                             threshold, z0, z1, halo)
+        labels.array[z0:z1] = core
+        del m
+    return points, owned
+
+def _contacts_block(mask_spec, z0, z1):
+    with _SharedArray(*mask_spec) as smask:
+        m = smask.array
+        results = _contacts(m, z0, z1)
+        del m
+    return results
+
+def _interface_block(mask_spec, map_spec, z0, z1):
+    with _SharedArray(*mask_spec) as smask, _SharedArray(*map_spec) as smap:
+        m, d = smask.array, smap.array
+        results = _interfaces(m, d, z0, z1)
+        del m, d
+    return results
+
+# -----------------------------------------------------------------------------
+# Contacts of mask planes z0 to z1-1 and across the seam with the next block,
+# with sign -1 for the seam plane contacts counted again by the next block.
+#
+def _contacts(mask, z0, z1):
+    from .kernels import region_contacts, kernel_mask
+    if z1 == mask.shape[0]:
+        return [(region_contacts(kernel_mask(mask[z0:z1])), 1)]
+    return [(region_contacts(kernel_mask(mask[z0:z1+1])), 1),
+            (region_contacts(kernel_mask(mask[z1:z1+1])), -1)]
+
+def _interfaces(mask, map, z0, z1):
+    from .kernels import interface_values, kernel_mask
+    if z1 == mask.shape[0]:
+        return [tuple(interface_values(kernel_mask(mask[z0:z1]), map[z0:z1])) + (1,)]
+    return [tuple(interface_values(kernel_mask(mask[z0:z1+1]), map[z0:z1+1])) + (1,),
+            tuple(interface_values(kernel_mask(mask[z1:z1+1]), map[z1:z1+1])) + (-1,)]
+
+# -----------------------------------------------------------------------------
+#
+class _SharedArray:
+
+    '''
+    Numpy array in shared memory.  Created without a name in the main
+    process, then attached in workers using the spec (shape, dtype, name).
+    '''
+
+    def __init__(self, shape, dtype, name = None):
+
+        from multiprocessing.shared_memory import SharedMemory
+        dtype = numpy.dtype(dtype)
+        size = max(1, int(numpy.prod(shape)) * dtype.itemsize)
+        self._owner = (name is None)
+        self._shm = SharedMemory(name = name, create = self._owner, size = size)
+        self.array = numpy.ndarray(shape, dtype, buffer = self._shm.buf)
+        self.spec = (tuple(shape), dtype.str, self._shm.name)
+
+    @staticmethod
+    def copy_of(array, dtype = None):
+        s = _SharedArray(array.shape, array.dtype if dtype is None else dtype)
+        s.array[:] = array
+        return s
+
+    def close(self):
+        self.array = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -3,29 +3,29 @@ import numpy
 from sys import stderr
 from . import timing
 from time import time as clock
+from collections.abc import Set, Mapping
 
-from .segment_dialog import debug
+from .log import debug
+from .regiontable import SegmentationMask, RegionTable, VoxelIndex, relabel, random_color
+from .contacts import Contact, RegionContacts, group_contacts, merge_by_contact_size, contact_drop_merges
 
 from chimerax.core.models import Surface
-class Segmentation ( Surface ):
+class Segmentation ( Surface, SegmentationMask ):
 
     def __init__(self, name, session, volume = None):
 
         Surface.__init__(self, name, session)
 
         self.name = name
+        self.mesh_cache = MeshCache()   # Region surface meshes.
+        SegmentationMask.__init__(self)
         if volume is None:
-            self.mask = None
             debug(" - no mask?")
         else:
-            from numpy import zeros, uint32
-            self.mask = zeros(volume.data.size[::-1], uint32)
+            from numpy import zeros, uint16
+            self.mask = zeros(volume.data.size[::-1], uint16)
             debug(" - made mask from", volume.name)
-        self.regions = set()            # Top level regions
-        self.id_to_region = {}
-        self.max_region_id = 0
         self.smoothing_level = 0
-        self.rcons = None               # Leaf region contacts.
         self.seg_map = volume           # Map being segmented.
         self.map_level = None           # Good contouring level.
         tf = None if volume is None else volume.data.ijk_to_xyz_transform
@@ -33,11 +33,37 @@ class Segmentation ( Surface ):
             debug(" - ijk_to_xyz tr: ", tf.matrix)
         self.ijk_to_xyz_transform = tf  # mask to physical coords
         self.surface_resolution = 1     # voxels
+        self.surface_threads = 0        # Threads computing region surfaces, 0 = all cpus.
+        self.surface_method = 'gaussian'  # Region surfaces around 'gaussian' points or 'mask' boundaries.
+        self.merged_surfaces = False    # Draw all regions in one RegionsSurface model.
+        self._regions_surface = None
+        self._session_surfaces = None   # Region ids and colors of surfaces not yet made after restore.
 
         self.adj_graph = None           # graph with regions as nodes
         self.graph_links = "uniform"    # how to compute radii of links in graph
         self.regions_scale = 1.0        # for shrinking regions in the graph
 
+    @property
+    def regions(self):
+        '''Set of top level regions.'''
+        return RegionSet(self)
+
+    @property
+    def id_to_region(self):
+        '''Mapping from region id to region, including groups.'''
+        return RegionIdMap(self)
+
+    def region(self, rid):
+        '''Region object for a region id in the table.'''
+        r = Region.__new__(Region)
+        object.__setattr__(r, 'segmentation', self)
+        object.__setattr__(r, 'rid', int(rid))
+        return r
+
+    def regions_for_ids(self, ids):
+
+        return [self.region(rid) for rid in ids]
+
     def volume_data(self):
 
         v = self.seg_map
@@ -84,69 +110,97 @@ class Segmentation ( Surface ):
         v = det([r[:3] for r in t.matrix])
         return v
 
-    def calculate_region_bounds(self):
-
-        from chimerax.segment import region_bounds
-        b = region_bounds(self.mask)
-        for r in self.childless_regions():
-            i = r.rid
-            npts = b[i,6]
-            if npts > 0:
-                r.rbounds = (b[i,:3],b[i,3:6])
-                r.npoints = npts
-            else:
-                self.mask_id = None             # Not found in mask
-                r.rbounds = ((1,1,1),(0,0,0))
-                r.npoints = 0
+    def mask_changed(self):
+        '''Discard data and surface meshes computed from the mask.'''
+        SegmentationMask.mask_changed(self)
+        self.mesh_cache.clear()
+
+    def renumber_regions(self):
+        '''
+        Renumber regions as SegmentationMask.renumber_regions() does.  Region
+        objects made earlier are not valid after renumbering except those
+        of displayed surfaces.
+        '''
+        new_id = SegmentationMask.renumber_regions(self)
+        t = self.table
+        for rid, sp in t.surfaces.items():
+            if hasattr(sp, 'region'):
+                object.__setattr__(sp.region, 'rid', int(rid))
+        rs = self._regions_surface
+        if rs is not None and not rs.deleted:
+            rs.renumber(new_id)
+        if hasattr(self, 'rid_sid'):
+            self.rid_sid = dict((int(new_id[rid]), sid) for rid, sid in self.rid_sid.items()
+                                if rid < len(new_id) and new_id[rid])
+        self.adj_graph = None
+        return new_id
+
+    def region_moments(self, task = None):
+        '''
+        Geometric moments of all regions as a RegionMoments indexed by
+        region id.  Leaf moments are computed once per mask and group
+        moments once per region hierarchy.
+        '''
+        t = self.table
+        h = t.hierarchy()
+        size = self.max_region_id + 1
+        lm, m, mh = (None, None, None) if self._moments is None else self._moments
+        if lm is None:
+            from .moments import leaf_moments
+            lm = leaf_moments(self.mask, size, task = task)
+            m = None
+        if m is None or mh is not h or len(m.m0) < size:
+            m = lm.copy(size)
+            ids = t.ids()
+            m.combine_groups(h, ids[t.nchildren[ids] > 0])
+        self._moments = (lm, m, h)
+        return m
+
+    def region_axes(self, regions):
+        '''
+        Centers and principal axes U, S, V as from axes.prAxes() for
+        regions, in physical coordinates.
+        '''
+        ids = numpy.array([r.rid for r in regions], numpy.int32)
+        return self.region_moments().principal_axes(ids, self.point_transform())
+
+    def region_extents(self, leaf_ids, centers, axes = None):
+        '''
+        Largest distance of region points from centers, and along axes
+        (columns of each 3 by 3 array) if given, for regions given by arrays
+        of leaf ids, in physical coordinates.  All regions take one pass
+        over the voxel index.  Returns radii and extents or None.
+        '''
+        from .moments import point_extents
+        return point_extents(self.voxel_index(), leaf_ids, centers, axes,
+                             self.point_transform())
+
+    def point_counts(self, ids):
+        '''Array of voxel counts for an array of region ids.'''
+        t = self.table
+        n = t.npoints[ids]
+        unknown = (n < 0)
+        if unknown.any():
+            for rid in ids[unknown]:
+                self.region(rid).point_count()
+            n = t.npoints[ids]
+        return n
 
     def region_contacts(self, task = None):
-
+        '''
+        Contacts between leaf regions as a RegionContacts graph keyed by
+        leaf region id.
+        '''
         if self.rcons is None:
-            from chimerax.segment import region_contacts
-            if timing: t0 = clock()
-            rcon = region_contacts(self.mask)
-            if timing: t1 = clock()
-            rcons = {}
-            id2r = self.id_to_region
-            for i, (r1id, r2id, ncon) in enumerate(rcon):
-                r1 = id2r[r1id]
-                r2 = id2r[r2id]
-                c = Contact(ncon)
-                if not r1 in rcons:
-                    rcons[r1] = {}
-                if not r2 in rcons:
-                    rcons[r2] = {}
-                rcons[r1][r2] = rcons[r2][r1] = c
-                if task and i % 1000 == 0:
-                    task.updateStatus('Calculating region contacts %d of %d' %
-                                      (i, len(rcon)))
-            if timing: t2 = clock()
+            from .contacts import mask_contacts
+            if task:
+                task.updateStatus('Calculating region contacts')
             v = self.volume_data()
-            if v:
-                map = v.full_matrix()
-                from chimerax.segment import interface_values
-                ci, cf = interface_values(self.mask, map)
-                id2r = self.id_to_region
-                for (r1id,r2id,nv), (dmax,dsum) in zip(ci,cf):
-                    c = rcons[id2r[r1id]][id2r[r2id]]
-                    c.maximum_density = dmax
-                    c.D = dsum
-
-            if timing: t3 = clock()
-
-            self.rcons = rcons
-            cc = sum([len(t) for t in list(rcons.values())])/2
-            debug('Computed %d contacting pairs' % cc)
-            if timing:
-                debug('Time %.2f: contact calc %.2f sec, contact objects %.2f sec, maxima %.2f sec' % (t3-t0,t1-t0,t2-t1,t3-t2))
-
+            map = v.full_matrix() if v else None
+            self.rcons = mask_contacts(self, map, self.workers)
 
         return self.rcons
 
-    def contacts_changed(self):
-
-        self.rcons = None
-
     def open_map(self, open = True):
 
         debug(self.name, ":")
@@ -208,7 +262,12 @@ class Segmentation ( Surface ):
 
         return dmap
 
-    def add_region(self, name, vertices, normals, triangles, rgba):
+    def add_region(self, name, vertices, normals, triangles, rgba, rid = 0):
+
+        if self.merged_surfaces:
+            rs = self.regions_surface()
+            return rs.add_pieces([(vertices, normals, triangles)],
+                                 [float_to_8bit_color(rgba)], [rid])[0]
 
         from chimerax.core.models import Surface
         d = Surface(name, self.session)
@@ -218,13 +277,157 @@ class Segmentation ( Surface ):
         self.add([d])
         return d
 
+    def regions_surface(self):
+        '''Surface model holding all region meshes when merged_surfaces is true.'''
+        rs = self._regions_surface
+        if rs is None or rs.deleted:
+            from .regionsurface import RegionsSurface
+            rs = self._regions_surface = RegionsSurface('regions', self.session)
+            self.add([rs])
+        return rs
+
+    def set_merged_surfaces(self, merged):
+        '''
+        Switch between a surface model for each region and one surface model
+        for all regions, remaking the current region surfaces.
+        '''
+        if bool(merged) == self.merged_surfaces:
+            return
+        t = self.table
+        shown = [(self.region(rid), sp.display, sp.color)
+                 for rid, sp in list(t.surfaces.items()) if not sp.deleted]
+        for r, display, color in shown:
+            r.remove_surface()
+        self.merged_surfaces = bool(merged)
+        if not merged and self._regions_surface is not None:
+            if not self._regions_surface.deleted:
+                self._regions_surface.delete()
+            self._regions_surface = None
+        surfs = self.make_region_surfaces([r for r, display, color in shown], self.regions_scale)
+        for sp, (r, display, color) in zip(surfs, shown):
+            sp.display = display
+            sp.color = color
+
+    def mesh_key(self, rid, scale = 1.0, leaf_ids = None):
+        '''Mesh cache key, the leaf regions, surface method, resolution and scale.'''
+        lids = self.table.leaf_ids_under(rid) if leaf_ids is None else leaf_ids
+        lids = numpy.sort(lids).astype(numpy.int32)
+        return (lids.tobytes(), self.surface_method, self.surface_resolution, round(scale, 3))
+
+    def region_meshes(self, regions, scale = 1.0, task = None):
+        '''
+        Surface meshes (vertices, normals, triangles) of regions in physical
+        coordinates.  Meshes not in the mesh cache are computed in a thread
+        pool, the Gaussian smoothing and contouring run in C++ and NumPy.
+        With surface_method 'mask' the surfaces follow the binned mask
+        voxel boundaries, computed for all regions together.
+        '''
+        t = self.table
+        lids = [t.leaf_ids_under(r.rid) for r in regions]
+        keys = [self.mesh_key(r.rid, scale, l) for r, l in zip(regions, lids)]
+        meshes = [self.mesh_cache.get(k) for k in keys]
+        todo = [i for i, m in enumerate(meshes) if m is None]
+        if len(todo) == 0:
+            return meshes
+
+        if timing: t0 = clock()
+        tf = self.point_transform()
+        res = self.surface_resolution
+        if self.surface_method == 'mask':
+            # All regions in one pass over the binned mask.
+            bounds = [regions[i].bounds() for i in todo]
+            rmeshes = mask_region_meshes(self.binned_mask(res), [lids[i] for i in todo],
+                                         bounds, res, tf, scale)
+            for i, m in zip(todo, rmeshes):
+                meshes[i] = m
+                self.mesh_cache.add(keys[i], m)
+            if timing:
+                debug('Time %.2f: %d mask region surfaces, %d cached'
+                      % (clock()-t0, len(todo), len(regions)-len(todo)))
+            return meshes
+
+        self.voxel_index()      # Build the index before threads read it.
+        def mesh(i):
+            return region_mesh(regions[i].points(), res, tf, scale)
+        from .parallel import worker_count
+        threads = min(worker_count(self.surface_threads), len(todo))
+        if threads > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers = threads) as pool:
+                for n, (i, m) in enumerate(zip(todo, pool.map(mesh, todo))):
+                    if task and n % 100 == 0:
+                        task.updateStatus('Surface %d of %d' % (n+1, len(todo)))
+                    meshes[i] = m
+        else:
+            for n, i in enumerate(todo):
+                if task and n % 20 == 0:
+                    task.updateStatus('Surface %d of %d' % (n+1, len(todo)))
+                meshes[i] = mesh(i)
+        for i in todo:
+            self.mesh_cache.add(keys[i], meshes[i])
+
+        if timing:
+            debug('Time %.2f: %d region surfaces, %d threads, %d cached'
+                  % (clock()-t0, len(todo), threads, len(regions)-len(todo)))
+        return meshes
+
+    def make_region_surfaces(self, regions, scale = 1.0, task = None, bForce = False):
+        '''Make surface models for regions, computing meshes in parallel.'''
+        if not bForce:
+            regions = [r for r in regions if not r.surface_piece]
+        meshes = self.region_meshes(regions, scale, task)
+        if not self.merged_surfaces:
+            return [r.make_surface(v, t, bForce = True, normals = n)
+                    for r, (v, n, t) in zip(regions, meshes)]
+
+        # Add all meshes to the merged surface at once.
+        for r in regions:
+            r.remove_surface(including_children = True)
+        colors = [float_to_8bit_color(r.top_parent().color) for r in regions]
+        pieces = self.regions_surface().add_pieces(meshes, colors, [r.rid for r in regions])
+        for r, p in zip(regions, pieces):
+            r._attach_surface(p)
+        return pieces
+
+
+    def restore_surfaces(self):
+        '''
+        Make the region surfaces that were shown when the session was saved.
+        Called when the segmentation is first drawn after a session restore.
+        '''
+        ss = self._session_surfaces
+        if ss is None:
+            return
+        self._session_surfaces = None
+        ids, colors = ss
+        t = self.table
+        keep = (ids < t.size)
+        keep[keep] = t.exists[ids[keep]]
+        regions = self.regions_for_ids(ids[keep])
+        colors = colors[keep]
+        have = [r.surface_piece is not None for r in regions]
+        regions = [r for r, h in zip(regions, have) if not h]
+        colors = [c for c, h in zip(colors, have) if not h]
+        surfs = self.make_region_surfaces(regions)
+        for sp, scolor in zip(surfs, colors):
+            sp.color = scolor
+
+    def _restore_surfaces_cb(self, trigger_name, data):
+        if self.deleted:
+            self._session_surfaces = None
+        elif not self.visible:
+            return
+        else:
+            self.restore_surfaces()
+        from chimerax.core.triggerset import DEREGISTER
+        return DEREGISTER
 
     def remove_all_regions(self):
 
-        for r in self.regions:
-            r.remove_surface()
-        self.regions.clear()
-        self.id_to_region.clear()
+        self._session_surfaces = None
+        for rid in list(self.table.surfaces.keys()):
+            self.region(rid).remove_surface()
+        self.table = RegionTable()
 
     def remove_region (self, region,
                        remove_children = False,
@@ -260,29 +463,21 @@ class Segmentation ( Surface ):
                 check = childless
 
         parents = set()
+        erase = []
         for i, r in enumerate(rset):
 
             if task and i % 100 == 0:
                 task.updateStatus('remove region %d of %d' % (i, len(rset)))
 
-            if r in self.regions:
-                self.regions.remove(r)
-            del self.id_to_region[r.rid]
-            #print " - removed r %d" % r.rid
-
             if update_surfaces :
                 r.remove_surface()
 
             if len(r.cregs) == 0:
-                p = r.points()
-                if not p is None:
-                    self.mask[p[:,2],p[:,1],p[:,0]] = 0   # zero mask at points
-                    self.contacts_changed()
+                erase.append(r.rid)
 
             for c in r.cregs:
                 if not c in rset:
-                    c.preg = None
-                    self.regions.add(c)
+                    c.preg = None       # Becomes a top level region
                     if update_surfaces:
                         c.make_surface()
 
@@ -290,11 +485,14 @@ class Segmentation ( Surface ):
             if p and not p in rset:
                 parents.add(p)
 
-            i += 1
+        self.erase_region_voxels(erase)
+
+        t = self.table
+        for r in rset:
+            t.remove_region(r.rid)
 
         for p in parents:
-            p.remove_children([c for c in p.cregs if c in rset],
-                              update_surfaces = update_surfaces)
+            p.children_changed(update_surfaces)
 
 
     def remove_small_regions ( self, minRegionSize, task = None ) :
@@ -303,11 +501,8 @@ class Segmentation ( Surface ):
         #regions = SmallConnectedRegions ( self.childless_regions(), rcons, minRegionSize, task )
         #self.remove_regions(regions, task = task)
 
-        rregs = []
-        for r in self.regions :
-            np = len ( r.points() )
-            if np < minRegionSize :
-                rregs.append ( r )
+        ids = self.table.top_ids()
+        rregs = self.regions_for_ids(ids[self.point_counts(ids) < minRegionSize])
 
         self.remove_regions(rregs, remove_children=True, update_surfaces=True, task = task)
         debug('Removed %d regions smaller than %d voxels' % (len(rregs), minRegionSize))
@@ -317,14 +512,9 @@ class Segmentation ( Surface ):
 
         rcons = self.region_contacts(task)
 
-        rregs = []
-        for r in self.all_regions() :
-            csize = 0
-            if r in rcons:
-                for rc, con in rcons[r].items() :
-                    csize += con.N
-            if csize < minContactSize :
-                rregs.append ( r )
+        ids = self.table.ids()
+        csize = rcons.contact_sizes(ids)
+        rregs = self.regions_for_ids(ids[csize < minContactSize])
 
         self.remove_regions(rregs, remove_children=True, update_surfaces=True, task = task)
 
@@ -336,50 +526,45 @@ class Segmentation ( Surface ):
         if len(regs) == 0 :
             return None
 
+        ids = numpy.array([r.rid for r in regs], numpy.int32)
+        return self.join_region_ids ( ids, max_point, color )
+
+    def join_region_ids ( self, ids, max_point = None, color = None ) :
+
+        if len(ids) == 0 :
+            return None
+
+        t = self.table
         rid = self.max_region_id + 1
         self.max_region_id += 1
 
-        if max_point is None:
-            from numpy import sum, float32, int32
-            try :
-                ave = sum([r.max_point for r in regs], axis=0).astype(float32) / len(regs)
-                max_point = ave.astype(int32)
-            except :
-                max_point = None
-
-        nreg = Region ( self, rid, children = regs, max_point = max_point )
+        if max_point is None and t.has_max_point[ids].all():
+            from numpy import float32, int32
+            ave = t.max_point[ids].sum(axis=0).astype(float32) / len(ids)
+            max_point = ave.astype(int32)
 
         if color is None:
-            lr = max(regs, key = lambda r: r.point_count())
-            color = lr.color
-        nreg.color = color
+            lid = ids[numpy.argmax(self.point_counts(ids))]
+            color = t.color[lid]
 
-        return nreg
+        t.add_region ( rid, max_point, ids, color )
 
-    def find_sym_regions ( self, csyms, task=None ) :
+        return self.region(rid)
 
-        import numpy
+    def find_sym_regions ( self, csyms, task=None ) :
 
         centers, syms = csyms
         debug("Finding %d-symmetry region groups" % len(syms))
 
-        com = centers[0]
-        t_0_com = ( (1.0,0.0,0.0,-com[0]),
-                    (0.0,1.0,0.0,-com[1]),
-                    (0.0,0.0,1.0,-com[2]) )
-        t_to_com = ( (1.0,0.0,0.0,com[0]),
-                    (0.0,1.0,0.0,com[1]),
-                    (0.0,0.0,1.0,com[2]) )
-
-        rmask = numpy.ones(self.seg_map.data.size[::-1], numpy.uint32) * -1
+        # Symmetry operators about the center in grid index coordinates.
+        tfs = symmetry_transforms(syms[1:], centers[0])
 
-        for reg in self.regions :
-            points = reg.points()
-            #i,j,k = points[:,0],points[:,1],points[:,2]
-            #nmat[k-lk,j-lj,i-li] = dmat[k,j,i]
-            for p in points :
-                i,j,k = p
-                rmask[k,j,i] = reg.rid
+        # Top level region id at each grid point, 0 where there is no region.
+        t = self.table
+        ids = t.top_ids()
+        top = numpy.where(t.exists, t.top_parents(), 0).astype(numpy.uint32)
+        rmask = top[self.mask]
+        ks, js, i_s = rmask.shape
 
         # a map from region id to a symmetry id
         self.rid_sid = {}
@@ -394,116 +579,115 @@ class Segmentation ( Surface ):
         # that are true symmetric counterparts
 
         debug(" - sorting regions by size...")
-        task.updateStatus ( 'Sorting regions by size' )
-        size_regs = []
-        for reg in self.regions : size_regs.append ( [ len(reg.points()), reg] )
-        size_regs.sort ()
-        size_regs.reverse ()
-
-        for ri, npoints_r in enumerate ( size_regs ) :
+        if task:
+            task.updateStatus ( 'Sorting regions by size' )
+        sizes = self.point_counts(ids)
+        ids = ids[numpy.lexsort((-ids, -sizes))]
 
-            npoints, r = npoints_r
+        for ri, rid in enumerate ( ids.tolist() ) :
 
-            if ri % 100 == 0 :
+            if task and ri % 100 == 0 :
                 task.updateStatus('Finding symmetric regions %.1f%%' % (
-                    100.0 * float(ri) / float(len(self.regions))) )
+                    100.0 * float(ri) / float(len(ids))) )
 
-            try :
-                sid = self.rid_sid [ r.rid ]
+            if rid in self.rid_sid :
                 continue
-            except : pass
 
             sid_at += 1
-            self.rid_sid [ r.rid ] = sid_at
-
-            for si, smat in enumerate ( syms [1 : ] ) :
-
-                # transform the region points using symmetry matrix
-                rpoints = r.points ().astype ( numpy.float32 )
-                tf = t_to_com * smat * t_0_com
-                tf.transform_points ( rpoints, in_place = True )
-
-                # and get region ids from the map at the transformed points
-                ipoints = numpy.round (rpoints).astype(numpy.int)
-                sym_rids = rmask [ ipoints[:,2],ipoints[:,1],ipoints[:,0] ]
-
-                # make a map from sym_rid, a region id that shows up
-                # at the trasnformed map indices for the current region
-                # to the number of time it appears at transformed indices
-                rm = {}
-                for sym_rid in sym_rids :
-                    try : rm [ sym_rid ] = rm [ sym_rid ] + 1
-                    except : rm [ sym_rid ] = 1
-
-                # ignore rids of -1, which are points
-                # in the grid where there is no region id
-                if -1 in rm : rm.pop ( -1 )
-
-                if 0 :
-                    # ignore regions that already have a sid
-                    # not sure if this is a good idea yet
-                    rm2 = {}
-                    for sym_rid, count in rm.items() :
-                        if sym_rid in self.rid_sid : continue
-                        else : rm2[sym_rid] = count
-                    rm = rm2
+            self.rid_sid [ rid ] = sid_at
 
+            points = self.region(rid).points()
+            if points is None or len(tfs) == 0:
+                continue
 
-                unique_sym_rids = list(rm.keys ())
-                if len ( unique_sym_rids ) == 0 : continue
-
-                # take the rid that appears the most as the symmetric counterpart
-                sym_rid = unique_sym_rids [ numpy.argmax ( list(rm.values()) ) ]
-
+            # Transform the region points by all symmetry operators at once
+            # and look up the region ids at the nearest grid points.
+            sp = numpy.einsum('sij,nj->sni', tfs[:,:,:3], points) + tfs[:,None,:,3]
+            ip = numpy.rint(sp).astype(numpy.int64)
+            i, j, k = ip[:,:,0], ip[:,:,1], ip[:,:,2]
+            inside = ((i >= 0) & (i < i_s) & (j >= 0) & (j < js) & (k >= 0) & (k < ks))
+            sym_rids = numpy.zeros(inside.shape, numpy.uint32)
+            sym_rids[inside] = rmask[k[inside], j[inside], i[inside]]
+
+            # Count each region id for each operator, the most frequent is
+            # the symmetric counterpart.  Ties go to the lower region id.
+            u, inv = numpy.unique(sym_rids, return_inverse = True)
+            nu = len(u)
+            op = numpy.repeat(numpy.arange(len(tfs)), sym_rids.shape[1])
+            counts = numpy.bincount(op * nu + inv.ravel(), minlength = len(tfs) * nu)
+            counts = counts.reshape((len(tfs), nu))
+            if u[0] == 0:
+                counts[:,0] = 0         # Points in no region.
+            found = counts.max(axis = 1) > 0
+            partners = u[counts.argmax(axis = 1)[found]]
+
+            for sym_rid in partners.tolist() :
                 self.rid_sid [ sym_rid ] = sid_at
-                sreg = self.id_to_region [ sym_rid ]
-                sreg.color = r.color
-
-            #if r.rid > 30 : break
+            t.color[partners] = t.color[rid]
 
         debug("%d regions, sid_at: %d - # sids: %d" % (
-            len(self.regions), sid_at, len(set(self.rid_sid.values())) ))
+            len(ids), sid_at, len(set(self.rid_sid.values())) ))
 
 
-    def calculate_watershed_regions ( self, mm, thrD, csyms=None, task = None ) :
+    def calculate_watershed_regions ( self, mm, thrD, csyms=None, task = None,
+                                      slab_planes = None, halo = 2, mask_path = None ) :
 
+        '''
+        With slab_planes the map is read and segmented that many z planes
+        at a time into a memory mapped mask, at mask_path or a temporary
+        file, for maps too large for memory.  Otherwise if self.workers is
+        not 1 the map is segmented in slabs by that many processes.
+        '''
         self.remove_all_regions()
 
         self.adj_graph = None
 
-        m = mm.data.full_matrix()
-        from chimerax.segment import watershed_regions, region_maxima
         if timing: t0 = clock()
         if task:
             task.updateStatus('Computing watershed regions for %s' % mm.name)
-        from numpy import zeros, uint32
-        self.mask = zeros(m.shape, uint32)
-        watershed_regions(m, thrD, self.mask)
-        self.map_level = thrD
-        if timing: t1 = clock()
-        max_points, max_values = region_maxima(self.mask, m)
-        if timing: t2 = clock()
+        from .parallel import worker_count
+        if slab_planes:
+            from .watershed import mask_array, tiled_watershed
+            mask = mask_array(mm.data.size[::-1], mask_path)
+            max_points = tiled_watershed(mm.data, thrD, mask, slab_planes, halo, task)
+            self.mask = mask
+            self.map_level = thrD
+            if timing: t1 = t2 = clock()
+        elif self.workers != 1 and worker_count(self.workers) > 1:
+            from .parallel import watershed_regions
+            m = mm.data.full_matrix()
+            self.mask, max_points = watershed_regions(m, thrD, self.workers, halo, task)
+            self.map_level = thrD
+            if timing: t1 = t2 = clock()
+        else:
+            m = mm.data.full_matrix()
+            from .kernels import watershed_regions, region_maxima
+            from numpy import zeros, uint32
+            self.mask = zeros(m.shape, uint32)
+            watershed_regions(m, thrD, self.mask)
+            self.map_level = thrD
+            if timing: t1 = clock()
+            max_points, max_values = region_maxima(self.mask, m)
+            if timing: t2 = clock()
         n = len(max_points)
-        regions = []
-        for r in range(n):
-            if task and r % 1000 == 0:
-                task.updateStatus('Created regions %d of %d' % (r, n))
-            reg = Region ( self, r+1, max_points[r] )
-            regions.append(reg)
-
-        self.regions = set(regions)
-        self.id_to_region = dict([(r.rid, r) for r in regions])
+        if task:
+            task.updateStatus('Creating %d regions' % n)
+        ids = numpy.arange(1, n+1, dtype = numpy.int32)
+        self.table.add_leaf_regions(ids, max_points)
+        self.max_region_id = max(n, self.max_region_id)
         if timing: t3 = clock()
 
-        np = sum([r.point_count() for r in regions])
-        debug('Calculated %d watershed regions covering %d grid points' % (len(regions), np))
+        self.calculate_region_bounds()
+        self.compact_mask()
+        np = self.table.npoints[ids].sum()
+        debug('Calculated %d watershed regions covering %d grid points' % (n, np))
         if timing:
-            debug('Time %.2f: watershed mask %.2f, maxima %.2f, region objects %.2f' % (t3-t0, t1-t0, t2-t1, t3-t2))
+            debug('Time %.2f: watershed mask %.2f, maxima %.2f, region table %.2f' % (t3-t0, t1-t0, t2-t1, t3-t2))
 
         if csyms :
             self.find_sym_regions ( csyms, task )
 
-        return regions
+        return self.regions
 
 
     def smooth_and_group ( self, steps, sdev, min_reg = 1, csyms=None, task=None ) :
@@ -512,8 +696,12 @@ class Segmentation ( Surface ):
 
         dmap = self.volume_data()
 
-        from numpy import single as floatc
-        sm_mat = dmap.data.full_matrix().astype(floatc)
+        # Fourier transform the map once for all smoothing widths.
+        if task:
+            task.updateStatus('Transforming map for smoothing')
+        from .scalespace import GaussianScaleSpace
+        scales = GaussianScaleSpace(dmap.data.full_matrix(), steps*sdev)
+        if timing: debug('Time %.2f: map transform' % (clock()-t0))
 
         rlist = []
         for iti in range ( steps ) :
@@ -523,9 +711,7 @@ class Segmentation ( Surface ):
             slev = (iti+1)*sdev
 
             if timing: t1 = clock()
-            ijk_sdev = (slev, slev, slev)
-            from chimerax.map_filter import gaussian
-            sm = gaussian.gaussian_convolution (sm_mat, ijk_sdev, task = task)
+            sm = scales.smoothed(slev)
             if timing: t2 = clock()
 
             rlist = None
@@ -555,52 +741,51 @@ class Segmentation ( Surface ):
 
     def group_by_tracking_maxima ( self, m, task = None ) :
 
-        rlist = list(self.regions)
-        pos = numpy.array([r.max_point for r in rlist], numpy.intc)
-
-        from chimerax.segment import find_local_maxima
-        find_local_maxima(m, pos)
-
-        rm = {}
-        for reg, pt in zip(rlist, pos):
-            pt = tuple(pt)
-            if pt in rm:
-                rm[pt].append(reg)
-            else:
-                rm[pt] = [reg]
-        groups = [(pt,regs) for pt,regs in list(rm.items()) if len(regs) >= 2]
+        groups = self.tracked_maxima_groups ( m )
 
         rlist = []
-        for i, (pt,regs) in enumerate(groups):
+        for i, (pt,ids) in enumerate(groups):
             if task and i % 100 == 0:
                 s = "Grouping %d of %d" % ( i, len( groups ) )
                 task.updateStatus ( s )
-            newReg = self.join_regions ( regs, pt )
+            newReg = self.join_region_ids ( ids, pt )
             rlist.append(newReg)
 
         return rlist
 
 
+    def tracked_maxima_groups ( self, m ) :
 
-    def group_by_tracking_maxima_sym ( self, m, csyms, task = None ) :
-
-        rlist = list(self.regions)
-        pos = numpy.array([r.max_point for r in rlist], numpy.intc)
+        '''
+        Move the maximum point of each top level region uphill on map m
+        and return a list of (point, region ids) for the points reached
+        by two or more regions.
+        '''
+        ids = self.table.top_ids()
+        pos = numpy.array(self.table.max_point[ids], numpy.intc)
 
-        from chimerax.segment import find_local_maxima
+        from .kernels import find_local_maxima
         find_local_maxima(m, pos)
 
-        rm = {}
-        for reg, pt in zip(rlist, pos):
-            pt = tuple(pt)
-            if pt in rm:
-                rm[pt].append(reg)
-            else:
-                rm[pt] = [reg]
-        groups = [(pt,regs) for pt,regs in list(rm.items()) if len(regs) >= 2]
+        if len(ids) == 0:
+            return []
+        upos, inv, counts = numpy.unique(pos, axis = 0, return_inverse = True,
+                                         return_counts = True)
+        inv = inv.ravel()
+        order = numpy.argsort(inv, kind = 'stable')
+        ends = numpy.cumsum(counts)
+        groups = [(upos[g], ids[order[e-c:e]])
+                  for g, (c, e) in enumerate(zip(counts, ends)) if c >= 2]
+        return groups
+
+
+
+    def group_by_tracking_maxima_sym ( self, m, csyms, task = None ) :
+
+        groups = self.tracked_maxima_groups ( m )
 
         rlist = []
-        for i, (pt,regs) in enumerate(groups):
+        for i, (pt,ids) in enumerate(groups):
             if task and i % 100 == 0:
                 s = "Grouping %d of %d" % ( i, len( groups ) )
                 task.updateStatus ( s )
@@ -611,26 +796,24 @@ class Segmentation ( Surface ):
             # not be joined since that would violate the symmetry condition
 
             sid_rids = {}
-            for r in regs :
-                try : sid = self.rid_sid [ r.rid ]
+            for rid in ids :
+                try : sid = self.rid_sid [ rid ]
                 except : continue
                 if sid in sid_rids :
                     # same sid seen more than once
                     doJoin = False
-                try : sid_rids [ sid ].append ( r.rid )
-                except : sid_rids [ sid ] = [ r.rid ]
+                try : sid_rids [ sid ].append ( rid )
+                except : sid_rids [ sid ] = [ rid ]
 
             if doJoin :
-                newReg = self.join_regions ( regs, pt )
+                newReg = self.join_region_ids ( ids, pt )
                 rlist.append(newReg)
 
             else :
                 debug("Trying to join: ", sid_rids)
                 clr = random_color()
                 for sid, rids in sid_rids.items () :
-                    for rid in rids :
-                        reg = self.id_to_region [ rid ]
-                        reg.color = clr
+                    self.table.color[rids] = clr
 
         self.find_sym_regions ( csyms, task )
         return rlist
@@ -661,55 +844,96 @@ class Segmentation ( Surface ):
         nregs0 = len(self.regions)
         debug("Grouping connected - %d regions" % nregs0)
 
-        newRegs, delRegs = [], []
+        gc = group_contacts(self.region_contacts(), limit_regions=regions)
+        if gc.count == 0 :
+            debug(" - no more connections, stopping")
+            return [], []
 
-        for si in range (nsteps) :
+        debug(" - %d cons, N %d - %d" % (gc.count, gc.N.min(), gc.N.max()))
 
-            cons = group_contacts(self.region_contacts(), limit_regions=regions)
+        if regions is not None :
+            # Joined regions are not in the limited set, only one level.
+            nsteps = min(nsteps, 1)
 
-            if task :
-                task.updateStatus( 'Making contacts list' )
+        def join ( r1id, r2id ) :
+            return self.join_region_ids ( numpy.array((r1id, r2id), numpy.int32) ).rid
 
-            minN, maxN = 1e5, 0
-            clist = []
-            for r1, r1cons in cons.items() :
-                for r2, con in r1cons.items () :
-                    clist.append ( [r1, r2, con] )
-                    if con.N < minN : minN = con.N
-                    if con.N > maxN : maxN = con.N
-
-            if len(clist) == 0 :
-                debug(" - no more connections, stopping")
-                break
-
-            debug(" - %d cons, N %d - %d, sorting..." % (len(clist), minN, maxN))
-
-            if task :
-                task.updateStatus( 'Sorting contacts list' )
+        if timing: t0 = clock()
+        levels = merge_by_contact_size ( gc, join, nsteps, stopAt, task )
+        if timing: debug("Joined %d levels in %.2f sec" % (len(levels), clock()-t0))
+        if len(levels) == 0 :
+            return [], []
 
-            clist.sort ( reverse=True, key=lambda x: x[2].N )
+        delRegs = self.regions_for_ids([rid for r1, r2, rj in levels[0] for rid in (r1, r2)])
+        newRegs = self.regions_for_ids([rj for r1, r2, rj in levels[-1]])
 
+        debug(" - connected %d regions, now at %d" % ( nregs0 - len(self.regions), len(self.regions) ))
 
-            #rgrouped = {}
-            nregs = []
-            for r1, r2, con in clist :
-                #if not r1 in rgrouped and not r2 in rgrouped : #r1.preg
-                if not r1.preg and not r2.preg :
-                    r = self.join_regions ( (r1, r2) )
-                    #rgrouped[r1], rgrouped[r2] = 1, 1
-                    nregs.append(r)
-                    if si == 0 : delRegs.extend ( [r1,r2] )
+        return newRegs, delRegs
 
-            newRegs = nregs[:]
 
-            debug(" - connected %d regions, now at %d" % ( len(nregs), len(self.regions) ))
+    def compute_merge_tree ( self, method = 'contact size', task = None ) :
+        '''
+        Compute the complete grouping tree of the current top level regions
+        so grouping to any number of regions is a fast cut of the tree.
+        Method is 'contact size' to join largest contacts first as grouping
+        by connectivity does, or 'contact drop' to join by density drop.
+        '''
+        from . import mergetree
+        if method == 'contact size':
+            self.merge_tree = mergetree.contact_size_merge_tree(self, task)
+        elif method == 'contact drop':
+            self.merge_tree = mergetree.contact_drop_merge_tree(self, task)
+        else:
+            raise ValueError('Unknown merge tree method "%s"' % method)
+        debug('Merge tree for %d regions, %d merges' %
+              (self.merge_tree.base_count, self.merge_tree.merge_count))
+        return self.merge_tree
+
+    def group_by_merge_tree ( self, nregions = None, height = None, task = None ) :
+        '''
+        Replace the grouping above the merge tree base regions by cutting
+        the merge tree to give nregions groups, or at a merge height.
+        Returns the new group regions.
+        '''
+        tree = self.merge_tree
+        if tree is None:
+            return []
+
+        if height is None:
+            nmerges = tree.merges_for_region_count(nregions)
+        else:
+            nmerges = tree.merges_for_height(height)
+
+        # Remove all groups above the base regions.
+        t = self.table
+        base = tree.base_ids[tree.base_ids < t.size]
+        base = base[t.exists[base]]
+        above = set()
+        p = t.parent[base]
+        while len(p) > 0:
+            p = numpy.unique(p[p > 0])
+            above.update(p.tolist())
+            p = t.parent[p]
+        if above:
+            rabove = self.regions_for_ids(sorted(above))
+            for r in rabove:
+                r.remove_surface()
+            self.remove_regions ( rabove, remove_childless_parents = False,
+                                  task = task )
 
-            if len(nregs) <= stopAt :
-                debug(" - stopping for %d regions" % stopAt)
-                break
+        if task:
+            task.updateStatus('Grouping to %d regions' % (tree.base_count - nmerges))
 
-        return newRegs, delRegs
+        groups = []
+        for ids in tree.groups(nmerges):
+            ids = ids[t.exists[ids]]
+            if len(ids) > 1:
+                groups.append(self.join_region_ids(ids))
 
+        debug('Cut merge tree after %d merges, %d groups, now %d regions' %
+              (nmerges, len(groups), len(self.regions)))
+        return groups
 
     def ungroup_regions ( self, regs, task = None ):
 
@@ -739,17 +963,27 @@ class Segmentation ( Surface ):
 
         debug(" -- showing ?", len(self.regions), "? regions")
 
-        rlist = list(self.regions)
-        rlist.sort(key = lambda r: r.point_count())
-        rlist.reverse()
+        # Largest regions first.
+        ids = self.table.top_ids()
+        ids = ids[numpy.argsort(-self.point_counts(ids), kind = 'stable')]
+        if not max_reg is None:
+            surfs = self.table.surfaces
+            for rid in ids[max_reg:]:
+                if rid in surfs:
+                    self.region(rid).remove_surface()
+            ids = ids[:max_reg]
+        rlist = self.regions_for_ids(ids)
 
         self.style = style
 
-        for i, reg in enumerate(rlist):
+        if style == 'Voxel_Surfaces':
+            todo = [r for r in rlist if bForce or not r.surface_piece]
+            self.make_region_surfaces(todo, self.regions_scale, task, bForce = True)
+            for reg in rlist:
+                reg.surface_piece.display = True
+            return
 
-            if not max_reg is None and i >= max_reg :
-                reg.remove_surface()
-                continue
+        for i, reg in enumerate(rlist):
 
             if (not bForce) and reg.surface_piece:
                 reg.surface_piece.display = True
@@ -757,11 +991,7 @@ class Segmentation ( Surface ):
 
             vt = None
 
-            if style == 'Voxel_Surfaces' :
-
-                reg.make_surface (None,None,self.regions_scale,bForce)
-
-            elif style == 'Density_Maxima' :
+            if style == 'Density_Maxima' :
                 rpts = numpy.array ( [r.max_point for r in r.childless_regions()], numpy.float32 )
                 import MultiScale
                 vt = MultiScale.surface.surface_points ( rpts, 1.0, 0.1, .25, 5 )
@@ -882,12 +1112,11 @@ class Segmentation ( Surface ):
 
     def all_regions ( self ):
 
-        return list(self.id_to_region.values())
+        return self.regions_for_ids(self.table.ids())
 
     def childless_regions ( self ):
 
-        rlist = [r for r in list(self.id_to_region.values()) if len(r.cregs) == 0]
-        return rlist
+        return self.regions_for_ids(self.table.leaf_ids())
 
     def select_regions ( self, regions, only = False ) :
 
@@ -924,9 +1153,9 @@ class Segmentation ( Surface ):
 
     def grouped_regions ( self ) :
 
-        #sregs = self.regions
-        regions = [r for r in self.regions if len(r.cregs) > 0]
-        return regions
+        t = self.table
+        ids = t.top_ids()
+        return self.regions_for_ids(ids[t.nchildren[ids] > 0])
 
 
     def change_surface_resolution(self, res, task = None):
@@ -934,22 +1163,31 @@ class Segmentation ( Surface ):
         if res == self.surface_resolution:
             return
         self.surface_resolution = res
-        for i, r in enumerate(self.regions):
-            if task and i % 100 == 0:
-                task.updateStatus('Redisplaying surface %d of %d' %
-                                  (i, len(self.regions)))
-            sp = r.surface_piece
-            if sp:
-                display = sp.display
-                color = sp.color
-                r.remove_surface()
-                sp = r.make_surface()
-                sp.display = display
-                sp.color = color
+        self.remake_surfaces(task)
+
+    def set_surface_method(self, method, task = None):
+        '''Surface regions around 'gaussian' smoothed points or 'mask' boundaries.'''
+        if method not in ('gaussian', 'mask'):
+            raise ValueError('Unknown region surface method "%s"' % method)
+        if method == self.surface_method:
+            return
+        self.surface_method = method
+        self.remake_surfaces(task)
+
+    def remake_surfaces(self, task = None):
+        '''Recompute shown region surfaces after surface settings change.'''
+        regs = [r for r in self.regions if r.surface_piece]
+        shown = [(r.surface_piece.display, r.surface_piece.color) for r in regs]
+        surfs = self.make_region_surfaces(regs, task = task, bForce = True)
+        for sp, (display, color) in zip(surfs, shown):
+            sp.display = display
+            sp.color = color
 
     @property
     def region_surfaces(self):
-        return [r.surface_piece for r in self.regions if r.surface_piece is not None]
+        t = self.table
+        return [sp for rid, sp in list(t.surfaces.items())
+                if t.parent[rid] == 0 and not sp.deleted]
     
     def close(self):
 
@@ -959,77 +1197,234 @@ class Segmentation ( Surface ):
             self.adj_graph.close()
 
     # State save/restore in ChimeraX
-    _save_attrs = ['mask', 'seg_map', 'regions', 'id_to_region', 'max_region_id',
-                   'smoothing_level', 'map_level', 'surface_resolution', 'ijk_to_xyz_transform']
+    _save_attrs = ['seg_map', 'max_region_id',
+                   'smoothing_level', 'map_level', 'surface_resolution', 'ijk_to_xyz_transform',
+                   'merged_surfaces', 'surface_method']
   
     def take_snapshot(self, session, flags):
         data = {
             'model state': Surface.take_snapshot(self, session, flags),
-            'version': 1,
+            'version': 3,
         }
         for attr in Segmentation._save_attrs:
             data[attr] = getattr(self, attr)
         if self.seg_map is not None and self.seg_map.deleted:
             data['seg_map'] = None
+        data['mask'] = None if self.mask is None else compress_mask(self.mask)
+        rstate = self.table.take_state()
+        if self._session_surfaces is not None and len(rstate['ids']) > 0:
+            # Surfaces from a restored session that have not been drawn yet.
+            ids, colors = self._session_surfaces
+            rows = numpy.searchsorted(rstate['ids'], ids)
+            rows = numpy.minimum(rows, len(rstate['ids'])-1)
+            found = (rstate['ids'][rows] == ids) & ~rstate['shown'][rows]
+            rstate['shown'][rows[found]] = True
+            rstate['surface_color'][rows[found]] = colors[found]
+        data['region table'] = rstate
+        if self.merge_tree is not None:
+            data['merge tree'] = self.merge_tree.take_state()
         return data
 
     @staticmethod
     def restore_snapshot(session, data):
         s = Segmentation('', session, volume = data['seg_map'])
         Surface.set_state_from_snapshot(s, session, data['model state'])
+        mask = data.get('mask')
+        s.mask = decompress_mask(mask) if isinstance(mask, dict) else mask
         for attr in Segmentation._save_attrs:
             if attr in data:
                 setattr(s, attr, data[attr])
-        for r in s.id_to_region.values():
-            r.segmentation = s
-            if getattr(r, '_session_restore_make_surface', False):
-                sp = r.make_surface()
-                scolor = getattr(r, '_session_restore_surface_color', None)
-                if scolor is not None:
-                    sp.color = scolor
+        if 'region table' in data:
+            rstate = data['region table']
+        else:
+            id2r = data['id_to_region']
+            rstate = region_states_to_table_state(id2r)
+            for r in id2r.values():
+                object.__setattr__(r, 'segmentation', s)
+        s.table.set_state(rstate)
+        if 'merge tree' in data:
+            from .mergetree import MergeTree
+            s.merge_tree = MergeTree.from_state(data['merge tree'])
+        # Region surfaces are made when the segmentation is first drawn.
+        shown = rstate['shown']
+        if shown.any():
+            s._session_surfaces = (rstate['ids'][shown], rstate['surface_color'][shown])
+            session.triggers.add_handler('new frame', s._restore_surfaces_cb)
         return s
 
+class RegionSet ( Set ):
+
+    '''Set of top level regions of a segmentation, backed by the region table.'''
+
+    def __init__(self, segmentation):
+        self.segmentation = segmentation
+
+    def __len__(self):
+        return self.segmentation.table.top_count
+
+    def __iter__(self):
+        seg = self.segmentation
+        return iter(seg.regions_for_ids(seg.table.top_ids()))
+
+    def __contains__(self, region):
+        if not isinstance(region, Region) or region.segmentation is not self.segmentation:
+            return False
+        t = self.segmentation.table
+        return t.has_region(region.rid) and t.parent[region.rid] == 0
+
+    @classmethod
+    def _from_iterable(cls, it):
+        return set(it)
+
+
+class RegionIdMap ( Mapping ):
+
+    '''Mapping from region id to region for a segmentation.'''
+
+    def __init__(self, segmentation):
+        self.segmentation = segmentation
+
+    def __getitem__(self, rid):
+        seg = self.segmentation
+        if not seg.table.has_region(rid):
+            raise KeyError(rid)
+        return seg.region(rid)
+
+    def __contains__(self, rid):
+        return self.segmentation.table.has_region(rid)
+
+    def __len__(self):
+        return self.segmentation.table.count()
+
+    def __iter__(self):
+        return iter(self.segmentation.table.ids().tolist())
+
+
 # State base class handles session save and restore using
 # take_snapshot() and restore_snapshot() methods.
 from chimerax.core.state import State
 
 class Region ( State ):
 
-    def __init__( self, segmentation, rid, max_point = None, children = None ) :
+    '''
+    A region of a segmentation.  Region data lives in the segmentation region
+    table so this object only records the segmentation and region id, and two
+    Region objects with the same id compare equal.  Other attributes assigned
+    to a region are kept in the table too.
+    '''
 
-        self.segmentation = segmentation
-        self.rid = rid
-        if segmentation:	# Segmentation is None during session restore.
-            segmentation.id_to_region[rid] = self
-            segmentation.regions.add(self)
-            segmentation.max_region_id = max(rid, segmentation.max_region_id)
-        if children is None:
-            children = []  # Don't use [] as default since appends change it.
-        self.mask_id = None if children else rid
-        self.cregs = children   # Child regions
-        self.preg = None        # Parent region
-        self.smoothing_level = 0
+    __slots__ = ('segmentation', 'rid')
 
-        self.rbounds = None      # (imin, jmin, kmin), (imax, jmax, kmax)
-        self.npoints = None
-        self.max_point = max_point     # Position of local maximum
-        self._surface_piece = None       # Displayed surface.
+    def __init__( self, segmentation, rid, max_point = None, children = None ) :
 
-        self.color = random_color()         # Surface color, rgba 0-1 values
-        self.placed = False
+        object.__setattr__(self, 'segmentation', segmentation)
+        object.__setattr__(self, 'rid', rid)
+        cids = [] if children is None else [c.rid for c in children]
+        segmentation.table.add_region(rid, max_point, cids)
+        segmentation.max_region_id = max(rid, segmentation.max_region_id)
+
+    def __eq__( self, r ):
+        return (isinstance(r, Region) and r.rid == self.rid and
+                r.segmentation is self.segmentation)
+
+    def __ne__( self, r ):
+        return not self.__eq__(r)
+
+    def __hash__( self ):
+        return hash(self.rid)
+
+    def __getattr__( self, name ):
+        if name in Region.__slots__:
+            raise AttributeError(name)
+        e = self.segmentation.table.extras.get(self.rid)
+        if e is None or name not in e:
+            raise AttributeError("'Region' object has no attribute '%s'" % name)
+        return e[name]
+
+    def __setattr__( self, name, value ):
+        if hasattr(type(self), name):
+            object.__setattr__(self, name, value)
+        else:
+            self.segmentation.table.extras.setdefault(self.rid, {})[name] = value
+
+    def __delattr__( self, name ):
+        e = self.segmentation.table.extras.get(self.rid)
+        if e is None or name not in e:
+            raise AttributeError(name)
+        del e[name]
+
+    def _get_smoothing_level( self ):
+        return float(self.segmentation.table.smoothing_level[self.rid])
+    def _set_smoothing_level( self, level ):
+        self.segmentation.table.smoothing_level[self.rid] = level
+    smoothing_level = property(_get_smoothing_level, _set_smoothing_level)
+
+    def _get_placed( self ):
+        return bool(self.segmentation.table.placed[self.rid])
+    def _set_placed( self, placed ):
+        self.segmentation.table.placed[self.rid] = placed
+    placed = property(_get_placed, _set_placed)
+
+    def _get_color( self ):
+        return tuple(float(c) for c in self.segmentation.table.color[self.rid])
+    def _set_color( self, color ):
+        self.segmentation.table.color[self.rid] = color
+    color = property(_get_color, _set_color)
+
+    def _get_max_point( self ):
+        t = self.segmentation.table
+        return t.max_point[self.rid].copy() if t.has_max_point[self.rid] else None
+    def _set_max_point( self, max_point ):
+        t = self.segmentation.table
+        t.has_max_point[self.rid] = max_point is not None
+        if max_point is not None:
+            t.max_point[self.rid] = max_point
+    max_point = property(_get_max_point, _set_max_point)
+
+    def _get_npoints( self ):
+        n = self.segmentation.table.npoints[self.rid]
+        return None if n < 0 else int(n)
+    def _set_npoints( self, npoints ):
+        self.segmentation.table.npoints[self.rid] = -1 if npoints is None else npoints
+    npoints = property(_get_npoints, _set_npoints)
+
+    def _get_rbounds( self ):
+        t = self.segmentation.table
+        if not t.has_bounds[self.rid]:
+            return None
+        b = t.bounds[self.rid]
+        return (b[:3].copy(), b[3:].copy())
+    def _set_rbounds( self, bounds ):
+        t = self.segmentation.table
+        t.has_bounds[self.rid] = bounds is not None
+        if bounds is not None:
+            t.bounds[self.rid] = tuple(bounds[0]) + tuple(bounds[1])
+    rbounds = property(_get_rbounds, _set_rbounds)
 
-        if children:
-            for reg in children :
-                reg.preg = self
-                if segmentation:
-                    segmentation.regions.remove(reg)
+    @property
+    def mask_id( self ):
+        return self.rid if self.segmentation.table.in_mask[self.rid] else None
+
+    @property
+    def cregs( self ):
+        '''List of child regions.'''
+        seg = self.segmentation
+        return seg.regions_for_ids(seg.table.child_ids(self.rid))
+
+    def _get_preg( self ):
+        pid = self.segmentation.table.parent[self.rid]
+        return self.segmentation.region(pid) if pid else None
+    def _set_preg( self, preg ):
+        self.segmentation.table.set_parent(self.rid, 0 if preg is None else preg.rid)
+    preg = property(_get_preg, _set_preg)
 
     def bounds ( self ):
 
-        if self.rbounds is None:
-            if self.cregs:
+        t = self.segmentation.table
+        if not t.has_bounds[self.rid]:
+            if t.nchildren[self.rid]:
                 self.rbounds = union_bounds([r.bounds() for r in self.cregs])
-            elif self.mask_id is None:
+            elif not t.in_mask[self.rid]:
                 self.rbounds = ((1,1,1),(0,0,0))        # Empty group
             else:
                 self.segmentation.calculate_region_bounds()
@@ -1044,20 +1439,17 @@ class Region ( State ):
 
     def points ( self ):
 
-        if self.cregs:
-            cpts = [r.points() for r in self.childless_regions()]
-            p = numpy.concatenate(cpts) if cpts else None
+        # Grid indices (i,j,k) of the region voxels taken from the
+        # segmentation voxel index, concatenated for all leaf regions of a group.
+        seg = self.segmentation
+        t = seg.table
+        if t.nchildren[self.rid]:
+            lids = t.leaf_ids_under(self.rid)
+            if len(lids) == 0:
+                return None
         else:
-            # would be useful to know what this is doing,
-            # it's a little hard to understand from the code...
-            (imin, jmin, kmin), (imax, jmax, kmax) = self.bounds()
-            m = self.segmentation.mask[kmin:kmax+1,jmin:jmax+1,imin:imax+1]
-            from chimerax.segment import region_points
-            p = region_points(m, self.rid)
-            p[:,0] += imin
-            p[:,1] += jmin
-            p[:,2] += kmin
-        return p
+            lids = [self.rid]
+        return seg.voxel_index().points(lids)
 
     def map_points ( self ):
 
@@ -1069,27 +1461,21 @@ class Region ( State ):
 
     def center_of_points ( self, transform = True ) :
 
-        plists = [r.points() for r in self.childless_regions()]
-        s = numpy.sum([numpy.sum(plist, axis=0) for plist in plists], axis=0)
-        com = s.astype(numpy.float32)
-        com /= self.point_count()
-        if transform:
-            tf = self.segmentation.point_transform()
-            tf.transform_points ( com.reshape((1,3)), in_place = True )
-
-        return com
+        # From the segmentation region moments, computed for all regions at once.
+        seg = self.segmentation
+        tf = seg.point_transform() if transform else None
+        com = seg.region_moments().centers([self.rid], tf)[0]
+        return com.astype(numpy.float32)
 
 
     def region_radius ( self ) :
 
-        from numpy import sqrt, max, sum, square
-        rmax = 0
-        c = self.center_of_points()
-        plists = [r.map_points() for r in self.childless_regions()]
-        for p in plists:
-            r = sqrt ( max ( sum ( square (p - c), 1 ) ) )
-            rmax = max(rmax, r)
-        return rmax
+        if self.point_count() == 0:
+            return 0
+        seg = self.segmentation
+        radii, ext = seg.region_extents([seg.table.leaf_ids_under(self.rid)],
+                                        [self.center_of_points()])
+        return radii[0]
 
 
     def enclosed_volume ( self ) :
@@ -1109,12 +1495,18 @@ class Region ( State ):
             self.surface_piece.color = float_to_8bit_color(tuple(self.color[:3]) + (opacity,))
 
     def _get_surface_piece( self ):
-        sp = self._surface_piece
+        surfs = self.segmentation.table.surfaces
+        sp = surfs.get(self.rid)
         if sp and sp.deleted:
-            self._surface_piece = sp = None
+            del surfs[self.rid]
+            sp = None
         return sp
     def _set_surface_piece( self, surf ):
-        self._surface_piece = surf
+        surfs = self.segmentation.table.surfaces
+        if surf is None:
+            surfs.pop(self.rid, None)
+        else:
+            surfs[self.rid] = surf
     surface_piece = property(_get_surface_piece, _set_surface_piece)
     
     def surface ( self ) :
@@ -1147,7 +1539,8 @@ class Region ( State ):
         if sp:
             sp.display = False
 
-    def make_surface ( self, vertices = None, triangles = None, scale=1.0, bForce=False ):
+    def make_surface ( self, vertices = None, triangles = None, scale=1.0, bForce=False,
+                       normals = None ):
 
         if (not bForce) and self.surface_piece:
             return self.surface_piece
@@ -1155,43 +1548,21 @@ class Region ( State ):
         self.remove_surface(including_children = True)
 
         if vertices is None:
-            seg = self.segmentation
-            '''
-            from MultiScale.surface import surface_points
-            vertices, triangles, normals = \
-                surface_points ( self.points(),
-                                 resolution = seg.surface_resolution,
-                                 density_threshold = 0.1,
-                                 smoothing_factor = .25,
-                                 smoothing_iterations = 5 )
-            '''
-            pts = self.points()
-            from numpy import ones, float32
-            weights = ones(len(pts), float32)
-            res = 3*seg.surface_resolution
-            from chimerax.surface import gaussian_surface
-            vertices, normals, triangles, level = gaussian_surface(pts, weights, res, level = 0.1)
-            tf = seg.point_transform()
-
-            import numpy
-            if numpy.fabs(scale-1.0) > 0.01 :
-                com = self.center_of_points ()
-                t_0_com = ( (1.0,0.0,0.0,-com[0]),
-                            (0.0,1.0,0.0,-com[1]),
-                            (0.0,0.0,1.0,-com[2]) )
-                t_to_com = ( (1.0,0.0,0.0,com[0]),
-                            (0.0,1.0,0.0,com[1]),
-                            (0.0,0.0,1.0,com[2]) )
-                t_scale = ( (scale,0.0,0.0,0.0),
-                            (0.0,scale,0.0,0.0),
-                            (0.0,0.0,scale,0.0) )
-                tf = t_to_com * t_scale * t_0_com * tf
-
-            tf.transform_points(vertices, in_place = True)
+            # Gaussian surface of the region points, from the mesh cache if
+            # the same leaf regions were surfaced before.
+            vertices, normals, triangles = \
+                self.segmentation.region_meshes([self], scale)[0]
+        elif normals is None:
+            from chimerax.surface import calculate_vertex_normals
+            normals = calculate_vertex_normals(vertices, triangles)
 
         rgba = self.top_parent().color
-        nsp = self.segmentation.add_region ('region', vertices, normals, triangles, rgba )
+        nsp = self.segmentation.add_region ('region', vertices, normals, triangles, rgba,
+                                            rid = self.rid )
         # debug(" - added piece with color", nsp.color)
+        return self._attach_surface(nsp)
+
+    def _attach_surface ( self, nsp ):
 
         try : sidstr = ", sym # %d" % self.segmentation.rid_sid [ self.rid ]
         except : sidstr = ""
@@ -1215,38 +1586,37 @@ class Region ( State ):
     # Contacting top regions.
     def contacting_regions ( self ):
 
-        rset = set()
-        rcons = self.segmentation.region_contacts()
-        for r in self.childless_regions():
-            if r in rcons:
-                rset.update(list(rcons[r].keys()))
-        cr = set()
-        for r in rset:
-            cr.add(r.top_parent())
-        return tuple(cr)
+        s = self.segmentation
+        t = s.table
+        rcons = s.region_contacts()
+        cids = rcons.neighbors_of(t.leaf_ids_under(self.rid))
+        tids = numpy.unique(t.top_parents()[cids])
+        return tuple(s.regions_for_ids(tids))
 
     def parents ( self ) :
 
-        rlist = []
-        r = self
-        while r.preg :
-            r = r.preg
-            rlist.append(r)
-        return rlist
+        seg = self.segmentation
+        parent = seg.table.parent
+        pids = []
+        p = parent[self.rid]
+        while p :
+            pids.append(p)
+            p = parent[p]
+        return seg.regions_for_ids(pids)
 
     def top_parent ( self ) :
 
-        r = self
-        while r.preg :
-            r = r.preg
-        return r
+        seg = self.segmentation
+        return seg.region(seg.table.hierarchy().top[self.rid])
+
+    def is_ancestor_of ( self, region ) :
+
+        return self.segmentation.table.hierarchy().is_ancestor(self.rid, region.rid)
 
     def all_regions ( self ):
 
-        rlist = [self]
-        for c in self.cregs:
-            rlist.extend(c.all_regions())
-        return rlist
+        seg = self.segmentation
+        return seg.regions_for_ids(seg.table.hierarchy().regions_under(self.rid))
 
     def in_group ( self ):
 
@@ -1254,11 +1624,11 @@ class Region ( State ):
 
     def has_children ( self ):
 
-        return len(self.cregs) > 0
+        return self.segmentation.table.nchildren[self.rid] > 0
 
     def is_group ( self ):
 
-        return len(self.cregs) > 0
+        return self.segmentation.table.nchildren[self.rid] > 0
 
     def children ( self ):
 
@@ -1266,30 +1636,28 @@ class Region ( State ):
 
     def all_children ( self ):
 
-        rlist = list(self.cregs)
-        for c in self.cregs:
-            rlist.extend(c.all_children())
-        return rlist
+        seg = self.segmentation
+        return seg.regions_for_ids(seg.table.hierarchy().regions_under(self.rid)[1:])
 
     def childless_regions ( self ):
 
-        if self.cregs:
-            rlist = []
-            for c in self.cregs:
-                rlist.extend(c.childless_regions())
-        else:
-            rlist = [self]
-        return rlist
+        seg = self.segmentation
+        return seg.regions_for_ids(seg.table.leaf_ids_under(self.rid))
 
     def point_count ( self ):
 
         if self.npoints is None:
-            if self.cregs:
-                self.npoints = sum([r.point_count() for r in self.cregs])
+            seg = self.segmentation
+            t = seg.table
+            if t.nchildren[self.rid]:
+                lids = t.leaf_ids_under(self.rid)
+                if (t.npoints[lids] < 0).any():
+                    seg.calculate_region_bounds()
+                self.npoints = int(numpy.maximum(t.npoints[lids], 0).sum())
             elif self.mask_id is None:
                 self.npoints = 0        # Empty group region
             else:
-                self.segmentation.calculate_region_bounds()
+                seg.calculate_region_bounds()
                 if self.npoints is None:
                     debug('empty region', self.rid)
                     self.npoints = 0
@@ -1297,127 +1665,155 @@ class Region ( State ):
 
     def remove_children ( self, cregs, update_surfaces = True):
 
+        t = self.segmentation.table
         for c in cregs:
-            self.cregs.remove(c)
+            t.set_parent(c.rid, 0)
         self.children_changed(update_surfaces)
 
     def children_changed(self, update_surfaces = True):
 
-        # Clear cached point count.
-        self.npoints = None
-        self.rbounds = None
+        # This region and its parents all changed.
+        for r in [self] + self.parents():
 
-        # Update displayed surface.
-        if self.surface_piece:
-            self.remove_surface()
-            if update_surfaces and len(self.cregs) > 0:
-                self.make_surface()
+            # Clear cached point count.
+            r.npoints = None
+            r.rbounds = None
 
-        # Update parent
-        p = self.preg
-        if p:
-            p.children_changed(update_surfaces)
+            # Update displayed surface.
+            if r.surface_piece:
+                r.remove_surface()
+                if update_surfaces and r.has_children():
+                    r.make_surface()
 
     def has_attribute(self, name):
 
-        return hasattr(self, 'attrib') and name in self.attrib
+        return name in self.attributes()
 
     def get_attribute(self, name, default = None):
 
-        return self.attrib[name] if hasattr(self, 'attrib') and name in self.attrib else default
+        return self.attributes().get(name, default)
 
     def set_attribute(self, name, value):
 
         if self.is_reserved_name(name):
             return False                 # Name clash
-        if not hasattr(self, 'attrib'):
-            self.attrib = {}
-        self.attrib[name] = value
+        self.segmentation.table.attrib.setdefault(self.rid, {})[name] = value
         setattr(self, name, value)
         return True
 
     def is_reserved_name(self, name):
 
-        return hasattr(self, name) and not (hasattr(self, 'attrib') and name in self.attrib)
+        return hasattr(self, name) and not name in self.attributes()
 
     def remove_attribute(self, name):
 
-        if hasattr(self, 'attrib') and name in self.attrib:
-            del self.attrib[name]
+        a = self.attributes()
+        if name in a:
+            del a[name]
             delattr(self, name)
 
     def attributes(self):
 
-        return self.attrib if hasattr(self, 'attrib') else {}
+        return self.segmentation.table.attrib.get(self.rid, {})
 
-    # State save/restore in ChimeraX
-    _save_attrs = ['rid', 'cregs', 'mask_id', 'smoothing_level',
-                   'rbounds', 'npoints', 'max_point', 'color', 'placed']
-  
+    # State save/restore in ChimeraX.  Region data is saved by the segmentation.
     def take_snapshot(self, session, flags):
-        data = { 'version': 1 }
-        for attr in Region._save_attrs:
-            data[attr] = getattr(self, attr)
-        data['_show_surface'] = self.has_surface()
-        sp = self.surface_piece
-        if sp:
-            data['_surface_color'] = sp.color
-        return data
+        return {'version': 2, 'segmentation': self.segmentation, 'rid': self.rid}
 
     @staticmethod
     def restore_snapshot(session, data):
-        seg = None	# Segmentation.restore_snapshot() will set segmentation
-        r = Region(seg, data['rid'], max_point = data['max_point'], children = data['cregs'])
-        for attr in Region._save_attrs:
-            setattr(r, attr, data[attr])
-        if data['_show_surface']:
-            r._session_restore_make_surface = True	# Will be created by Segmentation.restore_snapshot()
-        if '_surface_color' in data:
-            r._session_restore_surface_color = data['_surface_color']
+        if data['version'] >= 2:
+            return data['segmentation'].region(data['rid'])
+        # Sessions before version 2 saved each region separately.
+        # Segmentation.restore_snapshot() copies the state to the region table.
+        r = _RestoredRegion.__new__(_RestoredRegion)
+        object.__setattr__(r, 'segmentation', None)
+        object.__setattr__(r, 'rid', data['rid'])
+        r.state = data
         return r
-    
-
-class Contact:
 
-    def __init__ (self, ncontact):
+class _RestoredRegion ( Region ):
+    __slots__ = ('state',)
 
-        self.N = ncontact               # number of voxel pairs
-        self.D = 0.0                    # divide by 2*N to get average
-        self.maximum_density = None
+def region_states_to_table_state(id_to_region):
 
+    rlist = list(id_to_region.values())
+    n = len(rlist)
+    ids = numpy.array([r.rid for r in rlist], numpy.int32)
+    state = {'ids': ids}
+    parent = numpy.zeros((n,), numpy.int32)
+    rindex = dict((rid,i) for i, rid in enumerate(ids))
+    for r in rlist:
+        for c in r.state['cregs']:
+            parent[rindex[c.rid]] = r.rid
+    state['parent'] = parent
+    rs = [r.state for r in rlist]
+    state['in_mask'] = numpy.array([d['mask_id'] is not None for d in rs], numpy.bool_)
+    state['placed'] = numpy.array([bool(d['placed']) for d in rs], numpy.bool_)
+    state['has_max_point'] = numpy.array([d['max_point'] is not None for d in rs], numpy.bool_)
+    state['max_point'] = numpy.array([(0,0,0) if d['max_point'] is None else d['max_point']
+                                      for d in rs], numpy.int32).reshape((n,3))
+    state['color'] = numpy.array([d['color'] for d in rs], numpy.float32).reshape((n,4))
+    state['smoothing_level'] = numpy.array([d['smoothing_level'] for d in rs], numpy.float32)
+    state['npoints'] = numpy.array([-1 if d['npoints'] is None else d['npoints']
+                                    for d in rs], numpy.int64)
+    state['has_bounds'] = numpy.array([d['rbounds'] is not None for d in rs], numpy.bool_)
+    state['bounds'] = numpy.array([(0,)*6 if d['rbounds'] is None
+                                   else tuple(d['rbounds'][0]) + tuple(d['rbounds'][1])
+                                   for d in rs], numpy.int32).reshape((n,6))
+    state['shown'] = numpy.array([d['_show_surface'] for d in rs], numpy.bool_)
+    state['surface_color'] = numpy.array([d.get('_surface_color', (0,0,0,0))
+                                          for d in rs], numpy.uint8).reshape((n,4))
+    return state
+
+
+def symmetry_transforms(syms, center):
+    '''
+    Array of 3 by 4 matrices applying each symmetry operator about a center
+    point.  Operators are Place objects or 3 by 4 matrices.
+    '''
+    c = numpy.array(center, numpy.float64)
+    tfs = []
+    for sym in syms:
+        m = numpy.array(sym.matrix if hasattr(sym, 'matrix') else sym, numpy.float64)[:3]
+        r, t = m[:,:3], m[:,3]
+        tfs.append(numpy.concatenate((r, (t + c - r.dot(c))[:,None]), axis = 1))
+    return numpy.array(tfs, numpy.float64).reshape((-1,3,4))
+
+def compress_mask(mask, chunk_bytes = 2**24, level = 1, threads = None):
+    '''
+    Mask as a dictionary of zlib compressed slabs of z planes for saving
+    in sessions.  Masks of region ids compress to a few percent of their
+    size.  Slabs are compressed in a thread pool since zlib releases the
+    Python global lock.
+    '''
+    import zlib
+    nz = mask.shape[0]
+    step = max(1, chunk_bytes // max(1, mask[:1].nbytes))
+    def compress_planes(z):
+        return zlib.compress(numpy.ascontiguousarray(mask[z:z+step]).tobytes(), level)
+    zs = range(0, nz, step)
+    if threads is None:
+        import os
+        threads = min(8, os.cpu_count() or 1)
+    if threads > 1 and len(zs) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers = threads) as pool:
+            slabs = list(pool.map(compress_planes, zs))
+    else:
+        slabs = [compress_planes(z) for z in zs]
+    return {'shape': tuple(mask.shape), 'dtype': mask.dtype.str,
+            'planes': step, 'zlib': slabs}
 
-def group_contacts ( rcons, limit_regions = None, task = None ) :
-
-    if not limit_regions is None:
-        limit_regions = set(limit_regions)
-
-    # Compute top parents of leaf regions.
-    top = dict([(r,r.top_parent()) for r in rcons])
-
-    # Compute contacts of top region groups from leaf contacts.
-    cons = {}
-    for i, (r1, r1cons) in enumerate(rcons.items()) :
-        r1_parent = top[r1]
-        if limit_regions is None or r1_parent in limit_regions:
-            if task and i % 1000 == 0:
-                task.updateStatus('group contacts %d of %d' % (i, len(rcons)))
-            r1pcons = cons.setdefault(r1_parent, {})
-            for r2, o in r1cons.items() :
-                r2_parent = top[r2]
-                if r2_parent != r1_parent:
-                    if limit_regions is None or r2_parent in limit_regions:
-                        if r2_parent in r1pcons:
-                            no = r1pcons[r2_parent]
-                            no.D += o.D
-                            no.N += o.N
-                            if (no.maximum_density == None or
-                                no.maximum_density < o.maximum_density) :
-                                no.maximum_density = o.maximum_density
-                        else :
-                            r1pcons[r2_parent] = Contact(o.N)
-
-    return cons
-
+def decompress_mask(state):
+    '''Mask array from compress_mask() state.'''
+    import zlib
+    mask = numpy.empty(state['shape'], numpy.dtype(state['dtype']))
+    step = state['planes']
+    for i, slab in enumerate(state['zlib']):
+        p = mask[i*step:(i+1)*step]
+        p[:] = numpy.frombuffer(zlib.decompress(slab), p.dtype).reshape(p.shape)
+    return mask
 
 
 def GroupedRegions ( regions, rset = None ):
@@ -1428,7 +1824,7 @@ def GroupedRegions ( regions, rset = None ):
         rset.update( regions )
 
     for r in regions:
-        GroupedRegions ( r.cregs, rset )
+        rset.update ( r.all_regions() )
 
     return rset
 
@@ -1465,14 +1861,14 @@ def ConnectedRegions ( regions, rcons, min_contact = None, task = None ) :
             cc += 1
             while bndry :
                 reg = bndry.pop()
-                if reg in rcons:
-                    for cr in rcons[reg]:
-                        if (min_contact is None or
-                            rcons[reg][cr].N >= min_contact):
-                            if not cr in conr:
-                                s.add(cr)
-                                conr[cr] = s
-                                bndry.append(cr)
+                cids, ci = rcons.neighbor_contacts(reg.rid)
+                if min_contact is not None:
+                    cids = cids[rcons.N[ci] >= min_contact]
+                for cr in reg.segmentation.regions_for_ids(cids):
+                    if not cr in conr:
+                        s.add(cr)
+                        conr[cr] = s
+                        bndry.append(cr)
     return conr
 
 
@@ -1502,19 +1898,6 @@ def region_bounds(regions):
     return ijk_min, ijk_max
 
 
-def random_color(avoid_rgba = None, minimum_rgba_distance = 0.2):
-
-    from random import random as rand
-    while True:
-        c = ( 0.5*(1+rand()), 0.5*(1+rand()), 0.5*(1+rand()), 1.0 )
-        if avoid_rgba is None:
-            break
-        d = sum([(x0-x1)*(x0-x1) for x0,x1 in zip(c, avoid_rgba)])
-        if d > minimum_rgba_distance * minimum_rgba_distance:
-            break
-    return c
-
-
 def segmentations(session):
 
     slist = session.models.list(type = Segmentation)
@@ -1527,69 +1910,17 @@ def segmentations(session):
 #
 def group_by_contacts(smod, task = None):
 
-    map = smod.volume_data().full_matrix()
-
-    if task:
-        task.updateStatus('Computing interface maxima')
-
-    from chimerax.segment import interface_values
-    ci, cf = interface_values(smod.mask, map)
-
-    if task:
-        task.updateStatus('Computing drops')
-
     for r in smod.all_regions():
         r.color_level = len(smod.regions)
 
-    # Cache top parent, optimization for high grouping depth.
-    tp = {}
-    for t in smod.regions:
-        for c in t.childless_regions():
-            tp[c] = t
-
-    id2r = smod.id_to_region
-    rc = [(id2r[id1],id2r[id2],dmax) for (id1,id2,nv),(dmax,dsum) in zip(ci,cf)]
-
-    rmax = region_maxima(smod.regions, map)
-    drc = [(min(rmax[tp[r1]],rmax[tp[r2]])-cd,r1,r2,cd) for r1,r2,cd in rc]
-    drc.sort()
-    drc.reverse()
+    def join(p1, p2, drop):
+        rj = smod.join_region_ids(numpy.array((p1,p2), numpy.int32))
+        rj.color_level = len(smod.regions)
+        return rj.rid
 
-    cc = 0
-    rcnt = 0
-    drcr = []
-    dr = None
-    while drc:
-        d, r1, r2, cd = drc.pop()
-        dl = min(rmax[tp[r1]],rmax[tp[r2]])-cd
-        if dl != d:
-            # Drop changed due to region merging.
-            dr = dl if dr is None else min(dl, dr)
-            drcr.append((dl,r1,r2,cd))
-            continue
-        elif not dr is None and (d > dr or len(drc) == 0):
-            # Resort drops.
-            drcr.append((dl,r1,r2,cd))
-            drc = [(min(rmax[tp[r1]],rmax[tp[r2]])-cd,r1,r2,cd)
-                   for d,r1,r2,cd in drc + drcr]
-            drc.sort()
-            drc.reverse()
-            drcr = []
-            dr = None
-            rcnt += 1
-            continue
-        cc += 1
-        if task and cc % 100 == 0:
-            task.updateStatus('Contact %d of %d' % (cc, len(ci)))
-        p1 = collapse_chain(tp, r1)
-        p2 = collapse_chain(tp, r2)
-        if p1 != p2:
-            rj = smod.join_regions((p1,p2))
-            rj.color_level = len(smod.regions)
-            tp[p1] = tp[p2] = rj
-            rmax[rj] = max((rmax[p1], rmax[p2]))
+    map = smod.volume_data().full_matrix()
+    contact_drop_merges(smod, map, join, task)
     debug('max group depth', maximum_group_depth(smod.regions))
-    debug('resorted', rcnt)
 
 def connected_subsets(connections):
 
@@ -1617,11 +1948,14 @@ def region_maxima(regions, map, rmax = None):
     if rmax is None:
         rmax = {}
     for r in regions:
-        if r.cregs:
-            region_maxima([c for c in r.cregs if not c in rmax], map, rmax)
-            rmax[r] = max([rmax[c] for c in r.cregs])
-        else:
-            rmax[r] = map[r.max_point[2],r.max_point[1],r.max_point[0]]
+        # Reversed depth first order puts children before their parents.
+        for c in r.all_regions()[::-1]:
+            if c in rmax:
+                continue
+            if c.has_children():
+                rmax[c] = max([rmax[cc] for cc in c.cregs])
+            else:
+                rmax[c] = map[c.max_point[2],c.max_point[1],c.max_point[0]]
     return rmax
 
 def maximum_group_depth(regions):
@@ -1636,36 +1970,29 @@ def maximum_group_depth(regions):
             dmax = d
     return dmax
 
-def collapse_chain(d, e):
-    v = d[e]
-    if v in d and v != e:
-        while v in d and d[v] != v:
-            v = d[v]
-        while e != v:
-            n = d[e]
-            d[e] = v
-            e = n
-    return v
-
 def regions_radius ( regions ) :
 
-    from numpy import sqrt, max, sum, square, zeros, float32
-    s = zeros((3,), float32)
-    n = 0
-    for reg in regions:
-        for r in reg.childless_regions():
-            p = r.map_points()
-            s += sum(p, axis=0)
-            n += len(p)
-    c = s / n
-    rmax = 0
-    for reg in regions:
-        for r in reg.childless_regions():
-            p = r.map_points()
-            radius = sqrt ( max ( sum ( square (p - c), axis = 1 ) ) )
-            if radius > rmax:
-                rmax = radius
-    return rmax
+    # Center of all region points from the region moments, then the
+    # farthest point of each segmentation's regions in one pass.
+    segs = {}
+    for r in regions:
+        segs.setdefault(id(r.segmentation), (r.segmentation, []))[1].append(r.rid)
+    n, csum = 0, numpy.zeros((3,))
+    for seg, ids in segs.values():
+        m = seg.region_moments()
+        counts = m.m0[ids]
+        n += counts.sum()
+        csum += (counts[:,None] * m.centers(ids, seg.point_transform())).sum(axis = 0)
+    if n == 0:
+        return 0
+    c = csum / n
+    rad = 0
+    for seg, ids in segs.values():
+        t = seg.table
+        lids = numpy.concatenate([t.leaf_ids_under(rid) for rid in ids])
+        radii, ext = seg.region_extents([numpy.unique(lids)], [c])
+        rad = max(rad, radii[0])
+    return rad
 
 
 def mean_and_sd(regions, volume):
@@ -1681,34 +2008,19 @@ def mean_and_sd(regions, volume):
         debug('Incompatible mask (%d,%d,%d) and map (%d,%d,%d) sizes.' % (tuple(mask_size) + tuple(map_size)))
         return None
 
-    vmat = volume.full_matrix()
+    # Statistics for all regions take one pass over the map and are saved
+    # as region attributes.
+    from .regionstats import region_statistics, set_statistics_attributes
+    stats = region_statistics(smod, volume, binned_mask)
+    set_statistics_attributes(smod, stats)
 
-    moff = []
-    b0, b1, b2 = binned_mask
-    for i in range(b0):
-        for j in range(b1):
-            for k in range(b2):
-                moff.append(vmat[k::b2,j::b1,i::b0])
+    ids = numpy.array([reg.rid for reg in regions], numpy.int32)
+    return list(stats.mean[ids]), list(stats.sd[ids])
 
-    means = []
-    sdevs = []
-    from numpy import concatenate
-    for reg in regions :
-        pts = reg.points()
-        i,j,k = pts[:,0], pts[:,1], pts[:,2]
-        mval = concatenate([m[k,j,i] for m in moff])
-        mean, sd = mval.mean(), mval.std()
-        means.append(mean)
-        sdevs.append(sd)
-        reg.set_attribute('map mean', mean)
-        reg.set_attribute('map sd', sd)
 
-    return means, sdevs
+def mask_volume(regions, volume, full_size = True, pad = 4) :
 
-
-def mask_volume(regions, volume) :
-
-    mgrid = mask_data(regions, volume)
+    mgrid = mask_data(regions, volume, full_size, pad)
     if mgrid == None :
         return None
 
@@ -1719,59 +2031,58 @@ def mask_volume(regions, volume) :
     return nv
 
 
-def mask_data(regions, volume) :
+def mask_data(regions, volume, full_size = True, pad = 4) :
 
-    if len(regions) == 0:
-        return None
-
-    smod = regions[0].segmentation
-    mask_size = smod.grid_size()
-    map_size = volume.data.size
-    binned_mask = bin_size(mask_size, map_size)
-    if binned_mask is None:
+    '''
+    Map values inside regions and zero outside, as grid data covering the
+    full map, or the region bounds plus pad grid points if full_size is false.
+    '''
+    mb = masked_block(regions, volume, full_size, pad)
+    if mb is None:
         return None
-
-    vmat = volume.full_matrix()
-    import numpy
-    mmat = numpy.zeros_like ( vmat )
-
-    mask_matrix(regions, vmat, mmat, binned_mask)
+    mmat, ijk0 = mb
 
     import os.path
     name = os.path.splitext ( volume.name )[0] + "_masked"
     d = volume.data
     from chimerax.map_data import ArrayGridData
-    mgrid = ArrayGridData ( mmat, d.origin, d.step, d.cell_angles, name=name)
-
-    #import VolumeViewer
-    #nv = VolumeViewer.volume_from_grid_data ( mgrid, show_data = False,
-    #                                          show_dialog = False )
-    #nv.copy_settings_from(volume)
-    #nv.show()
+    mgrid = ArrayGridData ( mmat, d.ijk_to_xyz(ijk0), d.step, d.cell_angles,
+                            rotation = d.rotation, name=name)
     return mgrid
 
 
 def masked_matrix (regions, volume) :
 
+    mb = masked_block(regions, volume, full_size = True)
+    return None if mb is None else mb[0]
+
+
+def masked_block (regions, volume, full_size = True, pad = 0) :
+
+    '''
+    Map values inside regions with zero outside, cropped to the region bounds
+    plus pad grid points if full_size is false.  Only the cropped part of
+    the map is read.  Returns the matrix and the map grid index (i,j,k) of
+    its first value, or None if the mask and map sizes are incompatible.
+    '''
     if len(regions) == 0:
         return None
 
     smod = regions[0].segmentation
-    mask_size = smod.grid_size()
-    map_size = volume.data.size
-    binned_mask = bin_size(mask_size, map_size)
+    binned_mask = bin_size(smod.grid_size(), volume.data.size)
     if binned_mask is None:
         return None
 
-    vmat = volume.full_matrix()
-    import numpy
-    mmat = numpy.zeros_like ( vmat )
-
-    mask_matrix(regions, vmat, mmat, binned_mask)
-
-    return mmat
-
-
+    d = volume.data
+    if full_size:
+        ijk0, size = (0,0,0), tuple(d.size)
+    else:
+        ijk0, size = map_block_bounds(regions, binned_mask, d.size, pad)
+    m = d.matrix(ijk_origin = ijk0, ijk_size = size)
+    inside = region_grid_mask(regions, ijk0, size, binned_mask)
+    mmat = numpy.zeros(m.shape, m.dtype)
+    numpy.copyto(mmat, m, where = inside)
+    return mmat, ijk0
 
 
 def remove_mask_volume(regions, volume) :
@@ -1787,10 +2098,9 @@ def remove_mask_volume(regions, volume) :
         return None
 
     vmat = volume.full_matrix().copy()
-    import numpy
-    mmat = numpy.zeros_like ( vmat )
-
-    mask_matrix(regions, mmat, vmat, binned_mask)
+    (i0,j0,k0), (si,sj,sk) = ijk0, size = map_block_bounds(regions, binned_mask, map_size)
+    inside = region_grid_mask(regions, ijk0, size, binned_mask)
+    vmat[k0:k0+sk,j0:j0+sj,i0:i0+si][inside] = 0
 
     import os.path
     name = os.path.splitext ( volume.name )[0] + "_imasked"
@@ -1804,28 +2114,64 @@ def remove_mask_volume(regions, volume) :
     return nv
 
 
-
-
 def mask_matrix(regions, from_matrix, to_matrix, binned_mask = (1,1,1)):
 
-    if tuple(binned_mask) == (1,1,1):
-        for reg in regions :
-            pts = reg.points()
-            i,j,k = pts[:,0], pts[:,1], pts[:,2]
-            to_matrix[k,j,i] = from_matrix[k,j,i]
-    else:
-        moff = []
-        b0, b1, b2 = binned_mask
-        for i in range(b0):
-            for j in range(b1):
-                for k in range(b2):
-                    moff.append((from_matrix[k::b2,j::b1,i::b0],
-                                 to_matrix[k::b2,j::b1,i::b0]))
-        for reg in regions :
-            pts = reg.points()
-            i,j,k = pts[:,0], pts[:,1], pts[:,2]
-            for fm, tm in moff:
-                tm[k,j,i] = fm[k,j,i]
+    if len(regions) == 0:
+        return
+    map_size = from_matrix.shape[::-1]
+    (i0,j0,k0), (si,sj,sk) = ijk0, size = map_block_bounds(regions, binned_mask, map_size)
+    inside = region_grid_mask(regions, ijk0, size, binned_mask)
+    block = (slice(k0,k0+sk), slice(j0,j0+sj), slice(i0,i0+si))
+    numpy.copyto(to_matrix[block], from_matrix[block], where = inside)
+
+
+def map_block_bounds(regions, binned_mask, map_size, pad = 0):
+
+    '''
+    Map grid index origin and size of the block covering the union of the
+    region bounds, extended by pad grid points and clipped to the map.
+    '''
+    bmin, bmax = union_bounds([r.bounds() for r in regions])
+    b = numpy.array(binned_mask)
+    lo = numpy.maximum(numpy.array(bmin) * b - pad, 0)
+    hi = numpy.minimum((numpy.array(bmax) + 1) * b + pad, map_size)
+    hi = numpy.maximum(hi, numpy.minimum(lo + 1, map_size))     # Empty regions
+    return tuple(int(x) for x in lo), tuple(int(x) for x in hi - lo)
+
+
+def region_grid_mask(regions, ijk_origin, ijk_size, binned_mask = (1,1,1)):
+
+    '''
+    Boolean array for a block of map grid points that is true where the
+    mask value is a leaf region of the given regions.  Region ids are
+    looked up in a membership table, and a binned mask is expanded over
+    the map grid by broadcasting.
+    '''
+    smod = regions[0].segmentation
+    t = smod.table
+    member = numpy.zeros((smod.max_region_id + 1,), bool)
+    lids = [t.leaf_ids_under(r.rid) for r in regions]
+    member[numpy.concatenate(lids).astype(numpy.intp)] = True
+
+    b = numpy.array(binned_mask)
+    lo = numpy.array(ijk_origin)
+    size = numpy.array(ijk_size)
+    mlo = lo // b
+    mhi = numpy.minimum(-(-(lo + size) // b), smod.grid_size())
+    crop = smod.mask[mlo[2]:mhi[2], mlo[1]:mhi[1], mlo[0]:mhi[0]]
+    inside = member[crop]
+    if tuple(b) != (1,1,1):
+        nk, nj, ni = inside.shape
+        b0, b1, b2 = b
+        inside = numpy.broadcast_to(inside[:,None,:,None,:,None],
+                                    (nk,b2,nj,b1,ni,b0)).reshape((nk*b2,nj*b1,ni*b0))
+
+    # Inside starts at map grid point mlo*b, shift to the block origin.
+    o0, o1, o2 = lo - mlo*b
+    s0, s1, s2 = numpy.maximum(numpy.minimum(size, numpy.array(inside.shape[::-1]) - (o0,o1,o2)), 0)
+    gmask = numpy.zeros(tuple(size[::-1]), bool)
+    gmask[:s2,:s1,:s0] = inside[o2:o2+s2, o1:o1+s1, o0:o0+s0]
+    return gmask
 
 def bin_size(mask_size, map_size):
 
@@ -1858,13 +2204,142 @@ def make_surfaces(regions, surfaces = None, task = None):
 
     if surfaces is None:
         surfaces = []
-    for i,r in enumerate(regions):
-        if task and i%20 == 0:
-            task.updateStatus('%d of %d' % (i+1,len(regions)))
-        surfaces.append(r.make_surface())
+    segs = {}
+    for r in regions:
+        segs.setdefault(id(r.segmentation), []).append(r)
+    for sregs in segs.values():
+        surfaces.extend(sregs[0].segmentation.make_region_surfaces(sregs, task = task))
 
     return surfaces
 
+def region_mesh(points, resolution, transform, scale = 1.0):
+
+    '''
+    Gaussian surface enclosing grid points (i,j,k), in physical coordinates
+    and scaled about the point center.  Returns vertices, normals, triangles.
+    '''
+    if points is None or len(points) == 0:
+        return _empty_mesh()
+    weights = numpy.ones(len(points), numpy.float32)
+    from chimerax.surface import gaussian_surface
+    vertices, normals, triangles, level = \
+        gaussian_surface(points, weights, 3*resolution, level = 0.1)
+    transform.transform_points(vertices, in_place = True)
+    com = points.sum(axis = 0).astype(numpy.float32) / len(points)
+    _scale_mesh(vertices, com, transform, scale)
+    return vertices, normals, triangles
+
+def mask_region_meshes(binned_mask, leaf_ids, bounds, bin_size, transform, scale = 1.0):
+
+    '''
+    Surfaces of the mask voxels of regions, each region given by its leaf
+    ids and grid index bounds, computed in one pass over the mask binned
+    by bin_size.  The surfaces lie halfway between region voxels and other
+    voxels of the binned mask, and touching regions share the vertices of
+    their common boundary.  Regions sharing leaves are done in further
+    passes.  Returns vertices, normals, triangles in physical coordinates
+    for each region.
+    '''
+    b = max(1, int(round(bin_size)))
+    meshes = [_empty_mesh() for l in leaf_ids]
+    todo = [r for r, l in enumerate(leaf_ids) if len(l) > 0 and bounds[r][1][0] >= bounds[r][0][0]]
+    if len(todo) == 0:
+        return meshes
+    lsize = max(int(leaf_ids[r].max()) for r in todo) + 2
+    from .masksurface import label_surfaces
+    from chimerax.surface import calculate_vertex_normals
+    while todo:
+        lut = numpy.zeros((lsize,), numpy.int32)
+        rpass, later = [], []
+        for r in todo:
+            if lut[leaf_ids[r]].any():
+                later.append(r)
+            else:
+                rpass.append(r)
+                lut[leaf_ids[r]] = len(rpass)
+        # Binned grid box containing the regions.
+        lo = numpy.min([bounds[r][0] for r in rpass], axis = 0) // b
+        hi = numpy.max([bounds[r][1] for r in rpass], axis = 0) // b
+        (i0,j0,k0), (i1,j1,k1) = lo, hi
+        crop = binned_mask[k0:k1+1, j0:j1+1, i0:i1+1]
+        if lsize <= numpy.iinfo(crop.dtype).max:
+            crop = numpy.minimum(crop, crop.dtype.type(lsize-1))
+        labels = lut[crop]
+        k, j, i = numpy.nonzero(labels)
+        l = labels[k,j,i]
+        n = numpy.bincount(l, minlength = len(rpass)+1)
+        centers = numpy.stack([numpy.bincount(l, weights = c, minlength = len(rpass)+1)
+                               for c in (i, j, k)], axis = 1)
+        # Binned grid point centers in unbinned grid index units.
+        offset = lo.astype(numpy.float32) * b + 0.5*(b-1)
+        surfs = label_surfaces(labels, len(rpass))
+        for s, r in enumerate(rpass):
+            vertices, triangles = surfs[s]
+            if len(triangles) == 0:
+                continue
+            vertices *= b
+            vertices += offset
+            transform.transform_points(vertices, in_place = True)
+            com = centers[s+1] / n[s+1] * b + offset
+            _scale_mesh(vertices, com, transform, scale)
+            normals = calculate_vertex_normals(vertices, triangles)
+            meshes[r] = (vertices, normals, triangles)
+        todo = later
+    return meshes
+
+def _scale_mesh(vertices, center, transform, scale):
+
+    '''Scale vertices about a grid index center point, in place.'''
+    if abs(scale - 1.0) > 0.01:
+        com = numpy.array(center, numpy.float32).reshape((1,3))
+        transform.transform_points(com, in_place = True)
+        vertices -= com
+        vertices *= scale
+        vertices += com
+
+def _empty_mesh():
+
+    from numpy import zeros, float32, int32
+    return zeros((0,3), float32), zeros((0,3), float32), zeros((0,3), int32)
+
+class MeshCache:
+
+    '''
+    Least recently used cache of region surface meshes.  Keys identify the
+    leaf regions, surface resolution and scale so showing, hiding and
+    regrouping regions reuses meshes.  Meshes are dropped when the total
+    triangle count exceeds max_triangles.
+    '''
+
+    def __init__(self, max_triangles = 10000000):
+
+        from collections import OrderedDict
+        self._meshes = OrderedDict()
+        self._triangles = 0
+        self.max_triangles = max_triangles
+
+    def __len__(self):
+        return len(self._meshes)
+
+    def get(self, key):
+        m = self._meshes.get(key)
+        if m is not None:
+            self._meshes.move_to_end(key)
+        return m
+
+    def add(self, key, mesh):
+        if key in self._meshes:
+            self._triangles -= len(self._meshes.pop(key)[2])
+        self._meshes[key] = mesh
+        self._triangles += len(mesh[2])
+        while self._triangles > self.max_triangles and len(self._meshes) > 1:
+            k, m = self._meshes.popitem(last = False)
+            self._triangles -= len(m[2])
+
+    def clear(self):
+        self._meshes.clear()
+        self._triangles = 0
+
 def show_only_regions(rlist):
 
     segs = [r.segmentation for r in rlist]
@@ -1930,13 +2405,10 @@ def union_bounds(bounds):
 #
 def boundary_regions(rset, rcons):
 
-    bset = set()
-    for r in rset:
-        if r in rcons:
-            for b in rcons[r]:
-                if not b in rset:
-                    bset.add(b)
-    return bset
+    if len(rset) == 0:
+        return set()
+    ids = numpy.array([r.rid for r in rset], numpy.int32)
+    return set(rcons.segmentation.regions_for_ids(rcons.boundary_ids(ids)))
 
 # -----------------------------------------------------------------------------
 #
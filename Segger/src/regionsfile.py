@@ -34,10 +34,7 @@ def ReadRegionsFile ( regions_file_path, dmap, smod = None) :
 
     regions, groups, at = ParseRegions ( e, smod )
 
-    smod.regions = set(groups)
-    smod.id_to_region = regions
-
-    smod.rcons = ParseContacts(e, at, regions)
+    smod.rcons = ParseContacts(e, at, regions, smod)
 
     return smod
 
@@ -48,6 +45,7 @@ def ParseRegions ( e, smod ) :
     nregions = int ( e[0] )
     print(" - reading %d regions..." % nregions)
     at = 1
+    smod.ensure_mask_range(nregions)
 
     regs = {}
     all_regions = {}            # Includes groups.
@@ -86,7 +84,6 @@ def ParseRegions ( e, smod ) :
         regs [ reg.rid ] = reg
 
         last_reg = reg
-        reg.preg = None
 
         for pi in parents :
 
@@ -97,15 +94,14 @@ def ParseRegions ( e, smod ) :
                 preg.max_point = rpoints[0]
                 all_regions[pi] = preg
 
-            last_reg.preg = preg
-
-            if preg.cregs.count ( last_reg ) == 0 :
-                preg.cregs.append ( last_reg )
+            last_reg.preg = preg        # Adds to parent child list.
 
             last_reg = preg
 
 
 
+    smod.mask_changed()
+
     # Regions table only includes top level groups.
     groups = [ reg for reg in list(all_regions.values()) if reg.preg is None ]
 
@@ -113,7 +109,7 @@ def ParseRegions ( e, smod ) :
 
 
 
-def ParseContacts ( e, at, regs ):
+def ParseContacts ( e, at, regs, smod ):
 
     from . import regions
     importlib.reload (regions)
@@ -124,7 +120,7 @@ def ParseContacts ( e, at, regs ):
         ncon = 0
 
     at += 1
-    rcons = {}
+    cm = numpy.zeros ( (0, 4), numpy.float32 )
 
     if ncon > 0 :
 
@@ -133,29 +129,20 @@ def ParseContacts ( e, at, regs ):
         am = e [ at : at + (ncon*4) ]
         cm = numpy.reshape ( am, (ncon, 4) )
 
-        for i in range ( ncon ) :
-            c = cm[i]
-            rid1, rid2 = int(c[0]), int(c[1])
-            #from regions import Contact
-            o = regions.Contact(c[2])
-            o.D = c[3]
-
-            try : r1 = regs[rid1]
-            except : print("File error: contact region id", rid1); continue
-            try : r2 = regs[rid2]
-            except : print("File error: contact region id", rid2); continue
-
-            if r1 == r2 : print("File error: self contact id", rid1)
-
-            if not r1 in rcons : rcons[r1] = {}
-            if not r2 in rcons : rcons[r2] = {}
-
-            rcons[r1][r2] = o
-            rcons[r2][r1] = o
+        rids = numpy.array ( list(regs.keys()), numpy.int32 )
+        rid1, rid2 = cm[:,0].astype(numpy.int32), cm[:,1].astype(numpy.int32)
+        for rid in numpy.unique ( numpy.concatenate ( (rid1[~numpy.isin(rid1, rids)],
+                                                       rid2[~numpy.isin(rid2, rids)]) ) ) :
+            print("File error: contact region id", rid)
+        for rid in rid1[rid1 == rid2] :
+            print("File error: self contact id", rid)
+        ok = numpy.isin(rid1, rids) & numpy.isin(rid2, rids) & (rid1 != rid2)
+        cm = cm[ok]
 
     print("")
 
-    return rcons
+    return regions.RegionContacts ( smod, cm[:,0], cm[:,1], numpy.rint(cm[:,2]),
+                                    cm[:,3].astype(numpy.float64) )
 
 
 
@@ -183,12 +170,8 @@ def WriteRegionsFile ( smod, fname = None ) :
         tot_e_size += RegionSize ( region, tot_write_regions )
 
 
-    num_cons = 0
     rcons = smod.region_contacts()
-    for r1, cr1 in rcons.items () :
-        for r2, o in cr1.items () :
-            if r1.rid < r2.rid :
-                num_cons = num_cons + 1
+    num_cons = rcons.count
 
     tot_e_size = tot_e_size + 1 + 4 * (num_cons)
 
@@ -210,19 +193,13 @@ def WriteRegionsFile ( smod, fname = None ) :
     e[e_at] = float ( num_cons )
     e_at = e_at + 1
 
-    #consa = []
-    for r1, cr1 in rcons.items () :
-        for r2, o in cr1.items () :
-            if r1.rid < r2.rid :
-                #consa = consa + [r1.rid, r2.rid, o.N, o.D]
-                e[e_at+0] = float ( r1.rid )
-                e[e_at+1] = float ( r2.rid )
-                e[e_at+2] = o.N
-                e[e_at+3] = o.D
-                e_at = e_at + 4
-
-    #consa = [len(consa)/4] + consa
-    #e = numpy.concatenate ( [ e, numpy.array ( consa, numpy.float32 ) ] )
+    consa = e [ e_at : e_at + 4*num_cons ].reshape ( (num_cons, 4) )
+    consa[:,0] = rcons.r1
+    consa[:,1] = rcons.r2
+    consa[:,2] = rcons.N
+    if rcons.D is not None :
+        consa[:,3] = rcons.D
+    e_at = e_at + 4*num_cons
 
     e.tofile ( fname )
     print("Wrote %s" % os.path.basename(fname))
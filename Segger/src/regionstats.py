@@ -0,0 +1,177 @@
+# -----------------------------------------------------------------------------
+# Map value statistics for every region of a segmentation computed in one
+# pass over the mask and map.  Leaf region values are accumulated with
+# bincount and a sort of each mask slab, then combined for groups using the
+# depth first leaf ranges of the region hierarchy without reading voxels
+# again.  The mask can be binned relative to the map, each mask voxel then
+# covers a block of map voxels.
+#
+import numpy
+from . import timing
+from time import time as clock
+from .log import debug
+
+# -----------------------------------------------------------------------------
+#
+class RegionStatistics:
+
+    '''
+    Arrays indexed by region id of the number of map values, their sum, sum
+    of squares, minimum, maximum and the map grid index (i,j,k) of the
+    maximum.  Regions without values have count 0.
+    '''
+
+    attribute_names = ('map count', 'map sum', 'map mean', 'map sd', 'map min', 'map max')
+
+    def __init__(self, size):
+
+        self.count = numpy.zeros((size,), numpy.int64)
+        self.sum = numpy.zeros((size,), numpy.float64)
+        self.sum2 = numpy.zeros((size,), numpy.float64)
+        self.min = numpy.full((size,), numpy.inf, numpy.float64)
+        self.max = numpy.full((size,), -numpy.inf, numpy.float64)
+        self.max_ijk = numpy.zeros((size,3), numpy.int32)
+
+    @property
+    def mean(self):
+        return self.sum / numpy.maximum(self.count, 1)
+
+    @property
+    def sd(self):
+        n = numpy.maximum(self.count, 1)
+        m = self.sum / n
+        return numpy.sqrt(numpy.maximum(self.sum2 / n - m*m, 0))
+
+    def values(self, rid):
+        '''Dictionary of attribute values for one region id.'''
+        return dict(zip(self.attribute_names, self.row(rid)))
+
+    def row(self, rid):
+        n = int(self.count[rid])
+        if n == 0:
+            return (0, 0.0, 0.0, 0.0, 0.0, 0.0)
+        return (n, float(self.sum[rid]), float(self.mean[rid]), float(self.sd[rid]),
+                float(self.min[rid]), float(self.max[rid]))
+
+    def add_values(self, labels, values, ijk):
+        '''
+        Accumulate map values for nonzero region labels.  Function ijk(f)
+        gives map grid indices for flat indices f into values.
+        '''
+        labels = labels.ravel()
+        values = values.ravel()
+        nz = numpy.flatnonzero(labels)
+        if len(nz) == 0:
+            return
+        lab = labels[nz].astype(numpy.intp)
+        v = values[nz].astype(numpy.float64)
+        n = len(self.count)
+        self.count += numpy.bincount(lab, minlength = n)
+        self.sum += numpy.bincount(lab, weights = v, minlength = n)
+        self.sum2 += numpy.bincount(lab, weights = v*v, minlength = n)
+
+        # Sort by region then value for the minimum and maximum of each region.
+        order = numpy.lexsort((v, lab))
+        lab = lab[order]
+        last = numpy.flatnonzero(numpy.concatenate((lab[1:] != lab[:-1], (True,))))
+        first = numpy.concatenate(((0,), last[:-1] + 1))
+        rid = lab[last]
+        vmin, vmax = v[order[first]], v[order[last]]
+        self.min[rid] = numpy.minimum(self.min[rid], vmin)
+        higher = (vmax > self.max[rid])
+        self.max[rid[higher]] = vmax[higher]
+        self.max_ijk[rid[higher]] = ijk(nz[order[last[higher]]])
+
+    def combine_groups(self, hierarchy, group_ids):
+        '''
+        Set values of group regions from their leaf regions using the leaf
+        ranges of a HierarchyIndex.
+        '''
+        h = hierarchy
+        start, end = h.leaf_first[group_ids], h.leaf_end[group_ids]
+        keep = (end > start)
+        gids, start, end = group_ids[keep], start[keep], end[keep]
+        if len(gids) == 0:
+            return
+        leaves = h.leaves
+        for a in (self.count, self.sum, self.sum2):
+            cs = numpy.concatenate(((0,), numpy.cumsum(a[leaves])))
+            a[gids] = cs[end] - cs[start]
+        self.min[gids] = _range_reduce(numpy.minimum, self.min[leaves], start, end)
+        # Rank leaf maxima so the leaf holding a group maximum is found too.
+        lmax = self.max[leaves]
+        by_value = numpy.argsort(lmax, kind = 'stable')
+        rank = numpy.empty((len(lmax),), numpy.int64)
+        rank[by_value] = numpy.arange(len(lmax))
+        top = by_value[_range_reduce(numpy.maximum, rank, start, end)]
+        self.max[gids] = lmax[top]
+        self.max_ijk[gids] = self.max_ijk[leaves[top]]
+
+# -----------------------------------------------------------------------------
+#
+def _range_reduce(ufunc, a, start, end):
+    '''Reduce a[start[i]:end[i]] for non-empty, possibly nested, ranges.'''
+    a = numpy.concatenate((a, a[:1]))   # End index can be len(a).
+    idx = numpy.empty((2*len(start),), numpy.intp)
+    idx[0::2] = start
+    idx[1::2] = end
+    return ufunc.reduceat(a, idx)[0::2]
+
+# -----------------------------------------------------------------------------
+#
+def region_statistics(segmentation, volume, bin_size = (1,1,1), slab_bytes = 2**26,
+                      task = None):
+    '''
+    Map value statistics of all regions of a segmentation, including
+    groups, as a RegionStatistics indexed by region id.  Bin_size (bi,bj,bk)
+    is the number of map grid points along each axis per mask grid point.
+    The mask is read in z slabs to limit memory use.
+    '''
+    if timing: t0 = clock()
+    s = segmentation
+    mask = s.mask
+    mk, mj, mi = mask.shape
+    b0, b1, b2 = bin_size
+    stats = RegionStatistics(s.max_region_id + 1)
+    vmat = volume.full_matrix()
+
+    step = max(1, slab_bytes // max(1, 8 * mj * mi * b0 * b1 * b2))
+    for z0 in range(0, mk, step):
+        z1 = min(z0 + step, mk)
+        if task:
+            task.updateStatus('Map statistics for mask planes %d-%d of %d' % (z0, z1-1, mk))
+        labels = mask[z0:z1]
+        for i in range(b0):
+            for j in range(b1):
+                for k in range(b2):
+                    v = vmat[z0*b2+k:z1*b2:b2, j::b1, i::b0][:, :mj, :mi]
+                    def ijk(f, z0 = z0, i = i, j = j, k = k):
+                        fz, fy, fx = numpy.unravel_index(f, labels.shape)
+                        return numpy.stack(((fx*b0 + i), (fy*b1 + j), ((fz + z0)*b2 + k)), axis = 1)
+                    stats.add_values(labels, v, ijk)
+
+    t = s.table
+    ids = t.ids()
+    stats.combine_groups(t.hierarchy(), ids[t.nchildren[ids] > 0])
+
+    if timing:
+        debug('Time %.2f: map statistics for %d regions, bin size %d,%d,%d'
+              % (clock()-t0, len(ids), b0, b1, b2))
+    return stats
+
+# -----------------------------------------------------------------------------
+#
+def set_statistics_attributes(segmentation, stats, region_ids = None):
+    '''Save statistics as region attributes shown in the attributes dialog.'''
+    t = segmentation.table
+    ids = t.ids() if region_ids is None else region_ids
+    names = stats.attribute_names
+    cols = [stats.count[ids], stats.sum[ids], stats.mean[ids], stats.sd[ids],
+            stats.min[ids], stats.max[ids]]
+    has = (stats.count[ids] > 0)
+    for row, rid in enumerate(ids.tolist()):
+        if has[row]:
+            a = t.attrib.setdefault(rid, {})
+            a[names[0]] = int(cols[0][row])
+            for name, c in zip(names[1:], cols[1:]):
+                a[name] = float(c[row])
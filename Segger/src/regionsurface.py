@@ -0,0 +1,283 @@
+# -----------------------------------------------------------------------------
+# One surface model holding the meshes of many segmentation regions.  With
+# thousands of regions a child model per region makes drawing, selection and
+# closing slow.  Here each triangle records its region id and showing,
+# hiding, coloring and selecting a region changes slices of the triangle
+# mask, vertex color and highlight arrays.  RegionPiece objects stand in
+# for the per-region surface models used by the rest of Segger.
+#
+import numpy
+
+from chimerax.core.models import Surface
+class RegionsSurface ( Surface ):
+
+    SESSION_SAVE = False        # Segmentation makes surfaces on session restore
+
+    def __init__(self, name, session):
+
+        Surface.__init__(self, name, session)
+        self.pieces = []        # RegionPiece objects in vertex order
+        self.triangle_rids = numpy.zeros((0,), numpy.int32)
+        self._dead_triangles = 0
+        self._geometry_buffers = None
+
+    def add_pieces(self, meshes, colors, rids):
+        '''
+        Append region meshes (vertices, normals, triangles) with 8-bit rgba
+        colors.  Returns a RegionPiece for each mesh.  Meshes are copied into
+        geometry buffers that double in size when full, so adding regions
+        one call at a time does not copy all earlier regions each call.
+        The geometry is set once per call.
+        '''
+        va, na, ta, ca, tm, hm = self._arrays()
+        nv, nt = len(va), len(ta)
+        dv = sum(len(v) for v, n, t in meshes)
+        dt = sum(len(t) for v, n, t in meshes)
+        vb, nb, tb, cb, rb, tmb, hmb = self._buffers((va, na, ta, ca, self.triangle_rids, tm, hm),
+                                                     nv + dv, nt + dt)
+        pieces = []
+        for (v, n, t), color, rid in zip(meshes, colors, rids):
+            v1, t1 = nv + len(v), nt + len(t)
+            pieces.append(RegionPiece(self, rid, nv, v1, nt, t1))
+            vb[nv:v1] = v
+            nb[nv:v1] = n
+            tb[nt:t1] = t
+            tb[nt:t1] += nv
+            cb[nv:v1] = color
+            rb[nt:t1] = rid
+            nv, nt = v1, t1
+        tmb[nt-dt:nt] = True
+        hmb[nt-dt:nt] = False
+        self.pieces.extend(pieces)
+        self._set_arrays(vb[:nv], nb[:nv], tb[:nt], cb[:nv], rb[:nt], tmb[:nt], hmb[:nt])
+        return pieces
+
+    def _buffers(self, arrays, nv, nt):
+        '''
+        Vertex, normal, triangle, color, region id, triangle mask and
+        highlight buffers holding the current arrays with room for nv
+        vertices and nt triangles.  Arrays that are already the start of
+        a buffer are not copied.
+        '''
+        bufs = self._geometry_buffers
+        if bufs is None or len(bufs[0]) < nv or len(bufs[2]) < nt:
+            vsize = max(nv, 2*len(bufs[0]) if bufs else 0, 256)
+            tsize = max(nt, 2*len(bufs[2]) if bufs else 0, 256)
+            bufs = self._geometry_buffers = (
+                numpy.empty((vsize,3), numpy.float32), numpy.empty((vsize,3), numpy.float32),
+                numpy.empty((tsize,3), numpy.int32), numpy.empty((vsize,4), numpy.uint8),
+                numpy.empty((tsize,), numpy.int32), numpy.empty((tsize,), bool),
+                numpy.empty((tsize,), bool))
+        for a, b in zip(arrays, bufs):
+            if a.base is not b:
+                b[:len(a)] = a
+        return bufs
+
+    def remove_piece(self, piece):
+        '''
+        Hide the triangles of a removed piece.  The geometry arrays are
+        compacted once half the triangles belong to removed pieces.
+        '''
+        piece.deleted = True
+        self.set_triangles_shown(piece, False)
+        self._dead_triangles += piece.t1 - piece.t0
+        if 2*self._dead_triangles > len(self.triangle_rids):
+            self._compact()
+
+    def renumber(self, new_id):
+        '''Change region ids after the segmentation renumbers regions.'''
+        self.triangle_rids = new_id[self.triangle_rids].astype(numpy.int32)
+        for p in self.pieces:
+            p.rid = int(new_id[p.rid])
+
+    def region_ids(self, shown_only = True):
+        '''Ids of regions with triangles, optionally only shown ones.'''
+        rids = self.triangle_rids
+        if shown_only and self.triangle_mask is not None:
+            rids = rids[self.triangle_mask]
+        return numpy.unique(rids)
+
+    def set_triangles_shown(self, piece, show):
+        tm = self._triangle_mask()
+        tm[piece.t0:piece.t1] = show
+        self.triangle_mask = tm
+
+    def set_vertex_colors(self, piece, colors):
+        vc = self.vertex_colors
+        vc[piece.v0:piece.v1] = colors
+        self.vertex_colors = vc
+
+    def set_highlighted(self, piece, highlight):
+        hm = self.highlighted_triangles_mask
+        if hm is None:
+            hm = numpy.zeros((len(self.triangle_rids),), bool)
+        hm[piece.t0:piece.t1] = highlight
+        self.highlighted_triangles_mask = hm
+
+    def highlighted_pieces(self):
+        hm = self.highlighted_triangles_mask
+        if hm is None:
+            return []
+        return [p for p in self.pieces if hm[p.t0:p.t1].any()]
+
+    def first_intercept(self, mxyz1, mxyz2, exclude = None):
+        '''Pick the region of the closest shown triangle on a line segment.'''
+        if (exclude is not None and exclude(self)) or not self.display or len(self.pieces) == 0:
+            return None
+        tm = self._triangle_mask()
+        shown = numpy.flatnonzero(tm)
+        if len(shown) == 0:
+            return None
+        pinv = self.position.inverse()
+        xyz1, xyz2 = pinv * mxyz1, pinv * mxyz2
+        from chimerax.geometry import closest_triangle_intercept
+        f, t = closest_triangle_intercept(self.vertices, self.triangles[shown], xyz1, xyz2)
+        if f is None:
+            return None
+        t = shown[t]
+        i = numpy.searchsorted([p.t0 for p in self.pieces], t, side = 'right') - 1
+        return PickedRegion(f, self.pieces[i])
+
+    def _triangle_mask(self):
+        tm = self.triangle_mask
+        if tm is None:
+            tm = numpy.ones((len(self.triangle_rids),), bool)
+        return tm
+
+    def _arrays(self):
+        if self.vertices is None:
+            return (numpy.zeros((0,3), numpy.float32), numpy.zeros((0,3), numpy.float32),
+                    numpy.zeros((0,3), numpy.int32), numpy.zeros((0,4), numpy.uint8),
+                    numpy.zeros((0,), bool), numpy.zeros((0,), bool))
+        hm = self.highlighted_triangles_mask
+        if hm is None:
+            hm = numpy.zeros((len(self.triangles),), bool)
+        return (self.vertices, self.normals, self.triangles, self.vertex_colors,
+                self._triangle_mask(), hm)
+
+    def _set_arrays(self, va, na, ta, ca, rids, tm, hm):
+        self.triangle_rids = rids
+        self.set_geometry(va.astype(numpy.float32, copy = False),
+                          na.astype(numpy.float32, copy = False),
+                          ta.astype(numpy.int32, copy = False))
+        self.vertex_colors = ca
+        self.triangle_mask = tm
+        self.highlighted_triangles_mask = hm
+
+    def _compact(self):
+        '''Remove the geometry of removed pieces.'''
+        va, na, ta, ca, tm, hm = self._arrays()
+        keep = [p for p in self.pieces if not p.deleted]
+        vkeep = numpy.zeros((len(va),), bool)
+        tkeep = numpy.zeros((len(ta),), bool)
+        nv = nt = 0
+        for p in keep:
+            vkeep[p.v0:p.v1] = True
+            tkeep[p.t0:p.t1] = True
+            p.v0, p.v1, p.t0, p.t1 = nv, nv + p.v1 - p.v0, nt, nt + p.t1 - p.t0
+            nv, nt = p.v1, p.t1
+        vnew = numpy.cumsum(vkeep, dtype = numpy.int32) - 1
+        self.pieces = keep
+        self._dead_triangles = 0
+        self._set_arrays(va[vkeep], na[vkeep], vnew[ta[tkeep]], ca[vkeep],
+                         self.triangle_rids[tkeep], tm[tkeep], hm[tkeep])
+
+# -----------------------------------------------------------------------------
+#
+class RegionPiece:
+
+    '''
+    The part of a RegionsSurface for one region, with the attributes of a
+    region surface model that Segger uses.
+    '''
+
+    def __init__(self, surface, rid, v0, v1, t0, t1):
+
+        self.surface = surface
+        self.rid = rid
+        self.v0, self.v1, self.t0, self.t1 = v0, v1, t0, t1
+        self.name = str(rid)
+        self.region = None
+        self.deleted = False
+
+    @property
+    def was_deleted(self):
+        return self.deleted or self.surface.deleted
+
+    def delete(self):
+        if not self.deleted and not self.surface.deleted:
+            self.surface.remove_piece(self)
+        self.deleted = True
+
+    def _get_display(self):
+        tm = self.surface.triangle_mask
+        return tm is None or (self.t1 > self.t0 and bool(tm[self.t0]))
+    def _set_display(self, show):
+        if not self.deleted:
+            self.surface.set_triangles_shown(self, show)
+    display = property(_get_display, _set_display)
+
+    def _get_color(self):
+        vc = self.surface.vertex_colors
+        if self.v1 == self.v0 or vc is None:
+            return (255,255,255,255)
+        return tuple(int(c) for c in vc[self.v0])
+    def _set_color(self, color):
+        if not self.deleted:
+            self.surface.set_vertex_colors(self, numpy.array(color, numpy.uint8))
+    color = property(_get_color, _set_color)
+
+    def _get_vertex_colors(self):
+        return self.surface.vertex_colors[self.v0:self.v1]
+    def _set_vertex_colors(self, colors):
+        if colors is None:
+            colors = numpy.array(self.color, numpy.uint8)
+        if not self.deleted:
+            self.surface.set_vertex_colors(self, colors)
+    vertex_colors = property(_get_vertex_colors, _set_vertex_colors)
+
+    def _get_highlighted(self):
+        hm = self.surface.highlighted_triangles_mask
+        return hm is not None and bool(hm[self.t0:self.t1].any())
+    def _set_highlighted(self, highlight):
+        if not self.deleted:
+            self.surface.set_highlighted(self, highlight)
+    highlighted = property(_get_highlighted, _set_highlighted)
+
+    @property
+    def vertices(self):
+        return self.surface.vertices[self.v0:self.v1]
+
+    @property
+    def normals(self):
+        return self.surface.normals[self.v0:self.v1]
+
+    @property
+    def triangles(self):
+        return self.surface.triangles[self.t0:self.t1] - self.v0
+
+# -----------------------------------------------------------------------------
+#
+from chimerax.graphics import Pick
+class PickedRegion ( Pick ):
+
+    def __init__(self, distance, piece):
+
+        Pick.__init__(self, distance)
+        self.piece = piece
+
+    def description(self):
+        p = self.piece
+        return '%s region %s' % (p.surface.parent.name, p.name)
+
+    def drawing(self):
+        return self.piece.surface
+
+    def select(self, mode = 'add'):
+        p = self.piece
+        if mode == 'add':
+            p.highlighted = True
+        elif mode == 'subtract':
+            p.highlighted = False
+        elif mode == 'toggle':
+            p.highlighted = not p.highlighted
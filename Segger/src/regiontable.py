@@ -0,0 +1,635 @@
+# -----------------------------------------------------------------------------
+# Region id mask and region data of a segmentation held in arrays indexed by
+# region id, the region hierarchy index and the mask voxel index.  These use
+# only numpy so they can be used and tested without ChimeraX.
+#
+import numpy
+from . import timing
+from time import time as clock
+from .log import debug
+
+# -----------------------------------------------------------------------------
+#
+class SegmentationMask:
+
+    '''
+    Region id mask and region table of a segmentation.  Mask edits, the
+    mask value type and region renumbering are handled here without
+    ChimeraX models.  Segmentation adds the surface model and map.
+    '''
+
+    def __init__(self, mask = None):
+
+        self.table = RegionTable()      # Per-region data arrays
+        self.max_region_id = 0
+        self._voxel_index = None
+        self._moments = None            # Leaf and all region moments, and hierarchy used.
+        self.merge_tree = None          # Precomputed grouping dendrogram.
+        self.rcons = None               # Leaf region contacts.
+        self.workers = 1                # Processes for watershed and contacts, 0 = all cpus.
+        self._binned_masks = {}         # Mask binned for surfaces, by bin size.
+        self._mask = mask
+
+    def _get_mask(self):
+        return self._mask
+    def _set_mask(self, mask):
+        self._mask = mask
+        self.mask_changed()
+    mask = property(_get_mask, _set_mask)
+
+    def mask_changed(self):
+        '''Discard data computed from mask values after the mask is edited.'''
+        self._voxel_index = None
+        self._moments = None
+        self._binned_masks = {}
+        self.merge_tree = None
+        self.contacts_changed()
+
+    def memory_map_mask(self, path = None):
+        '''
+        Move the mask to a memory mapped file, at path or a temporary file,
+        so only the parts in use are held in memory.
+        '''
+        m = self.mask
+        if m is None or isinstance(m, numpy.memmap):
+            return
+        from .watershed import mask_array, copy_planes
+        self._mask = copy_planes(m, mask_array(m.shape, path, m.dtype))
+
+    def relabel_mask(self, lut):
+        '''
+        Replace each mask value v by lut[v] in one pass over the mask, a
+        value of 0 deletes voxels.  The table must have an entry for every
+        mask value.  Region data computed from the mask is discarded.
+        '''
+        lut = numpy.asarray(lut)
+        if len(lut) > 0:
+            self.ensure_mask_range(int(lut.max()))
+        relabel(self.mask, lut)
+        self.mask_changed()
+
+    def ensure_mask_range(self, max_id):
+        '''Promote a uint16 mask to uint32 before writing region ids above 65535.'''
+        m = self.mask
+        if m is not None and max_id > numpy.iinfo(m.dtype).max:
+            if isinstance(m, numpy.memmap):
+                from .watershed import mask_array, copy_planes
+                self._mask = copy_planes(m, mask_array(m.shape, dtype = numpy.uint32))
+            else:
+                self._mask = m.astype(numpy.uint32)
+
+    def compact_mask(self):
+        '''
+        Store the mask as uint16 when there are at most 65535 leaf regions,
+        renumbering regions first if leaf ids are larger.  Memory mapped
+        masks are left as is.  Returns the new id for each old region id
+        if regions were renumbered, otherwise None.
+        '''
+        m = self.mask
+        if m is None or m.dtype == numpy.uint16 or isinstance(m, numpy.memmap):
+            return None
+        t = self.table
+        ids = t.ids()
+        lids = ids[t.in_mask[ids]]
+        if len(lids) > 65535:
+            return None
+        new_id = None
+        if len(lids) > 0 and lids[-1] > 65535:
+            new_id = self.renumber_regions()
+        self._mask = self.mask.astype(numpy.uint16)
+        return new_id
+
+    def renumber_regions(self):
+        '''
+        Number leaf regions in the mask 1 to n in order of their current ids
+        followed by the other regions.  Region ids in the table and mask
+        change, and the merge tree is kept with its base region ids
+        renumbered.  Returns the array of new ids indexed by old id, 0 for
+        unused ids.
+        '''
+        t = self.table
+        ids = t.ids()
+        leaf = t.in_mask[ids]
+        order = numpy.concatenate((ids[leaf], ids[~leaf]))
+        new_id = numpy.zeros((t.size,), numpy.int32)
+        new_id[order] = numpy.arange(1, len(order)+1, dtype = numpy.int32)
+        t.renumber(new_id)
+        self.max_region_id = len(order)
+        self.ensure_mask_range(int(leaf.sum()))
+        relabel(self.mask, new_id)
+        tree = self.merge_tree
+        self.mask_changed()
+        if tree is not None:
+            tree.base_ids = new_id[tree.base_ids]
+            self.merge_tree = tree
+        return new_id
+
+    def voxel_index(self):
+        '''Mask voxel positions grouped by region id, built once per mask.'''
+        if self._voxel_index is None:
+            if timing: t0 = clock()
+            self._voxel_index = VoxelIndex(self.mask)
+            if timing:
+                debug('Time %.2f: voxel index for %d voxels' % (clock()-t0, len(self._voxel_index.voxels)))
+        return self._voxel_index
+
+    def binned_mask(self, bin_size):
+        '''Mask binned on a grid aligned to the whole mask, kept until the mask changes.'''
+        b = max(1, int(round(bin_size)))
+        bm = self._binned_masks.get(b)
+        if bm is None:
+            if timing: t0 = clock()
+            from .masksurface import binned_mask
+            bm = self._binned_masks[b] = binned_mask(self.mask, b)
+            if timing:
+                debug('Time %.2f: mask binned by %d' % (clock()-t0, b))
+        return bm
+
+    def erase_region_voxels(self, rids):
+        '''
+        Set the mask to zero for leaf regions.  Contacts of the erased
+        regions are dropped without recomputing the other contacts.
+        '''
+        if len(rids) == 0:
+            return
+        self._binned_masks = {}
+        vi = self._voxel_index
+        if vi is None:
+            # One lookup table pass over the mask, no voxel index needed.
+            lut = numpy.arange(self.max_region_id + 1, dtype = numpy.uint32)
+            lut[numpy.asarray(rids, numpy.int64)] = 0
+            relabel(self.mask, lut)
+        else:
+            f = [vi.region_voxels(rid) for rid in rids]
+            self.mask.put(numpy.concatenate(f), 0)
+            for rid in rids:
+                vi.remove_region(rid)
+        if self.rcons is not None:
+            self.rcons.remove_regions(rids)
+
+    def calculate_region_bounds(self):
+
+        from .parallel import region_bounds
+        b = region_bounds(self.mask)
+        t = self.table
+        ids = t.leaf_ids()
+        ids = ids[t.in_mask[ids]]
+        npts = numpy.zeros((len(ids),), numpy.int64)
+        inb = (ids < len(b))
+        npts[inb] = b[ids[inb],6]
+        t.npoints[ids] = npts
+        t.bounds[ids] = (1,1,1,0,0,0)           # Not found in mask
+        found = ids[npts > 0]
+        t.bounds[found] = b[found,:6]
+        t.has_bounds[ids] = True
+
+    def contacts_changed(self):
+
+        self.rcons = None
+
+# -----------------------------------------------------------------------------
+#
+class RegionTable:
+
+    '''
+    Region data for a segmentation held in arrays indexed by region id.
+    Watershed segmentation can produce hundreds of thousands of regions so
+    Region objects are only thin proxies created on demand.  Child lists are
+    kept as doubly linked lists through the first/last child and sibling
+    arrays.  A parent id of 0 means a region is a top level region.
+    '''
+
+    # Column name, per-region shape, type, initial value.
+    columns = (('exists', (), numpy.bool_, False),
+               ('in_mask', (), numpy.bool_, False),   # Leaf region id used in mask.
+               ('placed', (), numpy.bool_, False),
+               ('parent', (), numpy.int32, 0),
+               ('first_child', (), numpy.int32, 0),
+               ('last_child', (), numpy.int32, 0),
+               ('next_sibling', (), numpy.int32, 0),
+               ('prev_sibling', (), numpy.int32, 0),
+               ('nchildren', (), numpy.int32, 0),
+               ('max_point', (3,), numpy.int32, 0),   # Local maximum grid index.
+               ('has_max_point', (), numpy.bool_, False),
+               ('color', (4,), numpy.float32, 1),     # Rgba 0-1 values.
+               ('smoothing_level', (), numpy.float32, 0),
+               ('npoints', (), numpy.int64, -1),      # -1 means not computed.
+               ('bounds', (6,), numpy.int32, 0),      # imin,jmin,kmin,imax,jmax,kmax
+               ('has_bounds', (), numpy.bool_, False),
+               )
+
+    def __init__(self, size = 1):
+
+        self.size = 0
+        self.top_count = 0
+        self.surfaces = {}      # Region id to displayed Surface.
+        self.attrib = {}        # Region id to dictionary of user attributes.
+        self.extras = {}        # Region id to dictionary of other attributes.
+        self._hierarchy = None  # HierarchyIndex, rebuilt after structure changes.
+        for name, shape, dtype, fill in self.columns:
+            setattr(self, name, None)
+        self.reserve(size)
+
+    def reserve(self, size):
+
+        n = self.size
+        if size <= n:
+            return
+        size = max(size, 2*n)
+        for name, shape, dtype, fill in self.columns:
+            a = numpy.full((size,) + shape, fill, dtype)
+            old = getattr(self, name)
+            if old is not None:
+                a[:n] = old
+            setattr(self, name, a)
+        self.size = size
+
+    def has_region(self, rid):
+
+        return rid > 0 and rid < self.size and self.exists[rid]
+
+    def count(self):
+
+        return int(self.exists.sum())
+
+    def ids(self):
+
+        return numpy.nonzero(self.exists)[0].astype(numpy.int32)
+
+    def top_ids(self):
+
+        return numpy.nonzero(self.exists & (self.parent == 0))[0].astype(numpy.int32)
+
+    def leaf_ids(self):
+
+        return numpy.nonzero(self.exists & (self.nchildren == 0))[0].astype(numpy.int32)
+
+    def hierarchy(self):
+
+        '''Nested set index of the current region hierarchy.'''
+        if self._hierarchy is None:
+            self._hierarchy = HierarchyIndex(self)
+        return self._hierarchy
+
+    def top_parents(self):
+
+        '''Array giving the top level region id for each region id.'''
+        if self._hierarchy is not None:
+            return self._hierarchy.top
+        p = self.parent[:self.size]
+        top = numpy.arange(self.size, dtype = numpy.int32)
+        top = numpy.where(p > 0, p, top)
+        # Pointer jumping, doubles the distance covered each pass.
+        while True:
+            up = top[top]
+            if (up == top).all():
+                break
+            top = up
+        return top
+
+    def leaf_ids_under(self, rid):
+
+        '''Ids of regions without children below a region, depth first.'''
+        return self.hierarchy().leaves_under(rid)
+
+    def child_ids(self, rid):
+
+        cids = []
+        c = self.first_child[rid]
+        while c:
+            cids.append(c)
+            c = self.next_sibling[c]
+        return cids
+
+    def add_leaf_regions(self, ids, max_points):
+
+        self.reserve(ids.max()+1 if len(ids) else 1)
+        self.exists[ids] = True
+        self.in_mask[ids] = True
+        self.max_point[ids] = max_points
+        self.has_max_point[ids] = True
+        self.color[ids] = random_colors(len(ids))
+        self.top_count += len(ids)
+        self._hierarchy = None
+
+    def add_region(self, rid, max_point = None, child_ids = (), color = None):
+
+        self.reserve(rid+1)
+        self.exists[rid] = True
+        self.in_mask[rid] = (len(child_ids) == 0)
+        if max_point is not None:
+            self.max_point[rid] = max_point
+            self.has_max_point[rid] = True
+        self.color[rid] = random_color() if color is None else color
+        self.top_count += 1
+        self._hierarchy = None
+        for c in child_ids:
+            self.set_parent(c, rid)
+
+    def remove_region(self, rid):
+
+        if not self.has_region(rid):
+            return
+
+        for c in self.child_ids(rid):
+            self.parent[c] = self.next_sibling[c] = self.prev_sibling[c] = 0
+            self.top_count += 1
+        self.first_child[rid] = self.last_child[rid] = self.nchildren[rid] = 0
+        self.set_parent(rid, 0)
+        self.top_count -= 1
+
+        for name, shape, dtype, fill in self.columns:
+            getattr(self, name)[rid] = fill
+        for d in (self.surfaces, self.attrib, self.extras):
+            d.pop(rid, None)
+        self._hierarchy = None
+
+    def set_parent(self, rid, pid):
+
+        old = self.parent[rid]
+        if old == pid:
+            return
+        self._hierarchy = None
+
+        if old:
+            # Unlink from old parent child list.
+            p, n = self.prev_sibling[rid], self.next_sibling[rid]
+            if p:
+                self.next_sibling[p] = n
+            else:
+                self.first_child[old] = n
+            if n:
+                self.prev_sibling[n] = p
+            else:
+                self.last_child[old] = p
+            self.nchildren[old] -= 1
+            self.next_sibling[rid] = self.prev_sibling[rid] = 0
+        else:
+            self.top_count -= 1
+
+        self.parent[rid] = pid
+        if pid:
+            # Append to new parent child list.
+            last = self.last_child[pid]
+            if last:
+                self.next_sibling[last] = rid
+                self.prev_sibling[rid] = last
+            else:
+                self.first_child[pid] = rid
+            self.last_child[pid] = rid
+            self.nchildren[pid] += 1
+        else:
+            self.top_count += 1
+
+    def relink_children(self):
+
+        '''Rebuild child lists and top level count from the parent array.'''
+        for name in ('first_child', 'last_child', 'next_sibling',
+                     'prev_sibling', 'nchildren'):
+            getattr(self, name)[:] = 0
+
+        ids = numpy.nonzero(self.exists & (self.parent > 0))[0].astype(numpy.int32)
+        pids = self.parent[ids]
+        order = numpy.lexsort((ids, pids))
+        ids, pids = ids[order], pids[order]
+        if len(ids) > 0:
+            same = (pids[1:] == pids[:-1])
+            first = numpy.concatenate(((True,), ~same))
+            last = numpy.concatenate((~same, (True,)))
+            self.first_child[pids[first]] = ids[first]
+            self.last_child[pids[last]] = ids[last]
+            self.next_sibling[ids[:-1][same]] = ids[1:][same]
+            self.prev_sibling[ids[1:][same]] = ids[:-1][same]
+            self.nchildren[:] = numpy.bincount(pids, minlength = self.size)[:self.size]
+        self.top_count = int((self.exists & (self.parent == 0)).sum())
+        self._hierarchy = None
+
+    def renumber(self, new_id):
+
+        '''Change region ids, new_id[old id] is the new id of each region.'''
+        ids = self.ids()
+        nids = new_id[ids]
+        pmap = numpy.concatenate(((0,), new_id[1:])).astype(numpy.int32)
+        old = dict((name, getattr(self, name)) for name, shape, dtype, fill in self.columns)
+        for name, shape, dtype, fill in self.columns:
+            setattr(self, name, None)
+        self.size = 0
+        self.reserve(int(nids.max())+1 if len(nids) else 1)
+        for name, shape, dtype, fill in self.columns:
+            getattr(self, name)[nids] = old[name][ids]
+        self.parent[nids] = pmap[old['parent'][ids]]
+        for name in ('surfaces', 'attrib', 'extras'):
+            d = getattr(self, name)
+            setattr(self, name, dict((int(new_id[rid]), v) for rid, v in d.items()))
+        self.relink_children()
+
+    def take_state(self):
+
+        ids = self.ids()
+        state = {'ids': ids}
+        for name in ('in_mask', 'placed', 'parent', 'max_point', 'has_max_point',
+                     'color', 'smoothing_level', 'npoints', 'bounds', 'has_bounds'):
+            state[name] = getattr(self, name)[ids]
+        shown = numpy.zeros((len(ids),), numpy.bool_)
+        scolor = numpy.zeros((len(ids),4), numpy.uint8)
+        surfs = [(rid, sp) for rid, sp in self.surfaces.items() if not sp.deleted]
+        if surfs:
+            rows = numpy.searchsorted(ids, [rid for rid, sp in surfs])
+            shown[rows] = True
+            scolor[rows] = [sp.color for rid, sp in surfs]
+        state['shown'] = shown
+        state['surface_color'] = scolor
+        return state
+
+    def set_state(self, state):
+
+        ids = state['ids']
+        self.reserve(ids.max()+1 if len(ids) else 1)
+        self.exists[ids] = True
+        for name, shape, dtype, fill in self.columns:
+            if name in state:
+                getattr(self, name)[ids] = state[name]
+        self.relink_children()
+
+# -----------------------------------------------------------------------------
+#
+class HierarchyIndex:
+
+    '''
+    Nested set numbering of a region hierarchy.  Regions are laid out in
+    depth first order so the regions under region r are
+    order[first[r]:end[r]] and the regions without children under r are
+    leaves[leaf_first[r]:leaf_end[r]].  Region a is an ancestor of d when
+    first[a] < first[d] < end[a].  Built without recursion so deep
+    grouping chains are fine.
+    '''
+
+    def __init__(self, table):
+
+        t = table
+        size = t.size
+        first = [0]*size
+        end = [0]*size
+        lfirst = [0]*size
+        lend = [0]*size
+        order = []
+        leaves = []
+        first_child = t.first_child.tolist()
+        next_sibling = t.next_sibling.tolist()
+        # Stack of region ids, with ~rid marking the end of a region.
+        stack = t.top_ids().tolist()[::-1]
+        while stack:
+            r = stack.pop()
+            if r < 0:
+                r = ~r
+                end[r] = len(order)
+                lend[r] = len(leaves)
+                continue
+            first[r] = len(order)
+            lfirst[r] = len(leaves)
+            order.append(r)
+            c = first_child[r]
+            if c:
+                stack.append(~r)
+                cids = []
+                while c:
+                    cids.append(c)
+                    c = next_sibling[c]
+                stack.extend(cids[::-1])
+            else:
+                leaves.append(r)
+                end[r] = len(order)
+                lend[r] = len(leaves)
+
+        self.order = numpy.array(order, numpy.int32)
+        self.leaves = numpy.array(leaves, numpy.int32)
+        self.first = numpy.array(first, numpy.int32)
+        self.end = numpy.array(end, numpy.int32)
+        self.leaf_first = numpy.array(lfirst, numpy.int32)
+        self.leaf_end = numpy.array(lend, numpy.int32)
+
+        # Top level region of each region id, computed in depth first order.
+        top = numpy.arange(size, dtype = numpy.int32)
+        tids = t.top_ids()
+        n = self.end[tids] - self.first[tids]
+        top[self.order] = numpy.repeat(tids, n)
+        self.top = top
+
+    def regions_under(self, rid):
+        '''Ids of a region and all regions below it, depth first.'''
+        return self.order[self.first[rid]:self.end[rid]]
+
+    def leaves_under(self, rid):
+        '''Ids of regions without children below a region, depth first.'''
+        return self.leaves[self.leaf_first[rid]:self.leaf_end[rid]]
+
+    def is_ancestor(self, a, d):
+        '''True if region a is above region d.'''
+        return self.first[a] < self.first[d] < self.end[a]
+
+# -----------------------------------------------------------------------------
+#
+class VoxelIndex:
+
+    '''
+    Mask voxels grouped by region id in compressed sparse row layout.
+    The flat mask indices of the voxels of region id r are
+    voxels[start[r]:end[r]], in mask order.  Built with one stable sort
+    of the nonzero mask values so region point lookups do not scan the mask.
+    '''
+
+    def __init__(self, mask):
+
+        self.shape = mask.shape
+        m = mask.ravel()
+        nz = numpy.flatnonzero(m)
+        ids = m[nz]
+        order = numpy.argsort(ids, kind = 'stable')
+        itype = numpy.int32 if m.size < 2**31 else numpy.int64
+        self.voxels = nz[order].astype(itype)
+        counts = numpy.bincount(ids) if len(ids) > 0 else numpy.zeros((1,), numpy.int64)
+        self.end = numpy.cumsum(counts)
+        self.start = self.end - counts
+
+    def region_voxels(self, rid):
+
+        if rid >= len(self.start):
+            return self.voxels[:0]
+        return self.voxels[self.start[rid]:self.end[rid]]
+
+    def region_size(self, rid):
+
+        return self.end[rid] - self.start[rid] if rid < len(self.start) else 0
+
+    def remove_region(self, rid):
+
+        if rid < len(self.start):
+            self.end[rid] = self.start[rid]
+
+    def points(self, rids):
+
+        '''Grid indices (i,j,k) of voxels of the given region ids.'''
+        if len(rids) == 1:
+            f = self.region_voxels(rids[0])
+        else:
+            f = numpy.concatenate([self.region_voxels(rid) for rid in rids])
+        return self.grid_points(f)
+
+    def grid_points(self, f):
+
+        ksz, jsz, isz = self.shape
+        p = numpy.empty((len(f),3), numpy.int32)
+        k, ij = numpy.divmod(f, jsz*isz)
+        p[:,2] = k
+        p[:,1], p[:,0] = numpy.divmod(ij, isz)
+        return p
+
+# -----------------------------------------------------------------------------
+#
+def relabel(array, lut, out = None, chunk_bytes = 2**22, threads = None):
+    '''
+    Replace each value v of a 3-d integer array by lut[v], writing in place
+    unless out is given.  Slabs of z planes are done in a thread pool since
+    numpy.take releases the Python global lock.
+    '''
+    if out is None:
+        out = array
+    lut = numpy.asarray(lut, out.dtype)
+    nz = array.shape[0]
+    step = max(1, chunk_bytes // max(1, array[:1].nbytes))
+    def relabel_planes(z):
+        numpy.take(lut, array[z:z+step], out = out[z:z+step], mode = 'clip')
+    zs = range(0, nz, step)
+    if threads is None:
+        import os
+        threads = min(8, os.cpu_count() or 1)
+    if threads > 1 and len(zs) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers = threads) as pool:
+            list(pool.map(relabel_planes, zs))
+    else:
+        for z in zs:
+            relabel_planes(z)
+    return out
+
+# -----------------------------------------------------------------------------
+#
+def random_colors(n):
+
+    c = numpy.ones((n,4), numpy.float32)
+    c[:,:3] = 0.5*(1 + numpy.random.random((n,3)))
+    return c
+
+# -----------------------------------------------------------------------------
+#
+def random_color(avoid_rgba = None, minimum_rgba_distance = 0.2):
+
+    from random import random as rand
+    while True:
+        c = ( 0.5*(1+rand()), 0.5*(1+rand()), 0.5*(1+rand()), 1.0 )
+        if avoid_rgba is None:
+            break
+        d = sum([(x0-x1)*(x0-x1) for x0,x1 in zip(c, avoid_rgba)])
+        if d > minimum_rgba_distance * minimum_rgba_distance:
+            break
+    return c
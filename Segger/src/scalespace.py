@@ -0,0 +1,109 @@
+# -----------------------------------------------------------------------------
+# Gaussian smoothing of a map at a series of widths using one Fourier
+# transform of the map.  Each smoothing multiplies the transform by the
+# Gaussian transfer function and transforms back, so the cost does not
+# grow with the smoothing width as direct convolution does.
+#
+import numpy
+
+# -----------------------------------------------------------------------------
+#
+class GaussianScaleSpace:
+
+    '''
+    Smoothings of a 3-d array by Gaussians of different widths (in voxels)
+    up to max_sdev.  The array is zero padded by cutoff standard deviations
+    so the result matches convolution with zero values outside the array
+    instead of wrapping around.  Uses scipy.fft with the given number of
+    threads if available, otherwise numpy.fft.  The transform is held in
+    single precision either way.  NumPy before 2.0 computes Fourier
+    transforms in double precision, so then the transforms are done one
+    axis at a time over planes cast to complex64 as they are done, with
+    only one plane held in double precision.
+    '''
+
+    def __init__(self, array, max_sdev, cutoff = 5, threads = None):
+
+        self.shape = array.shape
+        rfftn, self._irfftn, fast_size, self._fft_args = _fft_functions(threads)
+        pad = [min(int(numpy.ceil(cutoff * max_sdev)), s) for s in array.shape]
+        pshape = tuple(fast_size(s + p) for s, p in zip(array.shape, pad))
+        self.padded_shape = pshape
+
+        a = numpy.zeros(pshape, numpy.float32)
+        k, j, i = array.shape
+        a[:k,:j,:i] = array
+        self.spectrum = rfftn(a, **self._fft_args)
+        del a
+
+        # Squared frequencies along each axis, last axis is halved by rfftn.
+        self._f2 = (numpy.fft.fftfreq(pshape[0])**2,
+                    numpy.fft.fftfreq(pshape[1])**2,
+                    numpy.fft.rfftfreq(pshape[2])**2)
+
+        self._product = numpy.empty_like(self.spectrum)
+        self._smoothed = numpy.empty(self.shape, numpy.float32)
+
+    def smoothed(self, sdev):
+
+        '''
+        Array smoothed by a Gaussian with standard deviation sdev voxels,
+        a single value or one per axis in i,j,k order.  The returned float32
+        array is reused by the next call.
+        '''
+        if numpy.isscalar(sdev):
+            sdev = (sdev, sdev, sdev)
+        si, sj, sk = sdev
+        gk, gj, gi = [numpy.exp(-2 * numpy.pi**2 * s**2 * f2).astype(numpy.float32)
+                      for s, f2 in zip((sk, sj, si), self._f2)]
+        p = self._product
+        numpy.multiply(self.spectrum, gk[:,None,None], out = p)
+        p *= gj[None,:,None]
+        p *= gi[None,None,:]
+        r = self._irfftn(p, s = self.padded_shape, **self._fft_args)
+        k, j, i = self.shape
+        numpy.copyto(self._smoothed, r[:k,:j,:i], casting = 'unsafe')
+        return self._smoothed
+
+# -----------------------------------------------------------------------------
+#
+def _fft_functions(threads = None):
+
+    try:
+        from scipy import fft
+    except ImportError:
+        fft = None
+
+    if fft is None:
+        if numpy.fft.rfft(numpy.zeros((2,), numpy.float32)).dtype == numpy.complex64:
+            return (numpy.fft.rfftn, numpy.fft.irfftn, lambda n: n, {'axes': (0,1,2)})
+        return (_rfftn_planes, _irfftn_planes, lambda n: n, {})
+
+    if threads is None:
+        import os
+        threads = os.cpu_count() or 1
+    return fft.rfftn, fft.irfftn, fft.next_fast_len, {'workers': threads}
+
+# -----------------------------------------------------------------------------
+# Real 3-d Fourier transforms kept in complex64 with a numpy.fft that
+# computes in double precision.  Each plane is transformed and cast back.
+#
+def _rfftn_planes(a):
+
+    ks, js, i_s = a.shape
+    f = numpy.empty((ks, js, i_s//2 + 1), numpy.complex64)
+    for k in range(ks):
+        f[k] = numpy.fft.fft(numpy.fft.rfft(a[k], axis = 1), axis = 0)
+    for j in range(js):
+        f[:,j,:] = numpy.fft.fft(f[:,j,:], axis = 0)
+    return f
+
+def _irfftn_planes(f, s):
+    '''Inverse of _rfftn_planes(), overwrites f.'''
+    ks, js, i_s = s
+    for j in range(js):
+        f[:,j,:] = numpy.fft.ifft(f[:,j,:], axis = 0)
+    a = numpy.empty(s, numpy.float32)
+    for k in range(ks):
+        a[k] = numpy.fft.irfft(numpy.fft.ifft(f[k], axis = 0), n = i_s, axis = 1)
+    return a
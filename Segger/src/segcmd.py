@@ -18,10 +18,33 @@ def register_segger_command(logger):
             ('save_path', SaveFileNameArg),
             ('format', EnumOf(('mrc', 'cmap'))),
             ('bin_size', Int1or3Arg),
-            ('sequential_ids', BoolArg)],
+            ('sequential_ids', BoolArg),
+            ('compress', BoolArg)],
         synopsis = 'Export mask as mrc file with integer region index values')
     register('segger exportmask', desc, export_mask, logger=logger)
 
+    from chimerax.core.commands import FloatArg, NonNegativeIntArg, PositiveIntArg
+    from chimerax.map import MapArg
+    desc = CmdDesc(
+        required = [('volume', MapArg)],
+        keyword = [
+            ('threshold', FloatArg),
+            ('workers', NonNegativeIntArg),
+            ('slab_planes', PositiveIntArg),
+            ('halo', PositiveIntArg)],
+        synopsis = 'Compute watershed regions of a map, optionally in parallel or in slabs')
+    register('segger segment', desc, segment_map, logger=logger)
+
+    desc = CmdDesc(
+        required = [('segmentation', SegmentationArg)],
+        keyword = [
+            ('merged', BoolArg),
+            ('method', EnumOf(('gaussian', 'mask'))),
+            ('threads', NonNegativeIntArg),
+            ('resolution', FloatArg)],
+        synopsis = 'Set how region surfaces are computed and drawn')
+    register('segger surfaces', desc, region_surfaces, logger=logger)
+
 # -----------------------------------------------------------------------------
 #
 from chimerax.core.commands import ModelsArg
@@ -80,12 +103,48 @@ def segment_command(cmdname, args):
                           (('savePath', string_arg),
                            ('format', string_arg),
                            ('sequentialIds', bool_arg),
-                           ('binSize', int3_arg))),
+                           ('binSize', int3_arg),
+                           ('compress', bool_arg))),
            }
 
     perform_operation(cmdname, args, ops)
 
 
+# -----------------------------------------------------------------------------
+#
+def segment_map(session, volume, threshold = None, workers = 1,
+                slab_planes = None, halo = 2):
+
+    if threshold is None:
+        threshold = volume.minimum_surface_level
+        if threshold is None:
+            from chimerax.core.errors import UserError
+            raise UserError('Map %s has no surface level, use the threshold option' % volume.name)
+
+    from os.path import splitext
+    from .regions import Segmentation
+    smod = Segmentation(splitext(volume.name)[0] + '.seg', session, volume)
+    session.models.add([smod])
+    smod.workers = workers
+    smod.calculate_watershed_regions(volume, threshold, slab_planes = slab_planes, halo = halo)
+    session.logger.info('Segmented %s at threshold %.5g into %d watershed regions'
+                        % (volume.name, threshold, len(smod.regions)))
+    return smod
+
+# -----------------------------------------------------------------------------
+#
+def region_surfaces(session, segmentation, merged = None, method = None,
+                    threads = None, resolution = None):
+
+    if threads is not None:
+        segmentation.surface_threads = threads
+    if method is not None:
+        segmentation.set_surface_method(method)
+    if resolution is not None:
+        segmentation.change_surface_resolution(resolution)
+    if merged is not None:
+        segmentation.set_merged_surfaces(merged)
+
 # -----------------------------------------------------------------------------
 #
 def copy_groups(from_seg, to_seg):
@@ -142,6 +201,7 @@ def unbin_mask(segmentation, volume):
     seg = Segmentation(name, volume.session, volume)
 
     # Copy mask
+    seg.ensure_mask_range(segmentation.mask.max())
     b2, b1, b0 = bsize
     s2, s1, s0 = [s*b for s, b in zip(ssize, bsize)]
     for o0 in range(b0):
@@ -178,10 +238,12 @@ def copy_regions(regions, bin_size, seg):
 def color_by_direction(segmentation, pattern = 'circle',
                        spherekey = False):
 
-    regions = segmentation.regions
-    from Measure.spine import points_long_axis
-    for region in regions:
-        axis = points_long_axis(region.map_points())
+    regions = list(segmentation.regions)
+    from numpy import array, int32
+    ids = array([r.rid for r in regions], int32)
+    m = segmentation.region_moments()
+    axes = m.long_axes(ids, segmentation.point_transform())
+    for region, axis in zip(regions, axes):
         color = direction_color(axis, pattern)
         region.set_color(color)
 
@@ -310,42 +372,32 @@ def slice_view(**kw):
 
 # -----------------------------------------------------------------------------
 #
-def export_mask(session, segmentation, save_path = None, format = 'mrc',
-                bin_size = (1,1,1), sequential_ids = True):
+def export_mask(session, segmentation, save_path = None, format = None,
+                bin_size = (1,1,1), sequential_ids = True, compress = False):
 
     m = segmentation.mask
     origin = segmentation.grid_origin()
     step = segmentation.grid_step()
 
     # Include only id numbers of top-level region groups.
-    from numpy import zeros, empty
-    parent = zeros((segmentation.max_region_id+1,), dtype = m.dtype)
-    for r in segmentation.all_regions():
-        parent[r.rid] = r.top_parent().rid
+    # Group ids can exceed the range of a uint16 mask.
+    from numpy import zeros, unique, arange, uint16, uint32
+    parent = zeros((segmentation.max_region_id+1,), dtype = uint32)
+    t = segmentation.table
+    ids = t.ids()
+    parent[ids] = t.top_parents()[ids]
     if sequential_ids:
-        used_ids = list(set(parent))
-        used_ids.sort()
-        seq_id = zeros((used_ids[-1]+1,), dtype = m.dtype)
-        for i,id in enumerate(used_ids):
-            seq_id[id] = i
+        used_ids = unique(parent)
+        seq_id = zeros((used_ids[-1]+1,), dtype = uint32)
+        seq_id[used_ids] = arange(len(used_ids))
         parent = seq_id[parent]
-    array = parent[m]
+    value_type = uint16 if parent.max() <= 65535 else uint32
 
-    # Expand array to match unbinned density map size.
+    # Region ids are computed a few planes at a time as the file is written.
     if tuple(bin_size) != (1,1,1):
         step = [s/b for s,b in zip(step,bin_size)]
-        shape = [a*b for a,b in zip(array.shape,bin_size[::-1])]
-        aub = empty(shape, array.dtype)
-        b2, b1, b0 = bin_size
-        for o0 in range(b0):
-            for o1 in range(b1):
-                for o2 in range(b2):
-                    aub[o0::b0,o1::b1,o2::b2] = array
-        array = aub
-
-    from chimerax.map_data import ArrayGridData
-    g = ArrayGridData(array, origin, step)
-    g.name = segmentation.name + ' region ids'
+    g = MaskIdGrid(m, parent.astype(value_type), bin_size, origin, step,
+                   name = segmentation.name + ' region ids')
 
     if save_path is None:
         # Open mask map as a volume.
@@ -353,12 +405,57 @@ def export_mask(session, segmentation, save_path = None, format = 'mrc',
         v = volume_from_grid_data(g, session)
         v.position = segmentation.position
     else:
-        # Write map file.
+        # Write map file, compressed HDF5 for Chimera map format.
+        if format is None:
+            format = 'cmap' if compress else 'mrc'
+        options = {}
+        if compress:
+            if format != 'cmap':
+                from chimerax.core.errors import UserError
+                raise UserError('Compressed mask export needs format cmap')
+            options['compress'] = True
         from chimerax.map_data import save_grid_data
-        save_grid_data(g, save_path, session, format=format)
+        save_grid_data(g, save_path, session, format=format, options=options)
 
     return g
 
+# -----------------------------------------------------------------------------
+#
+from chimerax.map_data import GridData
+class MaskIdGrid(GridData):
+
+    '''
+    Grid data giving lut[mask value] at each grid point, with each mask
+    voxel expanded to bin_size (bi,bj,bk) grid points.  Values are computed
+    from the mask only for the planes read, so writing a file never holds
+    the whole relabelled and unbinned array in memory.
+    '''
+
+    def __init__(self, mask, lut, bin_size, origin, step, name = ''):
+
+        self.mask = mask
+        self.lut = lut
+        self.bin_size = tuple(bin_size)
+        size = [s*b for s,b in zip(mask.shape[::-1], bin_size)]
+        GridData.__init__(self, size, lut.dtype, origin, step, name = name)
+
+    def read_matrix(self, ijk_origin, ijk_size, ijk_step, progress):
+
+        from numpy import arange, empty, take
+        from .regiontable import relabel
+        # Mask index of each requested grid point along each axis.
+        mi = [arange(o, o+n, s) // b for o, n, s, b in
+              zip(ijk_origin, ijk_size, ijk_step, self.bin_size)]
+        lo = [int(a[0]) for a in mi]
+        hi = [int(a[-1])+1 for a in mi]
+        sub = self.mask[lo[2]:hi[2], lo[1]:hi[1], lo[0]:hi[0]]
+        ids = relabel(sub, self.lut, out = empty(sub.shape, self.lut.dtype))
+        # Expand binned voxels and apply steps one axis at a time.
+        for axis, a, l, s, b in zip((2,1,0), mi, lo, ijk_step, self.bin_size):
+            if s != 1 or b != 1:
+                ids = take(ids, a - l, axis = axis)
+        return ids
+
 # -----------------------------------------------------------------------------
 #
 def segmentation_arg(s):
@@ -32,6 +32,12 @@
 #
 # skeleton = 'string encoding chimera marker file'
 #
+# /merge_tree
+#   method = "contact size" or "contact drop"
+#   base_ids = <array of region ids merged by the tree, length N>
+#   node1, node2 = <arrays of merged node indices, length M>
+#   height = <array of merge heights, length M>
+#
 # The file is saved with the Python PyTables modules which includes
 # additional attributes "VERSION", "CLASS", "TITLE", "PYTABLES_FORMAT_VERSION".
 #
@@ -66,22 +72,20 @@ def write_segmentation(seg, path = None):
         seg.region_colors ()
 
         from numpy import array, int32, float32
-        rlist = list(seg.id_to_region.values())
-        rlist.sort(key = lambda r: r.rid)
-
-        rids = array([r.rid for r in rlist], int32)
+        t = seg.table
+        rids = t.ids()
         h5file.create_array(root, 'region_ids', rids)
 
-        rcolors = array([r.color for r in rlist], float32)
+        rcolors = t.color[rids]
         h5file.create_array(root, 'region_colors', rcolors)
 
-        refpts = array([r.max_point for r in rlist], float32)
+        refpts = t.max_point[rids].astype(float32)
         h5file.create_array(root, 'ref_points', refpts)
 
-        slev = array([r.smoothing_level for r in rlist], float32)
+        slev = t.smoothing_level[rids]
         h5file.create_array(root, 'smoothing_levels', slev)
 
-        pids = array([(r.preg.rid if r.preg else 0) for r in rlist], int32)
+        pids = t.parent[rids]
         h5file.create_array(root, 'parent_ids', pids)
 
         map = seg.volume_data()
@@ -104,6 +108,9 @@ def write_segmentation(seg, path = None):
         if seg.adj_graph:
             write_skeleton(h5file, seg.adj_graph)
 
+        if seg.merge_tree:
+            write_merge_tree(h5file, seg.merge_tree)
+
     finally:
 
         h5file.close()
@@ -112,8 +119,8 @@ def write_segmentation(seg, path = None):
 
 # -----------------------------------------------------------------------------
 #
-def open_segmentation(session, path, name = None, **kw):
-    seg = read_segmentation(session, path, open = False)
+def open_segmentation(session, path, name = None, memory_map = False, **kw):
+    seg = read_segmentation(session, path, open = False, memory_map = memory_map)
     if name is not None:
         seg.name = name
 
@@ -276,7 +283,12 @@ def write_skeleton(h5file, mset):
 
 # -----------------------------------------------------------------------------
 #
-def read_segmentation(session, path, open = True, task = None):
+def read_segmentation(session, path, open = True, task = None, memory_map = False):
+
+    '''
+    With memory_map the mask is copied a slab at a time to a memory mapped
+    temporary file instead of being read into memory.
+    '''
 
     import tables
     f = tables.open_file(path)
@@ -321,7 +333,11 @@ def read_segmentation(session, path, open = True, task = None):
             from chimerax.geometry import Place
             s.ijk_to_xyz_transform = Place(a.ijk_to_xyz_transform)
 
-        s.mask = r.mask.read()
+        if memory_map:
+            from .watershed import mask_array, copy_planes
+            s.mask = copy_planes(r.mask, mask_array(r.mask.shape, dtype = r.mask.dtype))
+        else:
+            s.mask = r.mask.read()
         rids = r.region_ids.read()
         rcolors = r.region_colors.read()
         refpts = r.ref_points.read()
@@ -334,9 +350,14 @@ def read_segmentation(session, path, open = True, task = None):
 
         read_attributes(f, s)
 
-        read_skeleton(f, s)
+        read_merge_tree(f, s)
+
+        # Attributes and merge tree are renumbered with the regions.
+        new_id = s.compact_mask()
 
-        read_patches (f, s)
+        read_skeleton(f, s, new_id)
+
+        read_patches (f, s, new_id)
 
     finally:
 
@@ -377,63 +398,61 @@ def map_for_segmentation(session, map_path):
 def create_regions(s, rids, rcolors, refpts, slevels, pids, task):
 
     if task:
-        task.updateStatus('Making ID table')
-    id_to_index = dict([(id,i) for i,id in enumerate(rids)])
+        task.updateStatus('Creating %d regions' % len(rids))
 
-    if task:
-        task.updateStatus('Collecting child region IDs')
-    id_to_child_ids = {}
+    from numpy import int32, bool_, ones, isin
+    rids = rids.astype(int32)
     n = len(rids)
-    for i in range(n):
-        pid = pids[i]
-        if pid > 0:
-            if pid in id_to_child_ids:
-                id_to_child_ids[pid].append(rids[i])
-            else:
-                id_to_child_ids[pid] = [rids[i]]
+    state = {'ids': rids,
+             'parent': pids.astype(int32),
+             'in_mask': ~isin(rids, pids),
+             'color': rcolors,
+             'max_point': refpts.astype(int32),
+             'has_max_point': ones((n,), bool_)}
+    if not slevels is None:
+        state['smoothing_level'] = slevels
 
-    if task:
-        task.updateStatus('Ordering IDs')
-    from .regions import Region
-    ids = depth_order(rids, id_to_child_ids, set())
-    rlist = []
-    for c,rid in enumerate(ids):
-        if rid in id_to_child_ids:
-            children = [s.id_to_region[cid] for cid in id_to_child_ids[rid]]
-        else:
-            children = []
-        i = id_to_index[rid]
-        r = Region(s, rid, refpts[i], children)
-        # TODO: Get wrappy error setting surface piece color to numpy array.
-        r.color = tuple(rcolors[i])
-        if not slevels is None:
-            r.smoothing_level = slevels[i]
-        rlist.append(r)
-        if task and c % 1000 == 0:
-            task.updateStatus('Created %d of %d regions' % (c,n))
+    s.table.set_state(state)
+    if n > 0:
+        s.max_region_id = max(s.max_region_id, int(rids.max()))
 
     if not slevels is None:
         s.smoothing_level = max(slevels)
 
-    return rlist
+# -----------------------------------------------------------------------------
+#
+def write_merge_tree(h5file, tree):
+
+    g = h5file.create_group("/", 'merge_tree', 'region merge tree')
+    g._v_attrs.method = tree.method
+    h5file.create_array(g, 'base_ids', tree.base_ids)
+    if tree.merge_count == 0:
+        return              # HDF5 doesn't handle 0 length arrays.
+    h5file.create_array(g, 'node1', tree.node1)
+    h5file.create_array(g, 'node2', tree.node2)
+    h5file.create_array(g, 'height', tree.height)
 
 # -----------------------------------------------------------------------------
 #
-def depth_order(rids, id_to_child_ids, used):
-
-    idlist = []
-    for rid in rids:
-        if not rid in used:
-            used.add(rid)
-            if rid in id_to_child_ids:
-                cids = id_to_child_ids[rid]
-                idlist.extend(depth_order(cids, id_to_child_ids, used))
-            idlist.append(rid)
-    return idlist
+def read_merge_tree(f, s):
+
+    r = f.root
+    if not 'merge_tree' in r:
+        return
+
+    g = r.merge_tree
+    method = g._v_attrs.method
+    if isinstance(method, bytes):
+        method = method.decode('utf8')
+    state = {'method': method, 'base_ids': g.base_ids.read()}
+    for name in ('node1', 'node2', 'height'):
+        state[name] = getattr(g, name).read() if name in g else ()
+    from .mergetree import MergeTree
+    s.merge_tree = MergeTree.from_state(state)
 
 # -----------------------------------------------------------------------------
 #
-def read_skeleton(f, s):
+def read_skeleton(f, s, new_id = None):
 
     a = f.root
     if not 'skeleton' in a :
@@ -450,7 +469,7 @@ def read_skeleton(f, s):
     # Map markers to regions
     id2r = dict([(r.rid, r) for r in s.all_regions()])
     for m in skel.markers():
-        rid = int(m.extra_attributes['region_id'])
+        rid = file_region_id(int(m.extra_attributes['region_id']), new_id)
         m.region = id2r.get(rid, None)
         if m.region is None:
             debug('missing skeleton region %d' % rid)
@@ -458,9 +477,19 @@ def read_skeleton(f, s):
     s.adj_graph = skel
 
 
+# -----------------------------------------------------------------------------
+# Region id in the segmentation for an id in the file, new_id maps ids if the
+# regions were renumbered after reading.
+#
+def file_region_id(rid, new_id):
+
+    if new_id is None:
+        return rid
+    return int(new_id[rid]) if rid < len(new_id) else 0
+
 # -----------------------------------------------------------------------------
 #
-def read_patches(f, s):
+def read_patches(f, s, new_id = None):
 
     a = f.root
     if not 'patches' in a :
@@ -488,7 +517,7 @@ def read_patches(f, s):
             continue
 
         try :
-            reg = s.id_to_region[int(rid)]
+            reg = s.id_to_region[file_region_id(int(rid), new_id)]
         except :
             debug(" - did not find region for id")
             continue
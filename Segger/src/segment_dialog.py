@@ -35,10 +35,7 @@ showDevTools = False
 
 REG_OPACITY = 0.45
 
-def debug(*args, **kw):
-    from . import debug
-    if debug:
-        print(*args, **kw)
+from .log import debug
 
 
 from chimerax.core.tools import ToolInstance
@@ -306,6 +303,9 @@ class VolumeSegmentationDialog ( ToolInstance ):
 
         krer = EntriesRow(f, 'Keep regions having at least', 1, 'voxels,', 0, 'contact voxels')
         self._min_region_size, self._min_contact_size = krer.values
+
+        wer = EntriesRow(f, 'Use', 1, 'processes for watershed and contacts, 0 = all cpus')
+        self._num_workers, = wer.values
         
         gser = EntriesRow(f, True, 'Group by smoothing', 4, 'steps of size', 1.0, ', stop at', 1, 'regions')
         self._group_smooth, self._num_steps, self._step_size, self._target_num_regions = gser.values
@@ -314,8 +314,43 @@ class VolumeSegmentationDialog ( ToolInstance ):
         self._group_con, self._num_steps_con, self._target_num_regions_con, self._group_by_con_only_visible = gcer.values
 
         radio_buttons(self._group_smooth, self._group_con)
+
+        mtf = self._create_merge_tree_gui(f)
+        f.layout().addWidget(mtf)
         
         return p
+
+    def _create_merge_tree_gui(self, parent):
+
+        from Qt.QtWidgets import QFrame, QHBoxLayout, QLabel, QPushButton, QSlider, QComboBox
+        from Qt.QtCore import Qt
+        mf = QFrame(parent)
+        mlayout = QHBoxLayout(mf)
+        mlayout.setContentsMargins(0,0,0,0)
+        mlayout.setSpacing(5)
+
+        b = QPushButton('Merge tree', mf)
+        b.setToolTip('Compute all groupings once by the chosen join order,\n'
+                     'then group to any number of regions with the slider')
+        b.clicked.connect(self.ComputeMergeTree)
+        mlayout.addWidget(b)
+        self._merge_tree_method = m = QComboBox(mf)
+        m.addItems(['contact size', 'contact drop'])
+        m.setToolTip('contact size: join regions with the largest contact first,\n'
+                     '  as group by connectivity does\n'
+                     'contact drop: join regions with the smallest density drop\n'
+                     '  between them first')
+        mlayout.addWidget(m)
+        self._merge_tree_slider = s = QSlider(Qt.Horizontal, mf)
+        s.setTracking(False)                # Group when the slider is released.
+        s.setEnabled(False)
+        s.valueChanged.connect(self.MergeTreeCut)
+        s.sliderMoved.connect(self._merge_tree_slider_moved)
+        mlayout.addWidget(s, stretch = 1)
+        self._merge_tree_count = c = QLabel('', mf)
+        mlayout.addWidget(c)
+
+        return mf
     
     def _create_shortcuts_gui(self, parent):
 
@@ -1310,6 +1345,24 @@ class VolumeSegmentationDialog ( ToolInstance ):
 
         smod.change_surface_resolution(res)
 
+    def NumWorkers ( self ):
+
+        ''' Process count from the dialog, limited to the number of cpus.
+            Values that are not positive integers use all cpus if 0,
+            otherwise one process. '''
+
+        try :
+            n = int(self._num_workers.value)
+        except ( TypeError, ValueError ) :
+            n = 1
+        if n < 0 :
+            n = 1
+        from .parallel import worker_count
+        workers = 0 if n == 0 else worker_count(n)
+        if workers != n :
+            self._num_workers.value = workers
+        return workers
+
 
     def NewMaxRegions ( self, event = None ):
 
@@ -2000,6 +2053,54 @@ class VolumeSegmentationDialog ( ToolInstance ):
         else:
             s = "%s regions" % "{:,}".format( len(smod.regions) )
         self._region_count.setText(s)
+        self.UpdateMergeTreeSlider(smod)
+
+
+    def ComputeMergeTree ( self ) :
+
+        smod = self.CurrentSegmentation()
+        if smod is None : return
+
+        if smod.volume_data() is None:
+            self.status ('Segmentation map not opened')
+            return
+
+        method = self._merge_tree_method.currentText()
+        tree = smod.compute_merge_tree ( method )
+        self.UpdateMergeTreeSlider(smod)
+        self.status ( 'Computed %s merge tree for %d regions, can group down to %d regions' %
+                      (method, tree.base_count, max(1, tree.minimum_region_count)) )
+
+
+    def UpdateMergeTreeSlider ( self, smod ) :
+
+        s = self._merge_tree_slider
+        tree = None if smod is None else smod.merge_tree
+        s.blockSignals(True)
+        if tree is None:
+            s.setEnabled(False)
+            self._merge_tree_count.setText('')
+        else:
+            nmin, nmax = max(1, tree.minimum_region_count), max(1, tree.base_count)
+            s.setRange(nmin, nmax)
+            n = min(max(len(smod.regions), nmin), nmax)
+            s.setValue(n)
+            s.setEnabled(True)
+            self._merge_tree_count.setText('%d' % n)
+        s.blockSignals(False)
+
+    def _merge_tree_slider_moved ( self, nregions ) :
+
+        self._merge_tree_count.setText('%d' % nregions)
+
+    def MergeTreeCut ( self, nregions ) :
+
+        smod = self.CurrentSegmentation()
+        if smod is None or smod.merge_tree is None : return
+
+        smod.group_by_merge_tree ( nregions )
+        self.RegsDispUpdate ()
+        self.status ( 'Grouped to %d regions using merge tree' % len(smod.regions) )
 
 
     def RegsDispThr ( self ) :
@@ -2164,12 +2265,15 @@ class VolumeSegmentationDialog ( ToolInstance ):
             self.SetSurfaceGranularity(smod)
             self.SetCurrentSegmentation(smod)
 
+        smod.workers = self.NumWorkers()
+
         if timing: t0 = clock()
         smod.calculate_watershed_regions ( mm, thrD, csyms, task )
 
         if timing: t1 = clock()
         self.RemoveSmallRegions(smod, task)
         self.RemoveContactRegions(smod, task)
+        smod.compact_mask()
         nwr = len(smod.regions)
 
         if timing: t2 = clock()
@@ -2806,7 +2910,7 @@ class VolumeSegmentationDialog ( ToolInstance ):
             self.status ( "No segmentation selected..." )
             return
 
-        sel_regs = smod.selected_regions()
+        sel_regs = set(smod.selected_regions())
         if len(sel_regs)==0 :
             self.status ( "No regions selected..." )
             return
@@ -3089,7 +3193,14 @@ class VolumeSegmentationDialog ( ToolInstance ):
         smod = self.CurrentSegmentation()
         if smod is None: return
 
-        for r in regs :
+        # Axis directions of all regions from the segmentation moments.
+        # Extents are the farthest point from the center along each axis,
+        # for all regions in one pass over the voxel index.
+        coms, Us, Ss, Vs = smod.region_axes ( regs )
+        t = smod.table
+        rads, exts = smod.region_extents ( [t.leaf_ids_under(r.rid) for r in regs], coms, Us )
+
+        for r, com, U, S, V, ext in zip ( regs, coms, Us, Ss, Vs, exts ) :
 
             sp = r.surface_piece
             try :
@@ -3098,19 +3209,8 @@ class VolumeSegmentationDialog ( ToolInstance ):
             except :
                 pass
 
-            tpoints = r.map_points()
-            sp.COM, sp.U, sp.S, sp.V = prAxes ( tpoints )
-
-            com = numpy.sum(tpoints, axis=0) / len(tpoints)
-            comv = numpy.ones_like ( tpoints ) * com
-            points = tpoints - comv
-
-            ppoints = points * sp.U
-            sp.Extents = numpy.asarray ( numpy.max ( numpy.abs ( ppoints ), 0 ) )[0]
-
-            sp.Extents[0] += 5.0
-            sp.Extents[1] += 5.0
-            sp.Extents[2] += 5.0
+            sp.COM, sp.U, sp.S, sp.V = com, numpy.matrix(U), S, numpy.matrix(V)
+            sp.Extents = ext + 5.0
 
             from . import axes
 
@@ -3314,7 +3414,7 @@ class VolumeSegmentationDialog ( ToolInstance ):
         if m is None:
             return
 
-        from chimerax.segment import region_bounds
+        from .parallel import region_bounds
         b = region_bounds(m)
 
         rset = set()
@@ -3381,7 +3481,7 @@ class VolumeSegmentationDialog ( ToolInstance ):
     # State save/restore in ChimeraX
     _save_attrs = ['_map_menu', '_segmentation_menu',
                    '_max_num_regions', '_surface_granularity',
-                   '_min_region_size', '_min_contact_size',
+                   '_min_region_size', '_min_contact_size', '_num_workers',
                    '_group_smooth', '_num_steps', '_step_size', '_target_num_regions',
                    '_group_con', '_num_steps_con', '_target_num_regions_con', '_group_by_con_only_visible']
   
@@ -0,0 +1,221 @@
+# -----------------------------------------------------------------------------
+# Watershed segmentation of a map in slabs of z planes.  Each slab is read
+# with halo planes on each side, segmented in memory and the region labels
+# of the slab core are written to the mask.  Regions cut by slab boundaries
+# are stitched by following each slab region's maximum into the slab whose
+# core holds it.  Used for maps too large to hold in memory, with a memory
+# mapped mask, and to segment slabs in parallel.  Also has the routines for
+# creating and filling memory mapped masks.
+#
+import numpy
+from . import timing
+from time import time as clock
+from .log import debug
+
+# -----------------------------------------------------------------------------
+#
+def mask_array(shape, path = None, dtype = numpy.uint32):
+    '''
+    Zero filled memory mapped mask array.  Without a path the array is backed
+    by an anonymous temporary file that is removed when the array is freed.
+    '''
+    if path is None:
+        import tempfile
+        f = tempfile.TemporaryFile(suffix = '.mask')
+    else:
+        f = path
+    return numpy.memmap(f, dtype = dtype, mode = 'w+', shape = tuple(shape))
+
+# -----------------------------------------------------------------------------
+#
+def copy_planes(source, array, max_bytes = 2**28):
+    '''
+    Copy a 3-d array a few z planes at a time so a source read from a file
+    is never held in memory all at once.  Returns the destination array.
+    '''
+    nz = source.shape[0]
+    plane_bytes = max(1, array[:1].nbytes)
+    step = max(1, max_bytes // plane_bytes)
+    for z in range(0, nz, step):
+        array[z:z+step] = source[z:z+step]
+    if hasattr(array, 'flush'):
+        array.flush()
+    return array
+
+# -----------------------------------------------------------------------------
+#
+def slab_ranges(nz, slab_planes):
+    '''List of (z0, z1) core plane ranges for slabs of slab_planes z planes.'''
+    return [(z0, min(z0 + slab_planes, nz)) for z0 in range(0, nz, slab_planes)]
+
+# -----------------------------------------------------------------------------
+#
+def tiled_watershed(data, threshold, mask, slab_planes, halo = 2, task = None):
+    '''
+    Compute watershed regions of GridData data into a mask array (usually
+    memory mapped) reading slab_planes z planes of the map at a time.
+    Returns the maximum grid point (i,j,k) of each region, mask values are
+    region ids 1 to n numbered in z,y,x order of maxima.
+    '''
+    if timing: t0 = clock()
+    nx, ny, nz = data.size
+    def read_planes(z, n):
+        return data.matrix(ijk_origin = (0,0,z), ijk_size = (nx,ny,n))
+    slabs = slab_ranges(nz, slab_planes)
+    points, owned = [], []
+    for s, (z0, z1) in enumerate(slabs):
+        if task:
+            task.updateStatus('Watershed slab %d of %d, planes %d-%d'
+                              % (s+1, len(slabs), z0, z1-1))
+        core, p, o = slab_watershed(read_planes, nz, threshold, z0, z1, halo)
+        mask[z0:z1] = core
+        points.append(p)
+        owned.append(o)
+
+    if timing: t1 = clock()
+    max_points = stitch_slabs(slabs, points, owned, mask, mask)
+    if hasattr(mask, 'flush'):
+        mask.flush()
+
+    if timing:
+        debug('Tiled watershed %d slabs, %d slab regions, %d regions, %.2f sec, stitch %.2f'
+              % (len(slabs), sum(len(p) for p in points), len(max_points), clock()-t0, clock()-t1))
+
+    return max_points
+
+# -----------------------------------------------------------------------------
+#
+def slab_watershed(read_planes, nz, threshold, z0, z1, halo = 2):
+    '''
+    Watershed regions of core planes z0 to z1-1 of a map with nz planes.
+    Function read_planes(z, n) returns map planes z to z+n-1.  Returns the
+    core mask with slab region ids, the maximum point (i,j,k) of each slab
+    region in whole map indices, and whether each maximum is in the core.
+
+    The slab is segmented with halo extra planes on both sides.  Ascent
+    paths within the slab match those for the whole map except at points on
+    the outermost slab planes whose highest neighbor is outside the slab.
+    If a region reaching the slab core contains such a point the halo is
+    doubled and the slab recomputed, so slab regions touching the core end
+    at true maxima.  Stitching slabs then gives the whole map regions when
+    grid points ascend to their highest neighbor.
+    '''
+    from .kernels import watershed_regions, region_maxima
+
+    if halo < 1:
+        raise ValueError('Slab watershed needs at least 1 halo plane, got %d' % halo)
+
+    h = halo
+    while True:
+        e0, e1 = max(z0 - h, 0), min(z1 + h, nz)
+        m = read_planes(e0, e1-e0)
+        smask = numpy.zeros(m.shape, numpy.uint32)
+        watershed_regions(m, threshold, smask)
+        if (e0 == 0 and e1 == nz) or not _ascends_out_of_slab(read_planes, nz, m, smask, e0, z0, z1):
+            break
+        h *= 2
+        debug('Watershed ascent leaves slab at planes %d-%d, halo increased to %d' % (z0, z1-1, h))
+
+    points, values = region_maxima(smask, m)
+    points = numpy.array(points, numpy.int32).reshape((-1,3))
+    points[:,2] += e0
+    owned = (points[:,2] >= z0) & (points[:,2] < z1)
+    return smask[z0-e0:z1-e0], points, owned
+
+# -----------------------------------------------------------------------------
+#
+def stitch_slabs(slabs, points, owned, labels, mask):
+    '''
+    Join slab regions with maximum outside their slab core to the region at
+    that grid point and renumber the joined regions 1 to n in z,y,x order of
+    maxima.  Array labels holds slab region ids for each slab core, the
+    renumbered ids are written to mask which can be the same array.  Points
+    and owned are lists of slab watershed maxima and core flags.  Returns
+    the maximum point of each joined region.
+    '''
+    counts = [len(p) for p in points]
+    base = numpy.cumsum([0] + counts)
+    n = int(base[-1])
+    max_points = numpy.concatenate(points) if n else numpy.zeros((0,3), numpy.int32)
+    owned = numpy.concatenate(owned) if n else numpy.zeros((0,), bool)
+
+    # Slab regions with maximum in a halo point to the region at that maximum.
+    up = numpy.arange(n + 1, dtype = numpy.uint32)
+    uids = numpy.nonzero(~owned)[0] + 1
+    i, j, k = max_points[uids-1].T
+    zstart = numpy.array([z0 for z0, z1 in slabs])
+    s = numpy.searchsorted(zstart, k, side = 'right') - 1
+    link = labels[k, j, i].astype(numpy.uint32)
+    up[uids] = numpy.where(link > 0, link + base[s], uids)
+    up = _jump_to_roots(up)
+
+    # Renumber stitched regions in z,y,x order of maxima.
+    roots = numpy.unique(up[1:])
+    rpts = max_points[roots-1]
+    order = numpy.lexsort((rpts[:,0], rpts[:,1], rpts[:,2]))
+    roots, rpts = roots[order], rpts[order]
+    lut = numpy.zeros(n + 1, numpy.uint32)
+    lut[roots] = numpy.arange(1, len(roots)+1, dtype = numpy.uint32)
+    lut = lut[up]
+    for s, (z0, z1) in enumerate(slabs):
+        slut = lut[base[s]:base[s+1]+1].copy()
+        slut[0] = 0
+        mask[z0:z1] = slut[labels[z0:z1]]
+
+    return rpts
+
+# -----------------------------------------------------------------------------
+#
+def _ascends_out_of_slab(read_planes, nz, m, smask, e0, z0, z1):
+    '''
+    True if a slab region containing core planes z0 to z1-1 also contains a
+    point on an outer slab plane whose highest neighbor lies outside the slab.
+    Those points were given the wrong ascent direction.
+    '''
+    e1 = e0 + len(m)
+    bad = []
+    for z, zin, zout in ((0, 1, e0-1), (-1, -2, e1)):
+        if zout < 0 or zout >= nz:
+            continue
+        plane = m[z]
+        inside = _plane_neighbor_max(plane)
+        if len(m) > 1:
+            inside = numpy.maximum(inside, _plane_neighbor_max(m[zin]))
+        outside = _plane_neighbor_max(read_planes(zout, 1)[0])
+        leaves = (outside > plane) & (outside >= inside)
+        ids = smask[z][leaves]
+        bad.append(ids[ids > 0])
+    bad = numpy.unique(numpy.concatenate(bad)) if bad else ()
+    if len(bad) == 0:
+        return False
+    return numpy.isin(smask[z0-e0:z1-e0], bad).any()
+
+# -----------------------------------------------------------------------------
+#
+def _plane_neighbor_max(plane):
+    '''Maximum of each 2-d array value and its 8 neighbors.'''
+    p = numpy.pad(plane, 1, mode = 'edge')
+    ny, nx = plane.shape
+    mx = plane.copy()
+    for dj in (0, 1, 2):
+        for di in (0, 1, 2):
+            numpy.maximum(mx, p[dj:dj+ny, di:di+nx], out = mx)
+    return mx
+
+# -----------------------------------------------------------------------------
+#
+def _jump_to_roots(up, max_steps = 64):
+    '''
+    Follow parent links until every entry points to a root.  Equal map
+    values on a plateau could make a cycle of links, after max_steps the
+    regions in a cycle are made separate roots.
+    '''
+    for step in range(max_steps):
+        top = up[up]
+        if (top == up).all():
+            return up
+        up = top
+    debug('Watershed slab stitching did not converge, plateau maxima remain split')
+    cyc = numpy.nonzero(up[up] != up)[0]
+    up[cyc] = cyc
+    return _jump_to_roots(up, max_steps)
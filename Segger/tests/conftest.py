@@ -0,0 +1,48 @@
+# -----------------------------------------------------------------------------
+# Tests run with ChimeraX's Python using the installed bundle,
+#
+#   chimerax -m pytest Segger/tests
+#
+# or with a plain Python that has numpy and pytest, importing the modules in
+# Segger/src that do not need ChimeraX.  Tests of code that needs ChimeraX
+# are skipped there.  Kernels use the numpy backend when the chimerax.segment
+# C++ module is not available.
+#
+import importlib, os, sys, types
+import numpy
+import pytest
+
+def _segger_package():
+    try:
+        return importlib.import_module('chimerax.segger')
+    except ImportError:
+        pass
+    src = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+    # Package without running src/__init__.py, which needs ChimeraX.
+    pkg = types.ModuleType('segger')
+    pkg.__path__ = [src]
+    pkg.timing = False
+    pkg.debug = False
+    sys.modules['segger'] = pkg
+    return pkg
+
+package = _segger_package()
+installed = (package.__name__ == 'chimerax.segger')
+
+def segger_module(name):
+    '''Import a Segger module, skipping the test if it needs ChimeraX.'''
+    try:
+        return importlib.import_module(package.__name__ + '.' + name)
+    except ImportError as e:
+        pytest.skip('Segger module %s not importable: %s' % (name, e))
+
+def synthetic_map(shape = (30,26,28), nblobs = 18, seed = 0):
+    '''Sum of Gaussian blobs of random size and height, float32.'''
+    rs = numpy.random.RandomState(seed)
+    k, j, i = numpy.indices(shape)
+    m = numpy.zeros(shape, numpy.float32)
+    for b in range(nblobs):
+        c = rs.uniform(2, numpy.array(shape) - 2)
+        r2 = (k-c[0])**2 + (j-c[1])**2 + (i-c[2])**2
+        m += rs.uniform(.5, 1.5) * numpy.exp(-r2 / (2*rs.uniform(1.5, 3.5)**2))
+    return m
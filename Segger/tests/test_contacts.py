@@ -0,0 +1,132 @@
+# -----------------------------------------------------------------------------
+# Region contact graphs agree with contacts counted face by face, group
+# contacts are sums over leaf contacts, and dropping erased regions gives the
+# same graph as computing contacts again.
+#
+import itertools
+import numpy
+import pytest
+
+from conftest import segger_module, synthetic_map
+
+def watershed_segmentation(seed = 0):
+    rt = segger_module('regiontable')
+    kernels = segger_module('kernels')
+    m = synthetic_map(seed = seed)
+    mask = numpy.zeros(m.shape, numpy.uint32)
+    kernels.watershed_regions(m, 0.1, mask)
+    s = rt.SegmentationMask(mask)
+    ids = numpy.unique(mask[mask > 0]).astype(numpy.int32)
+    s.table.add_leaf_regions(ids, numpy.zeros((len(ids),3), numpy.int32))
+    s.max_region_id = int(ids.max())
+    return s, m
+
+def face_contacts(mask, map):
+    '''(r1,r2) -> [N, D, maximum density] counted one grid face at a time.'''
+    cons = {}
+    ks, js, i_s = mask.shape
+    for k, j, i in itertools.product(range(ks), range(js), range(i_s)):
+        a = mask[k,j,i]
+        for kk, jj, ii in ((k+1,j,i), (k,j+1,i), (k,j,i+1)):
+            if kk >= ks or jj >= js or ii >= i_s:
+                continue
+            b = mask[kk,jj,ii]
+            if a == 0 or b == 0 or a == b:
+                continue
+            v = float(min(map[k,j,i], map[kk,jj,ii]))
+            c = cons.setdefault((min(a,b), max(a,b)), [0, 0.0, -numpy.inf])
+            c[0] += 1
+            c[1] += v
+            c[2] = max(c[2], v)
+    return cons
+
+def contacts_dict(rc):
+    return dict(((r1, r2), (int(rc.N[i]), rc.D[i], rc.maximum_density[i]))
+                for i, (r1, r2) in enumerate(zip(rc.r1.tolist(), rc.r2.tolist())))
+
+def check_contacts(rc, cons):
+    d = contacts_dict(rc)
+    assert set(d.keys()) == set(cons.keys())
+    for pair, (n, D, maxd) in d.items():
+        cn, cD, cmax = cons[pair]
+        assert n == cn
+        assert D == pytest.approx(cD, rel = 1e-5)
+        assert maxd == pytest.approx(cmax, rel = 1e-5)
+
+def test_leaf_contacts():
+    contacts = segger_module('contacts')
+    s, m = watershed_segmentation(0)
+    rc = contacts.mask_contacts(s, m)
+    check_contacts(rc, face_contacts(s.mask, m))
+
+    c = rc.contact(int(rc.r2[0]), int(rc.r1[0]))
+    assert c.N == rc.N[0] and c.D == pytest.approx(rc.D[0])
+    assert rc.contact(int(rc.r1[0]), int(rc.r1[0])) is None
+
+def test_group_contacts_sum_leaf_contacts():
+    contacts = segger_module('contacts')
+    s, m = watershed_segmentation(1)
+    t = s.table
+    lids = t.leaf_ids()
+    # Two level groups of leaves, some leaves left ungrouped.
+    gid = s.max_region_id
+    for g in range(0, len(lids) - 3, 4):
+        t.add_region(gid + 1, child_ids = lids[g:g+2])
+        t.add_region(gid + 2, child_ids = (gid + 1, lids[g+2]))
+        gid += 2
+    s.max_region_id = gid
+    assert len(t.top_ids()) < len(lids)
+
+    rc = contacts.mask_contacts(s, m)
+    gc = contacts.group_contacts(rc)
+    top = t.top_parents()
+    tmask = top[s.mask].astype(numpy.uint32)
+    tmask[s.mask == 0] = 0
+    check_contacts(gc, face_contacts(tmask, m))
+
+    # Contact areas and sums, each group pair once.
+    assert gc.N.sum() == rc.N[top[rc.r1] != top[rc.r2]].sum()
+    assert len(set(zip(gc.r1.tolist(), gc.r2.tolist()))) == gc.count
+    assert (gc.r1 < gc.r2).all()
+
+def test_neighbors():
+    contacts = segger_module('contacts')
+    s, m = watershed_segmentation(2)
+    rc = contacts.mask_contacts(s, m)
+    cons = face_contacts(s.mask, m)
+    nbrs = {}
+    for a, b in cons.keys():
+        nbrs.setdefault(a, set()).add(b)
+        nbrs.setdefault(b, set()).add(a)
+
+    for rid in s.table.leaf_ids().tolist():
+        assert set(rc.neighbors(rid).tolist()) == nbrs.get(rid, set())
+        assert rc.degree(rid) == len(nbrs.get(rid, ()))
+    ids = s.table.leaf_ids()
+    assert (rc.degrees(ids) == [len(nbrs.get(r, ())) for r in ids.tolist()]).all()
+
+    some = ids[::3]
+    expect = set().union(*[nbrs.get(r, set()) for r in some.tolist()])
+    assert rc.neighbors_of(some).tolist() == sorted(expect)
+    assert rc.boundary_ids(some).tolist() == sorted(expect - set(some.tolist()))
+    # Ids that are not regions of the graph have no neighbors.
+    assert len(rc.neighbors_of([0, 10**6])) == 0
+    assert rc.degree(10**6) == 0 and len(rc.neighbors(0)) == 0
+
+    sizes = rc.contact_sizes(ids)
+    for rid, n in zip(ids.tolist(), sizes.tolist()):
+        assert n == sum(c[0] for p, c in cons.items() if rid in p)
+
+def test_erased_regions_match_new_contacts():
+    contacts = segger_module('contacts')
+    s, m = watershed_segmentation(0)
+    s.rcons = contacts.mask_contacts(s, m)
+    s.rcons.neighbors(1)                # Build the adjacency index before removal.
+    ids = s.table.leaf_ids()
+    gone = ids[::4]
+    s.erase_region_voxels(gone)
+    fresh = contacts.mask_contacts(s, m)
+    assert contacts_dict(s.rcons) == contacts_dict(fresh)
+    for rid in ids.tolist():
+        assert sorted(s.rcons.neighbors(rid).tolist()) == sorted(fresh.neighbors(rid).tolist())
+    assert len(s.rcons.neighbors_of(gone)) == 0
@@ -0,0 +1,171 @@
+# -----------------------------------------------------------------------------
+# Grouping by contact size gives the same levels of pairwise joins as
+# sorting all contacts again at each level, and grouping by density drop
+# joins in the same order as searching all contacts for the smallest drop.
+#
+import numpy
+import pytest
+
+from conftest import segger_module, synthetic_map
+
+def random_contacts(nregions, ncontacts, seed = 0, nmax = 20):
+    '''RegionContacts between random pairs of region ids with tied sizes.'''
+    contacts = segger_module('contacts')
+    rs = numpy.random.RandomState(seed)
+    pairs = set()
+    while len(pairs) < ncontacts:
+        a, b = rs.randint(1, nregions + 1, 2)
+        if a != b:
+            pairs.add((min(a,b), max(a,b)))
+    pairs = numpy.array(sorted(pairs), numpy.int32)
+    N = rs.randint(1, nmax, len(pairs))
+    return contacts.RegionContacts(None, pairs[:,0], pairs[:,1], N)
+
+def sorted_level_joins(rc, nsteps, stopAt, next_id):
+    '''Join disjoint pairs largest contact first, sorting all contacts each level.'''
+    cons = dict(((a, b), n) for a, b, n in zip(rc.r1.tolist(), rc.r2.tolist(), rc.N.tolist()))
+    levels = []
+    for step in range(nsteps):
+        if len(cons) == 0:
+            break
+        joined = {}
+        joins = []
+        for (a, b), n in sorted(cons.items(), key = lambda c: (-c[1], c[0])):
+            if a in joined or b in joined:
+                continue
+            joined[a] = joined[b] = next_id
+            joins.append((a, b, next_id))
+            next_id += 1
+        summed = {}
+        for (a, b), n in cons.items():
+            a, b = joined.get(a, a), joined.get(b, b)
+            if a != b:
+                key = (min(a,b), max(a,b))
+                summed[key] = summed.get(key, 0) + n
+        cons = summed
+        levels.append(joins)
+        if len(joins) <= stopAt:
+            break
+    return levels
+
+class Joiner:
+    def __init__(self, next_id):
+        self.next_id = next_id
+    def join(self, id1, id2):
+        self.next_id += 1
+        return self.next_id - 1
+
+@pytest.mark.parametrize('seed', [0, 1, 2, 3])
+def test_contact_size_levels(seed):
+    contacts = segger_module('contacts')
+    rc = random_contacts(60, 150, seed)
+    levels = contacts.merge_by_contact_size(rc, Joiner(1000).join, 100, 0)
+    assert levels == sorted_level_joins(rc, 100, 0, 1000)
+    assert len(levels) > 2
+    # Each region is joined at most once per level.
+    for joins in levels:
+        ids = [r for r1, r2, rj in joins for r in (r1, r2)]
+        assert len(ids) == len(set(ids))
+
+@pytest.mark.parametrize('nsteps, stopAt', [(1, 1), (3, 1), (100, 5)])
+def test_contact_size_stopping(nsteps, stopAt):
+    contacts = segger_module('contacts')
+    rc = random_contacts(50, 80, seed = 4)
+    levels = contacts.merge_by_contact_size(rc, Joiner(500).join, nsteps, stopAt)
+    assert levels == sorted_level_joins(rc, nsteps, stopAt, 500)
+    assert len(levels) <= nsteps
+
+def test_disconnected_groups_stop():
+    contacts = segger_module('contacts')
+    # Two separate chains, one join left at the end for each.
+    rc = contacts.RegionContacts(None, (1,2,3,5,6), (2,3,4,6,7), (5,4,3,2,1))
+    levels = contacts.merge_by_contact_size(rc, Joiner(10).join, 10, 0)
+    assert levels == sorted_level_joins(rc, 10, 0, 10)
+    assert sum(len(joins) for joins in levels) == 5
+
+def watershed_segmentation(seed = 0):
+    rt = segger_module('regiontable')
+    kernels = segger_module('kernels')
+    m = synthetic_map(seed = seed)
+    mask = numpy.zeros(m.shape, numpy.uint32)
+    kernels.watershed_regions(m, 0.1, mask)
+    s = rt.SegmentationMask(mask.astype(numpy.uint16))
+    ids = numpy.unique(mask[mask > 0]).astype(numpy.int32)
+    # No stored maximum points, maxima come from the map.
+    s.table.add_leaf_regions(ids, numpy.zeros((len(ids),3), numpy.int32))
+    s.table.has_max_point[ids] = False
+    s.max_region_id = int(ids.max())
+    return s, m
+
+def smallest_drop_joins(s, m, next_id):
+    '''Join the groups of the contact with the smallest drop, searching all contacts.'''
+    kernels = segger_module('kernels')
+    ci, cf = kernels.interface_values(s.mask.astype(numpy.uint32), m)
+    t = s.table
+    group = dict((rid, int(t.top_parents()[rid])) for rid in t.leaf_ids().tolist())
+    gmax = {}
+    for rid in t.leaf_ids().tolist():
+        v = m[s.mask == rid].max()
+        gmax[group[rid]] = max(gmax.get(group[rid], -numpy.inf), v)
+    joins = []
+    while True:
+        best = None
+        for i, ((r1, r2, n), (cd, csum)) in enumerate(zip(ci.tolist(), cf.tolist())):
+            if r1 not in group or r2 not in group:
+                continue
+            g1, g2 = group[r1], group[r2]
+            if g1 != g2:
+                d = min(gmax[g1], gmax[g2]) - cd
+                if best is None or d < best[0]:
+                    best = (d, g1, g2)
+        if best is None:
+            return joins
+        d, g1, g2 = best
+        joins.append((g1, g2, d))
+        gmax[next_id] = max(gmax[g1], gmax[g2])
+        for rid, g in group.items():
+            if g in (g1, g2):
+                group[rid] = next_id
+        next_id += 1
+
+class DropJoiner:
+    def __init__(self, next_id):
+        self.next_id = next_id
+        self.joins = []
+    def join(self, id1, id2, drop):
+        self.joins.append((id1, id2, drop))
+        self.next_id += 1
+        return self.next_id - 1
+
+def same_joins(joins, expect):
+    assert len(joins) == len(expect)
+    for (a1, a2, d), (b1, b2, e) in zip(joins, expect):
+        assert (a1, a2) == (b1, b2) or (a1, a2) == (b2, b1)
+        assert d == pytest.approx(e, rel = 1e-5, abs = 1e-6)
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_contact_drop_order(seed):
+    contacts = segger_module('contacts')
+    s, m = watershed_segmentation(seed)
+    jn = DropJoiner(s.max_region_id + 1)
+    contacts.contact_drop_merges(s, m, jn.join)
+    same_joins(jn.joins, smallest_drop_joins(s, m, s.max_region_id + 1))
+    assert len(jn.joins) > 5
+
+def test_contact_drop_groups_and_missing_regions():
+    contacts = segger_module('contacts')
+    s, m = watershed_segmentation(1)
+    t = s.table
+    lids = t.leaf_ids()
+    # Start from some groups, and drop a leaf from the table whose
+    # voxels are still in the mask.
+    g = s.max_region_id + 1
+    t.add_region(g, child_ids = lids[:3])
+    t.remove_region(int(lids[5]))
+    s.max_region_id = g
+    jn = DropJoiner(g + 1)
+    contacts.contact_drop_merges(s, m, jn.join)
+    same_joins(jn.joins, smallest_drop_joins(s, m, g + 1))
+    joined = set(r for a, b, d in jn.joins for r in (a, b))
+    assert int(lids[5]) not in joined
+    assert not joined & set(lids[:3].tolist())
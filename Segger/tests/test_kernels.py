@@ -0,0 +1,256 @@
+# -----------------------------------------------------------------------------
+# The numpy kernels agree with the chimerax.segment C++ kernels, with
+# direct grid point loops on small maps and with hand checked results.  The
+# numpy backend is tested three ways, with whole array NumPy operations, with
+# its Numba loops run uncompiled and with the loops compiled by Numba.  The
+# C++ comparisons are skipped outside ChimeraX and the compiled loops are
+# skipped without Numba.
+#
+import itertools
+import numpy
+import pytest
+
+from conftest import segger_module, synthetic_map
+
+threshold = 0.1
+seeds = [0, 1, 2]
+
+@pytest.fixture
+def nk():
+    return segger_module('numpy_kernels')
+
+@pytest.fixture
+def ck():
+    return pytest.importorskip('chimerax.segment')
+
+def use_numpy(nk, monkeypatch):
+    monkeypatch.setattr(nk, 'numba', None)
+
+def use_loops(nk, monkeypatch):
+    '''Run the loops meant for Numba as plain Python.'''
+    monkeypatch.setattr(nk, 'numba', True)
+    for name in dir(nk):
+        if name.endswith('_loop'):
+            monkeypatch.setattr(nk, name[:-5] + '_jit', getattr(nk, name), raising = False)
+
+@pytest.fixture(params = ['numpy', 'loops', 'numba'])
+def impl(request, nk, monkeypatch):
+    '''Numpy kernels using NumPy operations, uncompiled loops or Numba.'''
+    if request.param == 'numpy':
+        use_numpy(nk, monkeypatch)
+    elif request.param == 'loops':
+        use_loops(nk, monkeypatch)
+    elif nk.numba is None:
+        pytest.skip('Numba is not installed')
+    return nk
+
+def kernel_results(k, m):
+    '''Results of every kernel for a map, arrays in a fixed order.'''
+    mask = watershed(k, m)
+    r = {'watershed': mask}
+    r['maxima points'], r['maxima values'] = k.region_maxima(mask, m)
+    r['contacts'] = sorted_contacts(k.region_contacts(mask))
+    r['interface counts'], r['interface values'] = sorted_contacts(*k.interface_values(mask, m))
+    r['bounds'] = k.region_bounds(mask)
+    r['points'] = numpy.concatenate([sorted_points(k.region_points(mask, rid))
+                                     for rid in range(1, int(mask.max())+1)])
+    rs = numpy.random.RandomState(0)
+    points = numpy.stack([rs.randint(0, n, 100) for n in m.shape[::-1]], axis = 1).astype(numpy.intc)
+    k.find_local_maxima(m, points)
+    r['local maxima'] = points
+    return r
+
+def watershed(kernels, m):
+    mask = numpy.zeros(m.shape, numpy.uint32)
+    kernels.watershed_regions(m, threshold, mask)
+    return mask
+
+def sorted_contacts(ci, cf = None):
+    order = numpy.lexsort((ci[:,1], ci[:,0]))
+    return ci[order] if cf is None else (ci[order], cf[order])
+
+def sorted_points(p):
+    p = numpy.asarray(p).reshape((-1,3))
+    return p[numpy.lexsort(p.T[::-1])]
+
+# -----------------------------------------------------------------------------
+# Numpy kernels against the C++ kernels.
+#
+@pytest.mark.parametrize('seed', seeds)
+def test_watershed_regions(nk, ck, seed):
+    m = synthetic_map(seed = seed)
+    assert (watershed(nk, m) == watershed(ck, m)).all()
+
+@pytest.mark.parametrize('seed', seeds)
+def test_region_maxima(nk, ck, seed):
+    m = synthetic_map(seed = seed)
+    mask = watershed(ck, m)
+    p, v = nk.region_maxima(mask, m)
+    cp, cv = ck.region_maxima(mask, m)
+    assert (numpy.asarray(p) == numpy.asarray(cp)).all()
+    assert numpy.allclose(v, cv)
+
+@pytest.mark.parametrize('seed', seeds)
+def test_region_contacts(nk, ck, seed):
+    mask = watershed(ck, synthetic_map(seed = seed))
+    assert (sorted_contacts(nk.region_contacts(mask)) ==
+            sorted_contacts(ck.region_contacts(mask))).all()
+
+@pytest.mark.parametrize('seed', seeds)
+def test_interface_values(nk, ck, seed):
+    m = synthetic_map(seed = seed)
+    mask = watershed(ck, m)
+    ci, cf = sorted_contacts(*nk.interface_values(mask, m))
+    cci, ccf = sorted_contacts(*ck.interface_values(mask, m))
+    assert (ci == cci).all()
+    assert numpy.allclose(cf, ccf, rtol = 1e-5, atol = 1e-5)
+
+@pytest.mark.parametrize('seed', seeds)
+def test_region_bounds(nk, ck, seed):
+    mask = watershed(ck, synthetic_map(seed = seed))
+    b, cb = nk.region_bounds(mask), ck.region_bounds(mask)
+    found = (cb[:,6] > 0)
+    assert (b[:,6] == cb[:,6]).all()
+    assert (b[found] == cb[found]).all()
+
+@pytest.mark.parametrize('seed', seeds)
+def test_region_points(nk, ck, seed):
+    mask = watershed(ck, synthetic_map(seed = seed))
+    for rid in range(1, int(mask.max())+1):
+        assert (sorted_points(nk.region_points(mask, rid)) ==
+                sorted_points(ck.region_points(mask, rid))).all()
+
+@pytest.mark.parametrize('seed', seeds)
+def test_find_local_maxima(nk, ck, seed):
+    m = synthetic_map(seed = seed)
+    rs = numpy.random.RandomState(seed)
+    ks, js, i_s = m.shape
+    points = numpy.stack([rs.randint(0, n, 200) for n in (i_s, js, ks)], axis = 1).astype(numpy.intc)
+    p, cp = points.copy(), points.copy()
+    nk.find_local_maxima(m, p)
+    ck.find_local_maxima(m, cp)
+    assert (p == cp).all()
+
+# -----------------------------------------------------------------------------
+# Loops run uncompiled and compiled with Numba against NumPy operations.
+#
+@pytest.mark.parametrize('seed', [3, 4])
+def test_loops_match_numpy(impl, monkeypatch, seed):
+    m = synthetic_map((16,14,15), nblobs = 8, seed = seed)
+    r = kernel_results(impl, m)
+    with monkeypatch.context() as mp:
+        use_numpy(impl, mp)
+        expect = kernel_results(impl, m)
+    for name, a in expect.items():
+        if name == 'interface values':
+            assert numpy.allclose(r[name], a, rtol = 1e-6), name
+        else:
+            assert r[name].dtype == a.dtype, name
+            assert (r[name] == a).all(), name
+
+# -----------------------------------------------------------------------------
+# Hand checked results on a single plane map with two regions.
+#
+#   map j\i  0    1    2    3        mask   0  1  2  3
+#     0     1    2    1    0                1  1  1  0
+#     1     1    3    1   .5                1  1  2  2
+#     2     0    1   .5    4                0  1  2  2
+#
+plane_map = numpy.array([[[1, 2, 1, 0], [1, 3, 1, .5], [0, 1, .5, 4]]], numpy.float32)
+plane_mask = numpy.array([[[1, 1, 1, 0], [1, 1, 2, 2], [0, 1, 2, 2]]], numpy.uint32)
+
+def test_plane_watershed(impl):
+    assert (watershed(impl, plane_map) == plane_mask).all()
+
+def test_plane_maxima_and_bounds(impl):
+    p, v = impl.region_maxima(plane_mask, plane_map)
+    assert numpy.asarray(p).tolist() == [[1,1,0], [3,2,0]]
+    assert numpy.asarray(v).tolist() == [3, 4]
+    b = impl.region_bounds(plane_mask)
+    assert b.tolist() == [[0,0,0,0,0,0,0], [0,0,0,2,2,0,6], [2,1,0,3,2,0,4]]
+    assert sorted_points(impl.region_points(plane_mask, 2)).tolist() == \
+        [[2,1,0], [2,2,0], [3,1,0], [3,2,0]]
+
+def test_plane_contacts(impl):
+    # Faces (1,1)-(1,2), (2,1)-(2,2) and (0,2)-(1,2) at j,i with lower
+    # side values 1, .5 and 1.
+    assert impl.region_contacts(plane_mask).tolist() == [[1, 2, 3]]
+    ci, cf = impl.interface_values(plane_mask, plane_map)
+    assert ci.tolist() == [[1, 2, 3]]
+    assert cf.tolist() == [[1, 2.5]]
+
+def test_plane_local_maxima(impl):
+    points = numpy.array([(0,0,0), (3,1,0), (0,2,0), (3,2,0)], numpy.intc)
+    impl.find_local_maxima(plane_map, points)
+    assert points.tolist() == [[1,1,0], [3,2,0], [1,1,0], [3,2,0]]
+
+# -----------------------------------------------------------------------------
+# Numpy kernels against grid point loops.
+#
+small_shape = (7, 8, 9)
+
+def neighbors(shape, k, j, i):
+    for dk, dj, di in itertools.product((-1,0,1), repeat = 3):
+        kk, jj, ii = k+dk, j+dj, i+di
+        if (dk, dj, di) != (0,0,0) and 0 <= kk < shape[0] and 0 <= jj < shape[1] and 0 <= ii < shape[2]:
+            yield kk, jj, ii
+
+def ascend(m, p):
+    while True:
+        best = p
+        for q in neighbors(m.shape, *p):
+            if m[q] > m[best]:
+                best = q
+        if best == p:
+            return p
+        p = best
+
+def test_watershed_loops(impl):
+    m = synthetic_map(small_shape, nblobs = 4, seed = 5)
+    mask = watershed(impl, m)
+    top = {}
+    for p in numpy.ndindex(m.shape):
+        if m[p] >= threshold:
+            top.setdefault(ascend(m, p), []).append(p)
+    assert len(top) == mask.max()
+    for rid, peak in enumerate(sorted(top), start = 1):     # k,j,i order of maxima
+        for p in top[peak]:
+            assert mask[p] == rid
+
+def test_contacts_and_bounds_loops(impl):
+    nk = impl
+    m = synthetic_map(small_shape, nblobs = 6, seed = 6)
+    mask = watershed(nk, m)
+    counts, vmax = {}, {}
+    for p in numpy.ndindex(mask.shape):
+        for axis in range(3):
+            q = list(p)
+            q[axis] += 1
+            q = tuple(q)
+            if q[axis] < mask.shape[axis] and 0 < mask[p] != mask[q] > 0:
+                pair = tuple(sorted((int(mask[p]), int(mask[q]))))
+                counts[pair] = counts.get(pair, 0) + 1
+                vmax[pair] = max(vmax.get(pair, -numpy.inf), min(m[p], m[q]))
+    ci, cf = sorted_contacts(*nk.interface_values(mask, m))
+    assert [tuple(c) for c in ci.tolist()] == [pair + (counts[pair],) for pair in sorted(counts)]
+    assert numpy.allclose(cf[:,0], [vmax[pair] for pair in sorted(counts)])
+
+    b = nk.region_bounds(mask)
+    for rid in range(1, int(mask.max())+1):
+        k, j, i = numpy.nonzero(mask == rid)
+        assert tuple(b[rid]) == (i.min(), j.min(), k.min(), i.max(), j.max(), k.max(), len(i))
+        assert (sorted_points(nk.region_points(mask, rid)) ==
+                sorted_points(numpy.stack((i, j, k), axis = 1))).all()
+
+def test_backend_registry():
+    kernels = segger_module('kernels')
+    assert 'numpy' in kernels.available_backends()
+    previous = kernels.backend_name()
+    try:
+        kernels.set_backend('numpy')
+        m = synthetic_map(seed = 7)
+        assert (watershed(kernels, m) == watershed(kernels.backend('numpy'), m)).all()
+        with pytest.raises(ValueError):
+            kernels.set_backend('no such backend')
+    finally:
+        kernels.set_backend(previous)
@@ -0,0 +1,146 @@
+# -----------------------------------------------------------------------------
+# uint16 masks give the same kernel results as uint32 masks without a whole
+# mask uint32 copy, and segmentation masks promote to uint32 for large ids
+# and compact back to uint16 with renumbered regions.
+#
+import numpy
+import pytest
+
+from conftest import segger_module, synthetic_map
+
+def watershed_mask(seed = 0):
+    kernels = segger_module('kernels')
+    m = synthetic_map(seed = seed)
+    mask = numpy.zeros(m.shape, numpy.uint32)
+    kernels.watershed_regions(m, 0.1, mask)
+    return m, mask
+
+@pytest.fixture
+def small_blocks(monkeypatch):
+    '''Use blocks of a few planes and record the size of uint32 conversions.'''
+    parallel = segger_module('parallel')
+    kernels = segger_module('kernels')
+    blocks = parallel._mask_blocks
+    monkeypatch.setattr(parallel, '_mask_blocks',
+                        lambda mask: blocks(mask, block_bytes = 3 * 4 * mask[:1].size))
+    converted = []
+    kernel_mask = kernels.kernel_mask
+    def recording_kernel_mask(mask):
+        if mask.dtype != numpy.uint32:
+            converted.append(mask.shape[0])
+        return kernel_mask(mask)
+    monkeypatch.setattr(kernels, 'kernel_mask', recording_kernel_mask)
+    return converted
+
+def sorted_pairs(c):
+    return numpy.lexsort((c[:,1], c[:,0]))
+
+def test_uint16_region_bounds(small_blocks):
+    parallel = segger_module('parallel')
+    kernels = segger_module('kernels')
+    m, mask = watershed_mask(1)
+    b = parallel.region_bounds(mask.astype(numpy.uint16))
+    assert (b == kernels.region_bounds(mask)).all()
+    assert small_blocks and max(small_blocks) <= 3
+
+def test_uint16_region_maxima(small_blocks):
+    parallel = segger_module('parallel')
+    kernels = segger_module('kernels')
+    m, mask = watershed_mask(3)
+    m -= 2          # Negative maxima, absent regions in a block read 0.
+    p, v = parallel.region_maxima(mask.astype(numpy.uint16), m)
+    kp, kv = kernels.region_maxima(mask, m)
+    assert (p == kp).all() and (v == kv).all()
+    assert small_blocks and max(small_blocks) <= 3
+
+def test_uint16_contacts(small_blocks):
+    parallel = segger_module('parallel')
+    kernels = segger_module('kernels')
+    m, mask = watershed_mask(2)
+    mask16 = mask.astype(numpy.uint16)
+
+    c, sc = parallel.region_contacts(mask16), kernels.region_contacts(mask)
+    assert (c[sorted_pairs(c)] == sc[sorted_pairs(sc)]).all()
+
+    ci, cf = parallel.interface_values(mask16, m)
+    sci, scf = kernels.interface_values(mask, m)
+    o, so = sorted_pairs(ci), sorted_pairs(sci)
+    assert (ci[o] == sci[so]).all()
+    assert numpy.allclose(cf[o], scf[so], rtol = 1e-5)
+    assert small_blocks and max(small_blocks) <= 4      # Block plus seam plane.
+
+def add_leaves(s, ids):
+    '''Table entries for leaf regions and one mask voxel each, in id order.'''
+    s.ensure_mask_range(int(ids.max()))
+    s.mask.flat[:len(ids)] = ids
+    s.table.add_leaf_regions(ids, numpy.zeros((len(ids),3), numpy.int32))
+    s.max_region_id = int(ids.max())
+
+def test_mask_promotion_and_compaction():
+    rt = segger_module('regiontable')
+    mergetree = segger_module('mergetree')
+    s = rt.SegmentationMask(numpy.zeros((10,10,12), numpy.uint16))
+    add_leaves(s, numpy.arange(1, 1001, dtype = numpy.int32))
+    assert s.mask.dtype == numpy.uint16
+    s.ensure_mask_range(65535)
+    assert s.mask.dtype == numpy.uint16
+
+    # Relabelling to ids above 65535 promotes the mask.
+    lut = numpy.arange(1001, dtype = numpy.int32) + 69000
+    lut[0] = 0
+    old = s.mask.copy()
+    s.relabel_mask(lut)
+    assert s.mask.dtype == numpy.uint32
+    assert (s.mask == lut[old]).all()
+
+    t = s.table = rt.RegionTable()
+    ids = lut[1:]
+    t.add_leaf_regions(ids, numpy.zeros((len(ids),3), numpy.int32))
+    g = s.max_region_id = 70001
+    t.add_region(g, child_ids = (69001, 69002))
+    t.attrib[69005] = {'name': 'leaf'}
+    t.attrib[g] = {'name': 'group'}
+    s.merge_tree = mergetree.MergeTree(numpy.array((69003, 69004, 69005)),
+                                       (0,), (1,), (1.0,), 'contact size')
+
+    # Delete some leaves then store as uint16 again with renumbered ids.
+    gone = numpy.arange(69010, 69020, dtype = numpy.int32)
+    s.voxel_index()             # Erase using the voxel index.
+    s.erase_region_voxels(gone)
+    for rid in gone.tolist():
+        t.remove_region(rid)
+    tree = s.merge_tree
+    before = s.mask.copy()
+    new_id = s.compact_mask()
+    assert new_id is not None
+    assert s.mask.dtype == numpy.uint16
+    assert (s.mask == new_id[before]).all()
+
+    kept = numpy.setdiff1d(ids, gone)
+    assert (new_id[kept] == numpy.arange(1, len(kept)+1)).all()
+    assert (new_id[gone] == 0).all()
+    assert new_id[g] == len(kept) + 1 and s.max_region_id == len(kept) + 1
+    assert t.leaf_ids().tolist() == list(range(1, len(kept)+1))
+    assert t.child_ids(new_id[g]) == [1, 2]
+    assert t.attrib == {5: {'name': 'leaf'}, new_id[g]: {'name': 'group'}}
+    assert s.merge_tree is tree and tree.base_ids.tolist() == [3, 4, 5]
+
+    s.calculate_region_bounds()
+    assert (t.npoints[1:len(kept)+1] == 1).all()
+
+def test_many_leaves_stay_uint32():
+    rt = segger_module('regiontable')
+    s = rt.SegmentationMask(numpy.zeros((41,41,40), numpy.uint16))
+    ids = numpy.arange(2, 65540, dtype = numpy.int32)
+    add_leaves(s, ids)
+    assert s.mask.dtype == numpy.uint32
+    assert s.compact_mask() is None and s.mask.dtype == numpy.uint32
+
+    # Fewer than 65536 leaves after deletion, renumbered to fit uint16.
+    s.erase_region_voxels(ids[:10])
+    for rid in ids[:10].tolist():
+        s.table.remove_region(rid)
+    assert s.compact_mask() is not None
+    assert s.mask.dtype == numpy.uint16
+    assert s.mask.max() == len(ids) - 10
+    assert (s.mask.flat[10:len(ids)] == numpy.arange(1, len(ids)-9)).all()
@@ -0,0 +1,77 @@
+# -----------------------------------------------------------------------------
+# Binned mask values are the most common value of blocks aligned to the
+# whole mask, and label surfaces are closed, face outward, enclose the label
+# voxels and share vertices where labels touch.
+#
+import numpy
+import pytest
+
+from conftest import segger_module
+
+@pytest.fixture
+def ms():
+    return segger_module('masksurface')
+
+def vertex_set(v):
+    return set(map(tuple, v.tolist()))
+
+def check_closed(v, t):
+    '''Each directed edge appears once and its reverse once.'''
+    edges = numpy.concatenate((t[:,[0,1]], t[:,[1,2]], t[:,[2,0]]))
+    es = set(map(tuple, edges.tolist()))
+    assert len(es) == len(edges)
+    assert all((b, a) in es for a, b in es)
+
+def enclosed_volume(v, t):
+    a, b, c = v[t[:,0]], v[t[:,1]], v[t[:,2]]
+    return (a * numpy.cross(b, c)).sum() / 6
+
+def test_binned_mask(ms):
+    rs = numpy.random.RandomState(0)
+    mask = rs.randint(0, 4, (7,9,8)).astype(numpy.uint16)
+    bm = ms.binned_mask(mask, 3)
+    assert bm.shape == (3,3,3) and bm.dtype == mask.dtype
+    for k, j, i in numpy.ndindex(bm.shape):
+        block = numpy.zeros((3,3,3), numpy.int64)
+        b = mask[3*k:3*k+3, 3*j:3*j+3, 3*i:3*i+3]
+        block[:b.shape[0],:b.shape[1],:b.shape[2]] = b
+        counts = numpy.bincount(block.ravel())
+        assert bm[k,j,i] == numpy.argmax(counts)
+    assert ms.binned_mask(mask, 1) is mask
+
+def test_touching_labels_share_boundary(ms):
+    labels = numpy.zeros((5,6,8), numpy.int32)
+    labels[1:4,1:5,1:4] = 1
+    labels[1:4,1:5,4:7] = 2
+    (v1, t1), (v2, t2) = ms.label_surfaces(labels, 2)
+    for v, t in ((v1, t1), (v2, t2)):
+        check_closed(v, t)
+        assert enclosed_volume(v, t) > 0       # Triangles face outward.
+    # Shared vertices lie on the plane between labels, i = 3.5, and cover
+    # the contact rectangle.
+    shared = vertex_set(v1) & vertex_set(v2)
+    assert all(p[0] == 3.5 for p in shared)
+    inner = set(p for p in vertex_set(v1) if p[0] == 3.5 and 1 <= p[1] <= 4 and 1 <= p[2] <= 3)
+    assert inner == set(p for p in vertex_set(v2) if p[0] == 3.5 and 1 <= p[1] <= 4 and 1 <= p[2] <= 3)
+    assert inner <= shared
+    assert set((3.5, j, k) for j in range(1,5) for k in range(1,4)) <= inner
+
+def test_label_surfaces_enclose_voxels(ms):
+    rs = numpy.random.RandomState(1)
+    labels = rs.randint(0, 4, (6,7,5)).astype(numpy.int32)
+    surfs = ms.label_surfaces(labels, 5, max_cells = 50)       # Several passes.
+    assert len(surfs[4][0]) == 0 and len(surfs[4][1]) == 0
+    for l, (v, t) in enumerate(surfs[:3], 1):
+        check_closed(v, t)
+        assert enclosed_volume(v, t) > 0
+        # Vertices are edge midpoints next to a label voxel.
+        k, j, i = numpy.nonzero(labels == l)
+        ijk = numpy.stack((i, j, k), axis = 1)
+        d = numpy.abs(v[:,None,:] - ijk[None,:,:]).max(axis = 2).min(axis = 1)
+        assert (d == 0.5).all()
+    # Same surfaces computed in one pass, and shared vertices between touching labels.
+    one = ms.label_surfaces(labels, 5)
+    for (v, t), (w, u) in zip(surfs, one):
+        assert (v == w).all()
+        assert sorted(map(tuple, t.tolist())) == sorted(map(tuple, u.tolist()))
+    assert vertex_set(surfs[0][0]) & vertex_set(surfs[1][0])
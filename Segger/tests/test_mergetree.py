@@ -0,0 +1,74 @@
+# -----------------------------------------------------------------------------
+# Merge tree cuts give the groups of joining the first merges one at a time.
+#
+import numpy
+import pytest
+
+from conftest import segger_module
+
+def random_tree(nbase, nmerges, seed = 0):
+    '''Tree with random joins of current groups and increasing heights.'''
+    MergeTree = segger_module('mergetree').MergeTree
+    rs = numpy.random.RandomState(seed)
+    base_ids = numpy.sort(rs.choice(10*nbase, nbase, replace = False)) + 1
+    live = list(range(nbase))
+    node1, node2 = [], []
+    for m in range(nmerges):
+        a, b = rs.choice(len(live), 2, replace = False)
+        node1.append(live[a])
+        node2.append(live[b])
+        live = [n for i, n in enumerate(live) if i not in (a, b)] + [nbase + m]
+    height = numpy.cumsum(rs.uniform(0, 1, nmerges))
+    return MergeTree(base_ids, node1, node2, height, 'contact size')
+
+def joined_groups(tree, nmerges):
+    '''Groups of base ids from joining merges one at a time, groups of 2 or more.'''
+    members = dict((i, [int(rid)]) for i, rid in enumerate(tree.base_ids))
+    for m in range(nmerges):
+        n = tree.base_count + m
+        members[n] = members.pop(int(tree.node1[m])) + members.pop(int(tree.node2[m]))
+    return sorted(sorted(g) for g in members.values() if len(g) > 1)
+
+def cut_groups(tree, nmerges):
+    return sorted(sorted(g.tolist()) for g in tree.groups(nmerges))
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_cuts_match_joins(seed):
+    tree = random_tree(40, 30, seed)
+    for nmerges in range(tree.merge_count + 1):
+        assert cut_groups(tree, nmerges) == joined_groups(tree, nmerges)
+
+def test_region_count_and_height():
+    tree = random_tree(25, 20, seed = 3)
+    assert tree.minimum_region_count == 5
+    assert tree.merges_for_region_count(25) == 0
+    assert tree.merges_for_region_count(10) == 15
+    assert tree.merges_for_region_count(1) == 20       # Cannot go below 5 regions.
+    for m in range(tree.merge_count):
+        assert tree.merges_for_height(tree.height[m]) == m + 1
+    assert tree.merges_for_height(-1) == 0
+
+def test_labels_give_region_count():
+    tree = random_tree(30, 29, seed = 4)
+    for nregions in (30, 17, 5, 1):
+        labels = tree.labels(tree.merges_for_region_count(nregions))
+        assert len(numpy.unique(labels)) == nregions
+
+def test_cuts_are_nested():
+    tree = random_tree(30, 25, seed = 5)
+    previous = tree.labels(0)
+    for nmerges in range(1, tree.merge_count + 1):
+        labels = tree.labels(nmerges)
+        # Regions grouped by fewer merges stay grouped.
+        pairs = numpy.unique(numpy.stack((previous, labels)), axis = 1)
+        assert len(numpy.unique(pairs[0])) == pairs.shape[1]
+        previous = labels
+
+def test_state_round_trip():
+    MergeTree = segger_module('mergetree').MergeTree
+    tree = random_tree(20, 12, seed = 6)
+    copy = MergeTree.from_state(tree.take_state())
+    assert copy.method == tree.method
+    for name in ('base_ids', 'node1', 'node2', 'height'):
+        assert (getattr(copy, name) == getattr(tree, name)).all()
+    assert cut_groups(copy, 12) == cut_groups(tree, 12)
@@ -0,0 +1,65 @@
+# -----------------------------------------------------------------------------
+# Largest distances of region points from centers and along axes, found for
+# all regions in one pass over the voxel index, agree with distances computed
+# from each region's points.
+#
+import numpy
+import pytest
+
+from conftest import segger_module, synthetic_map
+
+class Transform:
+    '''Affine transform with a 3 by 4 matrix, like a ChimeraX Place.'''
+    def __init__(self, matrix):
+        self.matrix = numpy.array(matrix, numpy.float64)
+
+skewed = Transform([(1.5, 0.2, 0, 3), (0, 1.2, 0.1, -2), (0, 0, 0.9, 1)])
+
+def watershed_mask(seed = 0):
+    kernels = segger_module('kernels')
+    m = synthetic_map(seed = seed)
+    mask = numpy.zeros(m.shape, numpy.uint32)
+    kernels.watershed_regions(m, 0.1, mask)
+    return mask
+
+def physical_points(vi, lids, transform):
+    if len(lids) == 0:
+        return numpy.zeros((0,3))
+    p = vi.points(list(lids)).astype(numpy.float64)
+    A = transform.matrix
+    return p @ A[:,:3].T + A[:,3]
+
+@pytest.mark.parametrize('chunk_size', [2**20, 97])
+def test_point_extents(chunk_size):
+    mo = segger_module('moments')
+    rt = segger_module('regiontable')
+    mask = watershed_mask(0)
+    vi = rt.VoxelIndex(mask)
+    nids = int(mask.max())
+    # Single leaves, groups of leaves, a missing id and an empty region.
+    leaf_ids = [numpy.array([r]) for r in range(1, nids+1)]
+    leaf_ids += [numpy.arange(1, nids+1, 3), numpy.array([2, 5, 7]),
+                 numpy.array([nids + 50]), numpy.zeros((0,), numpy.int32)]
+    rs = numpy.random.RandomState(0)
+    centers = rs.uniform(0, 30, (len(leaf_ids), 3))
+    axes = numpy.linalg.qr(rs.normal(size = (len(leaf_ids), 3, 3)))[0]
+    radii, ext = mo.point_extents(vi, leaf_ids, centers, axes, skewed, chunk_size = chunk_size)
+    for lids, c, U, r, e in zip(leaf_ids, centers, axes, radii, ext):
+        p = physical_points(vi, [l for l in lids if l <= nids], skewed)
+        if len(p) == 0:
+            assert r == 0 and (e == 0).all()
+            continue
+        d = p - c
+        assert r == pytest.approx(numpy.sqrt((d*d).sum(axis = 1).max()), rel = 1e-12)
+        assert numpy.allclose(e, numpy.abs(d @ U).max(axis = 0), rtol = 1e-12)
+
+def test_point_extents_radius_only():
+    mo = segger_module('moments')
+    rt = segger_module('regiontable')
+    mask = numpy.zeros((4,5,6), numpy.uint16)
+    mask[1,2,0:4] = 1
+    mask[3,0,5] = 2
+    vi = rt.VoxelIndex(mask)
+    radii, ext = mo.point_extents(vi, [[1], [1, 2]], [(1.5, 2, 1), (0, 0, 0)])
+    assert ext is None
+    assert radii.tolist() == pytest.approx([1.5, numpy.sqrt(5**2 + 3**2)])
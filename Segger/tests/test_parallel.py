@@ -0,0 +1,98 @@
+# -----------------------------------------------------------------------------
+# Parallel and slab-wise watershed and contacts give the serial results.
+#
+import multiprocessing
+import numpy
+import pytest
+
+from conftest import segger_module, synthetic_map, installed
+
+threshold = 0.1
+
+def serial_watershed(m):
+    kernels = segger_module('kernels')
+    mask = numpy.zeros(m.shape, numpy.uint32)
+    kernels.watershed_regions(m, threshold, mask)
+    return mask
+
+def same_regions(mask1, mask2):
+    '''Masks have the same regions, possibly with different ids.'''
+    if mask1.shape != mask2.shape or ((mask1 == 0) != (mask2 == 0)).any():
+        return False
+    pairs = numpy.unique(numpy.stack((mask1.ravel(), mask2.ravel())), axis = 1)
+    return (len(numpy.unique(pairs[0])) == pairs.shape[1] and
+            len(numpy.unique(pairs[1])) == pairs.shape[1])
+
+def sorted_contacts(c):
+    return c[numpy.lexsort((c[:,1], c[:,0]))]
+
+class ArrayData:
+    '''Map array read by z planes like GridData.'''
+    def __init__(self, m):
+        self.m = m
+        self.size = m.shape[::-1]
+    def matrix(self, ijk_origin, ijk_size):
+        (i0,j0,k0), (si,sj,sk) = ijk_origin, ijk_size
+        return self.m[k0:k0+sk, j0:j0+sj, i0:i0+si]
+
+needs_fork = pytest.mark.skipif(
+    not installed and multiprocessing.get_start_method() != 'fork',
+    reason = 'worker processes import the source package only when forked')
+
+@needs_fork
+@pytest.mark.parametrize('seed', [0, 1, 2])
+@pytest.mark.parametrize('workers', [2, 3, 5])
+def test_parallel_watershed(seed, workers):
+    parallel = segger_module('parallel')
+    m = synthetic_map(seed = seed)
+    mask, max_points = parallel.watershed_regions(m, threshold, workers)
+    serial = serial_watershed(m)
+    assert same_regions(mask, serial)
+    assert len(max_points) == serial.max()
+    # Each maximum is in its own region.
+    i, j, k = max_points.T
+    assert (mask[k, j, i] == numpy.arange(1, len(max_points)+1)).all()
+
+@pytest.mark.parametrize('slab_planes', [3, 7, 11])
+def test_tiled_watershed(slab_planes):
+    watershed = segger_module('watershed')
+    m = synthetic_map(seed = 3)
+    mask = numpy.zeros(m.shape, numpy.uint32)
+    watershed.tiled_watershed(ArrayData(m), threshold, mask, slab_planes, halo = 1)
+    assert same_regions(mask, serial_watershed(m))
+
+@needs_fork
+@pytest.mark.parametrize('workers', [2, 4])
+def test_parallel_contacts(workers):
+    parallel = segger_module('parallel')
+    kernels = segger_module('kernels')
+    m = synthetic_map(seed = 4)
+    mask = serial_watershed(m)
+
+    c = parallel.region_contacts(mask, workers)
+    assert (sorted_contacts(c) == sorted_contacts(kernels.region_contacts(mask))).all()
+
+    ci, cf = parallel.interface_values(mask, m, workers)
+    sci, scf = kernels.interface_values(mask, m)
+    order, sorder = numpy.lexsort((ci[:,1], ci[:,0])), numpy.lexsort((sci[:,1], sci[:,0]))
+    assert (ci[order] == sci[sorder]).all()
+    assert numpy.allclose(cf[order], scf[sorder], rtol = 1e-5)
+
+def test_worker_count():
+    import os
+    parallel = segger_module('parallel')
+    ncpu = os.cpu_count() or 1
+    assert parallel.worker_count(0) == ncpu
+    assert parallel.worker_count(None) == ncpu
+    assert parallel.worker_count(1) == 1
+    assert parallel.worker_count(10**6) == ncpu
+    assert parallel.worker_count(-3) == 1
+    assert parallel.worker_count('many') == 1
+
+def test_one_worker_is_serial():
+    parallel = segger_module('parallel')
+    m = synthetic_map(seed = 5)
+    mask, max_points = parallel.watershed_regions(m, threshold, 1)
+    assert (mask == serial_watershed(m)).all()
+    i, j, k = max_points.T
+    assert (mask[k, j, i] == numpy.arange(1, len(max_points)+1)).all()
@@ -0,0 +1,146 @@
+# -----------------------------------------------------------------------------
+# Region table child lists, top level parents, renumbering and state.
+#
+import numpy
+import pytest
+
+from conftest import segger_module
+
+@pytest.fixture
+def rt():
+    return segger_module('regiontable')
+
+def grouped_table(rt):
+    '''Leaves 1-6, groups 7 = (1,2), 8 = (7,3), 9 = (4,5), leaf 6 ungrouped.'''
+    t = rt.RegionTable()
+    ids = numpy.arange(1, 7, dtype = numpy.int32)
+    t.add_leaf_regions(ids, numpy.zeros((6,3), numpy.int32))
+    t.add_region(7, child_ids = (1,2))
+    t.add_region(8, child_ids = (7,3))
+    t.add_region(9, child_ids = (4,5))
+    return t
+
+def check_links(t):
+    '''Child lists, child counts and top count agree with the parent array.'''
+    for rid in t.ids().tolist():
+        cids = t.child_ids(rid)
+        assert sorted(cids) == [c for c in t.ids().tolist() if t.parent[c] == rid]
+        assert t.nchildren[rid] == len(cids)
+        back = []
+        c = t.last_child[rid]
+        while c:
+            back.append(c)
+            c = t.prev_sibling[c]
+        assert back == cids[::-1]
+    assert t.top_count == len(t.top_ids())
+
+def test_parent_child_links(rt):
+    t = grouped_table(rt)
+    check_links(t)
+    assert t.child_ids(8) == [7, 3]
+    assert t.child_ids(7) == [1, 2]
+    assert t.top_ids().tolist() == [6, 8, 9]
+    assert t.leaf_ids().tolist() == [1, 2, 3, 4, 5, 6]
+    assert not t.in_mask[7] and t.in_mask[1]
+
+    # Move a leaf between groups and to the top level.
+    t.set_parent(2, 9)
+    assert t.child_ids(7) == [1] and t.child_ids(9) == [4, 5, 2]
+    t.set_parent(4, 0)
+    assert t.child_ids(9) == [5, 2] and t.parent[4] == 0
+    check_links(t)
+
+def test_remove_region(rt):
+    t = grouped_table(rt)
+    t.attrib[7] = {'name': 'g'}
+    t.remove_region(7)
+    assert not t.has_region(7) and 7 not in t.attrib
+    assert t.parent[1] == 0 and t.parent[2] == 0
+    assert t.child_ids(8) == [3]
+    assert t.top_ids().tolist() == [1, 2, 6, 8, 9]
+    check_links(t)
+
+    t.remove_region(3)
+    assert t.child_ids(8) == [] and t.nchildren[8] == 0
+    assert t.leaf_ids().tolist() == [1, 2, 4, 5, 6, 8]
+    check_links(t)
+
+def test_top_parents(rt):
+    t = grouped_table(rt)
+    top = t.top_parents()
+    assert [top[r] for r in range(1, 10)] == [8, 8, 8, 9, 9, 6, 8, 8, 9]
+    # Same answer from the hierarchy index once it is built.
+    h = t.hierarchy()
+    assert (t.top_parents() == top).all()
+    assert sorted(h.regions_under(8).tolist()) == [1, 2, 3, 7, 8]
+    assert t.leaf_ids_under(8).tolist() == [1, 2, 3]
+    assert h.is_ancestor(8, 1) and not h.is_ancestor(9, 1)
+
+    # Structure changes discard the hierarchy index.
+    t.set_parent(9, 8)
+    assert t.top_parents()[4] == 8
+    assert t.leaf_ids_under(8).tolist() == [1, 2, 3, 4, 5]
+
+def test_deep_chain_top_parents(rt):
+    t = rt.RegionTable()
+    t.add_leaf_regions(numpy.array((1,), numpy.int32), numpy.zeros((1,3), numpy.int32))
+    for rid in range(2, 2001):
+        t.add_region(rid, child_ids = (rid-1,))
+    assert t.top_parents()[1] == 2000
+    assert t.leaf_ids_under(2000).tolist() == [1]
+
+def test_renumber(rt):
+    t = grouped_table(rt)
+    t.max_point[3] = (4,5,6)
+    t.has_max_point[3] = True
+    t.attrib[9] = {'name': 'b'}
+    t.extras[3] = {'x': 1}
+    new_id = numpy.zeros((t.size,), numpy.int32)
+    new_id[1:10] = (20, 11, 12, 13, 14, 15, 16, 17, 18)
+    color8 = t.color[8].copy()
+    t.renumber(new_id)
+
+    assert t.ids().tolist() == [11, 12, 13, 14, 15, 16, 17, 18, 20]
+    # Child lists are rebuilt in id order.
+    assert t.child_ids(17) == [12, 16] and t.child_ids(16) == [11, 20]
+    assert t.child_ids(18) == [13, 14]
+    assert t.top_ids().tolist() == [15, 17, 18]
+    assert tuple(t.max_point[12]) == (4,5,6) and t.has_max_point[12]
+    assert (t.color[17] == color8).all()
+    assert t.attrib == {18: {'name': 'b'}} and t.extras == {12: {'x': 1}}
+    assert t.leaf_ids().tolist() == [11, 12, 13, 14, 15, 20]
+    check_links(t)
+
+def test_take_and_set_state(rt):
+    t = grouped_table(rt)
+    t.npoints[1:7] = (5, 6, 7, 8, 9, 10)
+    state = t.take_state()
+    assert not state['shown'].any()
+
+    t2 = rt.RegionTable()
+    t2.set_state(state)
+    assert (t2.ids() == t.ids()).all()
+    for rid in t.ids().tolist():
+        assert t2.child_ids(rid) == sorted(t.child_ids(rid))
+    assert (t2.npoints[1:7] == t.npoints[1:7]).all()
+    assert (t2.color[t.ids()] == t.color[t.ids()]).all()
+    assert (t2.in_mask[:10] == t.in_mask[:10]).all()
+    check_links(t2)
+
+def test_voxel_index(rt):
+    mask = numpy.zeros((3,4,5), numpy.uint16)
+    mask[0,1,2] = mask[2,3,4] = 2
+    mask[1,0,0] = 5
+    vi = rt.VoxelIndex(mask)
+    assert vi.region_size(2) == 2 and vi.region_size(5) == 1 and vi.region_size(3) == 0
+    assert vi.points([2]).tolist() == [[2,1,0], [4,3,2]]
+    assert vi.points([5, 2]).tolist() == [[0,0,1], [2,1,0], [4,3,2]]
+    vi.remove_region(2)
+    assert vi.region_size(2) == 0 and len(vi.region_voxels(9)) == 0
+
+def test_relabel(rt):
+    rs = numpy.random.RandomState(0)
+    mask = rs.randint(0, 10, (7,6,5)).astype(numpy.uint16)
+    lut = rs.randint(0, 100, 10)
+    out = rt.relabel(mask.copy(), lut, chunk_bytes = 60, threads = 3)
+    assert (out == lut[mask]).all()
@@ -0,0 +1,56 @@
+# -----------------------------------------------------------------------------
+# Scale space smoothing from one Fourier transform matches direct Gaussian
+# convolution with zeros outside the map, and the plane by plane transforms
+# used with double precision numpy.fft keep complex64 results.
+#
+import numpy
+import pytest
+
+from conftest import segger_module, synthetic_map
+
+@pytest.fixture
+def ss():
+    return segger_module('scalespace')
+
+def convolve(m, sdev, cutoff = 5):
+    '''Separable convolution with a sampled Gaussian, zero outside the array.'''
+    r = int(numpy.ceil(cutoff * sdev))
+    x = numpy.arange(-r, r+1)
+    g = numpy.exp(-x**2 / (2.0 * sdev**2))
+    g /= g.sum()
+    a = m.astype(numpy.float64)
+    for axis in range(3):
+        a = numpy.apply_along_axis(lambda v: numpy.convolve(v, g)[r:r+len(v)], axis, a)
+    return a
+
+def plane_fft_functions(threads = None):
+    ss = segger_module('scalespace')
+    return ss._rfftn_planes, ss._irfftn_planes, lambda n: n, {}
+
+@pytest.mark.parametrize('sdev', [1.0, 2.5])
+def test_smoothing_matches_convolution(ss, sdev):
+    m = synthetic_map(shape = (20,18,22))
+    s = ss.GaussianScaleSpace(m, 3.0)
+    r = s.smoothed(sdev)
+    assert r.dtype == numpy.float32 and r.shape == m.shape
+    assert numpy.allclose(r, convolve(m, sdev), atol = 1e-3 * m.max())
+
+def test_plane_transforms(ss):
+    a = numpy.random.RandomState(0).random_sample((9,10,7)).astype(numpy.float32)
+    f = ss._rfftn_planes(a)
+    assert f.dtype == numpy.complex64
+    assert numpy.allclose(f, numpy.fft.rfftn(a.astype(numpy.float64)), rtol = 1e-4, atol = 1e-4)
+    b = ss._irfftn_planes(f, a.shape)
+    assert b.dtype == numpy.float32
+    assert numpy.allclose(b, a, atol = 1e-5)
+
+def test_plane_transform_smoothing(ss, monkeypatch):
+    m = synthetic_map(shape = (20,18,22))
+    expect = ss.GaussianScaleSpace(m, 3.0).smoothed(2.0).copy()
+    monkeypatch.setattr(ss, '_fft_functions', plane_fft_functions)
+    s = ss.GaussianScaleSpace(m, 3.0)
+    assert s.spectrum.dtype == numpy.complex64
+    assert numpy.allclose(s.smoothed(2.0), expect, atol = 1e-5 * m.max())
+    assert numpy.allclose(s.smoothed((1.0, 2.0, 3.0)),
+                          ss.GaussianScaleSpace(m, 3.0).smoothed((1.0, 2.0, 3.0)),
+                          atol = 1e-5 * m.max())